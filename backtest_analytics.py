@@ -0,0 +1,470 @@
+from functools import cached_property
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+import seaborn as sns
+
+from backtestt import DIRECTIONS, TradeLog, _coerce_results, _finish_figure, _new_figure, logger
+
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def position_paths(results) -> pd.DataFrame:
+    """
+    Balance path of every closed position relative to the balance when it opened.
+
+    A position's path includes its counter trades, which close while it is
+    open. Because entries are sized from the current balance, chaining the
+    positions' growth in their original order reproduces the backtest's
+    balance after each trade, and their low, high and internal drawdown
+    reproduce its max drawdown, so resampled sequences of positions keep the
+    drawdown counter-trade losses cause within a position.
+
+    Parameters:
+    - results: Results of a single-position backtest with full logs, or a saved results directory
+
+    Returns:
+    - DataFrame with one row per closed position: growth (balance after the
+      close over balance at the open), low and high of that ratio while open,
+      and drawdown (most negative fall from an earlier high within the position, as a fraction)
+    """
+    results = _coerce_results(results)
+    if not isinstance(results.get('trade_history'), TradeLog) or 'symbols' in results:
+        raise ValueError("Position paths need the full trade log of a single-position backtest")
+    rows = results['trade_history'].array
+    actions = rows['action']
+    pnl = np.where(actions == 0, 0.0, rows['pnl_amount'])
+    balance = results['initial_balance'] + np.cumsum(pnl)
+
+    # Rows from one open up to the next belong to the same position
+    position = np.cumsum(actions == 0) - 1
+    num_closed = int(np.count_nonzero(actions == 1))
+    balance_at_open = balance[actions == 0][:num_closed]
+    # Like the equity curve, only see the balance after the last event of a candle
+    # (a counter trade closing with its position is not a separate dip)
+    last_of_candle = np.append(rows['time'][1:] != rows['time'][:-1], True)
+    kept = (position >= 0) & (position < num_closed) & (last_of_candle | (actions == 0))
+    # A balance at or below zero is ruin, so ratios are floored there
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = np.maximum(balance[kept] / balance_at_open[position[kept]], 0)
+    paths = pd.DataFrame({'position': position[kept], 'growth': growth})
+    peaks = paths.groupby('position')['growth'].cummax()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        paths['drawdown'] = np.where(peaks > 0, paths['growth'] / peaks - 1, 0.0)
+
+    grouped = paths.groupby('position')
+    return pd.DataFrame({
+        'growth': grouped['growth'].last(),
+        'low': grouped['growth'].min(),
+        'high': grouped['growth'].max(),
+        'drawdown': grouped['drawdown'].min(),
+    })
+
+
+def trade_returns(results) -> np.ndarray:
+    """Return of every closed position, counter trades included, relative to the balance at its open."""
+    return position_paths(results)['growth'].to_numpy() - 1
+
+
+def monte_carlo(results, num_trials: int = 10000, method: str = 'bootstrap', seed: int = None,
+                percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> dict:
+    """
+    Resample the positions of a backtest to get percentile bands for return and drawdown.
+
+    All trials are simulated at once on (trials x positions) matrices: the
+    cumulative product of the positions' growth along each row is the
+    equity path, and each position's low, high and internal drawdown give
+    the max drawdown of the path. 'bootstrap' draws positions with
+    replacement, so both final balance and drawdown vary; 'shuffle' permutes
+    the actual positions, which keeps the final balance and only varies the
+    drawdown. A path that reaches zero balance is ruined and stays at zero.
+    Memory use is a few times 8 bytes per trial and position.
+
+    Parameters:
+    - results: Results of a single-position backtest with full logs, or a saved results directory
+    - num_trials: Number of resampled position sequences
+    - method: 'bootstrap' or 'shuffle'
+    - seed: Random seed
+    - percentiles: Percentiles to report
+
+    Returns:
+    - dict with percentile Series of final balance, percentage return and max
+      drawdown, loss and ruin probabilities, equity bands after each position
+      and the raw per-trial arrays
+    """
+    results = _coerce_results(results)
+    paths = position_paths(results)
+    initial_balance = results['initial_balance']
+    num_positions = len(paths)
+    if not num_positions:
+        raise ValueError("Monte Carlo analysis needs at least one closed trade")
+
+    rng = np.random.default_rng(seed)
+    if method == 'bootstrap':
+        sample = rng.integers(0, num_positions, (num_trials, num_positions))
+    elif method == 'shuffle':
+        sample = rng.permuted(np.broadcast_to(np.arange(num_positions), (num_trials, num_positions)), axis=1)
+    else:
+        raise ValueError(f"Unknown Monte Carlo method: {method}")
+
+    # Balance at every open and after every close
+    equity = np.empty((num_trials, num_positions + 1))
+    equity[:, 0] = initial_balance
+    np.cumprod(paths['growth'].to_numpy()[sample], axis=1, out=equity[:, 1:])
+    equity[:, 1:] *= initial_balance
+    at_open = equity[:, :-1]
+
+    # Highest balance before each position, then the deepest fall below it while the position is open
+    peaks = np.empty_like(at_open)
+    peaks[:, 0] = initial_balance
+    np.maximum.accumulate(at_open[:, :-1] * paths['high'].to_numpy()[sample[:, :-1]], axis=1, out=peaks[:, 1:])
+    np.maximum(peaks[:, 1:], initial_balance, out=peaks[:, 1:])
+    drawdowns = np.minimum(at_open * paths['low'].to_numpy()[sample] / peaks - 1,
+                           paths['drawdown'].to_numpy()[sample])
+    max_drawdowns = np.minimum(drawdowns.min(axis=1), 0) * 100
+    final_balances = equity[:, -1]
+    percentage_returns = (final_balances / initial_balance - 1) * 100
+
+    labels = pd.Index(percentiles, name='percentile')
+    logger.info(f"Monte Carlo ({method}) over {num_trials} trials of {num_positions} positions")
+    return {
+        'method': method,
+        'num_trials': num_trials,
+        'num_trades': num_positions,
+        'initial_balance': initial_balance,
+        'final_balance': pd.Series(np.percentile(final_balances, percentiles), index=labels),
+        'percentage_return': pd.Series(np.percentile(percentage_returns, percentiles), index=labels),
+        'max_drawdown': pd.Series(np.percentile(max_drawdowns, percentiles), index=labels),
+        'probability_of_loss': np.mean(final_balances < initial_balance),
+        'probability_of_ruin': np.mean(final_balances <= 0),
+        'equity_bands': pd.DataFrame(np.percentile(equity, percentiles, axis=0).T,
+                                     columns=labels, index=pd.RangeIndex(num_positions + 1, name='trade')),
+        'final_balances': final_balances,
+        'max_drawdowns': max_drawdowns,
+    }
+
+
+def plot_monte_carlo(monte_carlo_results: dict, save_path: str = None, show: bool = True):
+    """
+    Plot the equity percentile bands and the max drawdown distribution of monte_carlo results.
+
+    With show=False it is drawn on a standalone Figure and only saved, for headless use.
+    """
+    bands = monte_carlo_results['equity_bands']
+    percentiles = list(bands.columns)
+    fig = _new_figure((16, 6), show)
+    axes = fig.subplots(1, 2)
+
+    # Shade symmetric pairs of percentiles, outermost first, and draw the median
+    for low, high in zip(percentiles[:len(percentiles) // 2], reversed(percentiles)):
+        axes[0].fill_between(bands.index, bands[low], bands[high], alpha=0.2, color='tab:blue',
+                             label=f'{low:g}-{high:g}th percentile')
+    if len(percentiles) % 2:
+        median = percentiles[len(percentiles) // 2]
+        axes[0].plot(bands.index, bands[median], color='tab:blue', label=f'{median:g}th percentile')
+    axes[0].axhline(y=monte_carlo_results['initial_balance'], color='r', linestyle='--', label='Initial Balance')
+    axes[0].set_title(f"Monte Carlo Equity ({monte_carlo_results['method']}, "
+                      f"{monte_carlo_results['num_trials']} trials)")
+    axes[0].set_xlabel('Trade')
+    axes[0].set_ylabel('Balance')
+    axes[0].legend()
+    axes[0].grid(True)
+
+    # Shuffles of few distinct trades give few distinct drawdowns, which cannot fill 50 bins
+    max_drawdowns = monte_carlo_results['max_drawdowns']
+    axes[1].hist(max_drawdowns, bins=min(50, len(np.unique(np.round(max_drawdowns, 6)))))
+    axes[1].set_title('Max Drawdown Distribution')
+    axes[1].set_xlabel('Max Drawdown %')
+    axes[1].set_ylabel('Frequency')
+    axes[1].grid(True)
+
+    fig.tight_layout()
+
+    _finish_figure(fig, save_path, show)
+
+
+def _rank_within(codes: np.ndarray) -> np.ndarray:
+    """Rank of every element among the elements with the same code, in array order."""
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    group_starts = np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+    ranks = np.empty(len(codes), dtype=np.int64)
+    ranks[order] = np.arange(len(codes)) - group_starts
+    return ranks
+
+
+class TradeAnalytics:
+    """
+    Per-position table and breakdowns of one backtest's trade log.
+
+    The position table is built from the columnar TradeLog in a few
+    vectorized passes: the k-th open of a coin is paired with its k-th close,
+    and counter-trade closes are attributed to the position open at the time.
+    Every breakdown is one groupby over that table and is computed on first
+    access, then kept, so charts and reports reuse it. Use trade_analytics()
+    to also share instances between calls for the same results.
+    """
+
+    def __init__(self, results):
+        """
+        Parameters:
+        - results: Backtest results with a full trade log, or a saved results directory
+        """
+        results = _coerce_results(results)
+        if not isinstance(results.get('trade_history'), TradeLog):
+            raise ValueError("Trade analytics need the full trade log (lean_backtest=False)")
+        self.trade_history = results['trade_history']
+
+    @cached_property
+    def positions(self) -> pd.DataFrame:
+        """One row per closed position, in close order."""
+        log = self.trade_history
+        rows = log.array
+        actions = rows['action']
+        row_index = np.arange(len(rows))
+        open_rows, close_rows = row_index[actions == 0], row_index[actions == 1]
+        open_coins, close_coins = rows['coin'][open_rows], rows['coin'][close_rows]
+        if np.any(close_coins < 0):
+            # Closes without a recorded coin come from one position at a time, so pair them in order
+            open_coins, close_coins = np.zeros_like(open_coins), np.zeros_like(close_coins)
+
+        # Pair the k-th close of every coin with the k-th open of that coin
+        stride = len(rows) + 1
+        open_keys = open_coins.astype(np.int64) * stride + _rank_within(open_coins)
+        close_keys = close_coins.astype(np.int64) * stride + _rank_within(close_coins)
+        order = np.argsort(open_keys)
+        open_rows = open_rows[order[np.searchsorted(open_keys[order], close_keys)]]
+
+        opens, closes = rows[open_rows], rows[close_rows]
+        counter_pnl, counter_trades = self._counter_trades(rows, open_rows, close_rows)
+        coins = np.array(log.coins + [None], dtype=object)
+        positions = pd.DataFrame({
+            'coin': coins[opens['coin']],
+            'direction': np.array(DIRECTIONS, dtype=object)[opens['direction']],
+            'reason': np.array(log.reasons, dtype=object)[closes['reason']],
+            'open_time': pd.to_datetime(opens['time'], unit='ns'),
+            'close_time': pd.to_datetime(closes['time'], unit='ns'),
+            'holding_minutes': (closes['time'] - opens['time']) / 60e9,
+            'open_price': closes['open_price'],
+            'close_price': closes['close_price'],
+            'pnl_percentage': closes['pnl_percentage'],
+            'pnl_amount': closes['pnl_amount'],
+            'counter_pnl': counter_pnl,
+            'counter_trades': counter_trades,
+            'margin_levels_used': closes['margin_levels_used'],
+            'total_margin_used': closes['total_margin_used'],
+        })
+        positions['total_pnl'] = positions['pnl_amount'] + positions['counter_pnl']
+        positions['win'] = positions['pnl_amount'] > 0
+        return positions
+
+    @staticmethod
+    def _counter_trades(rows: np.ndarray, open_rows: np.ndarray, close_rows: np.ndarray):
+        """PnL and number of counter-trade closes of every position, NaN when positions overlap."""
+        num_positions = len(close_rows)
+        by_open = np.argsort(open_rows)
+        if np.any(open_rows[by_open][1:] < close_rows[by_open][:-1]):
+            # Concurrent positions (universe backtests) do not record which one a counter trade hedged
+            return np.full(num_positions, np.nan), np.full(num_positions, -1)
+
+        counter_rows = np.flatnonzero(rows['action'] == 2)
+        owner = np.searchsorted(open_rows[by_open], counter_rows, side='right') - 1
+        owned = (owner >= 0) & (counter_rows < close_rows[by_open][np.maximum(owner, 0)])
+        owner = by_open[owner[owned]]
+        pnl = np.bincount(owner, weights=rows['pnl_amount'][counter_rows[owned]], minlength=num_positions)
+        return pnl, np.bincount(owner, minlength=num_positions)
+
+    def _breakdown(self, key: str) -> pd.DataFrame:
+        grouped = self.positions.groupby(key, sort=True)
+        breakdown = grouped.agg(
+            trades=('pnl_amount', 'size'),
+            total_pnl=('pnl_amount', 'sum'),
+            mean_pnl=('pnl_amount', 'mean'),
+            mean_pnl_percentage=('pnl_percentage', 'mean'),
+            win_rate=('win', 'mean'),
+            counter_pnl=('counter_pnl', 'sum'),
+            median_holding_minutes=('holding_minutes', 'median'),
+        )
+        breakdown['win_rate'] *= 100
+        if self.positions['counter_pnl'].isna().all():
+            breakdown['counter_pnl'] = np.nan
+        return breakdown
+
+    @cached_property
+    def by_reason(self) -> pd.DataFrame:
+        """Trades, PnL, win rate and holding time per close reason."""
+        return self._breakdown('reason')
+
+    @cached_property
+    def by_margin_level(self) -> pd.DataFrame:
+        """Trades, PnL, win rate and holding time per number of margin levels used."""
+        return self._breakdown('margin_levels_used')
+
+    @cached_property
+    def by_coin(self) -> pd.DataFrame:
+        """Trades, PnL, win rate and holding time per coin."""
+        return self._breakdown('coin')
+
+    @cached_property
+    def holding_time(self) -> pd.Series:
+        """Distribution of holding times in minutes."""
+        return self.positions['holding_minutes'].describe(percentiles=[0.05, 0.25, 0.5, 0.75, 0.95])
+
+    @cached_property
+    def counter_trade_contribution(self) -> dict:
+        """PnL of main positions and of their counter trades, and the counter trades' share."""
+        positions = self.positions
+        main_pnl = positions['pnl_amount'].sum()
+        counter_pnl = positions['counter_pnl'].sum(min_count=1)
+        total = main_pnl + counter_pnl
+        return {
+            'main_pnl': main_pnl,
+            'counter_pnl': counter_pnl,
+            'counter_trades': int(positions['counter_trades'].clip(lower=0).sum()),
+            'positions_with_counter_trades': int((positions['counter_trades'] > 0).sum()),
+            'counter_share': counter_pnl / abs(total) * 100 if total else np.nan,
+        }
+
+    def report_section(self) -> str:
+        """Markdown section with the breakdowns, for generate_backtest_report."""
+        if self.positions.empty:
+            return ""
+        columns = ['trades', 'total_pnl', 'win_rate', 'median_holding_minutes']
+        section = "## Trade Breakdown\n\n"
+        section += f"### By Close Reason\n\n```\n{self.by_reason[columns].to_string(float_format='{:.2f}'.format)}\n```\n\n"
+        section += (f"### By Margin Levels Used\n\n"
+                    f"```\n{self.by_margin_level[columns].to_string(float_format='{:.2f}'.format)}\n```\n\n")
+        section += f"- Median Holding Time: {self.holding_time['50%']:.1f} minutes\n"
+        section += f"- 95th Percentile Holding Time: {self.holding_time['95%']:.1f} minutes\n"
+        contribution = self.counter_trade_contribution
+        if not np.isnan(contribution['counter_pnl']):
+            section += f"- Counter Trade PnL: ${contribution['counter_pnl']:.2f} "
+            section += f"({contribution['counter_share']:.2f}% of net trade PnL)\n"
+        return section + "\n"
+
+
+def trade_analytics(results) -> TradeAnalytics:
+    """
+    Cached TradeAnalytics of results.
+
+    The same results always give the same instance, with every breakdown it
+    has already computed, until their trade log changes. The instance is kept
+    on the trade log, tagged with its version, so it is freed together with
+    the log (a WeakKeyDictionary could not free it, since the analytics
+    reference the log).
+    """
+    results = _coerce_results(results)
+    log = results.get('trade_history')
+    if not isinstance(log, TradeLog):
+        return TradeAnalytics(results)
+    cached = getattr(log, '_trade_analytics', None)
+    if cached is not None and cached[0] == log.version:
+        return cached[1]
+    analytics = TradeAnalytics(results)
+    log._trade_analytics = (log.version, analytics)
+    return analytics
+
+
+def clear_trade_analytics(results):
+    """Drop the cached TradeAnalytics of results, e.g. to time the uncached report."""
+    log = _coerce_results(results).get('trade_history')
+    if isinstance(log, TradeLog):
+        log._trade_analytics = None
+
+
+def compare_runs(runs: Dict[str, dict], breakdown: str = 'by_reason') -> pd.DataFrame:
+    """
+    Stack one breakdown of many runs, reusing their cached analytics.
+
+    Parameters:
+    - runs: Mapping of run name to results (or saved results directory)
+    - breakdown: TradeAnalytics attribute, e.g. 'by_reason' or 'by_margin_level'
+
+    Returns:
+    - DataFrame indexed by run name and breakdown key
+    """
+    return pd.concat({name: getattr(trade_analytics(results), breakdown) for name, results in runs.items()},
+                     names=['run'])
+
+
+def plot_trade_breakdowns(results, save_path: str = None, show: bool = True):
+    """
+    Plot PnL and win rate by margin levels used, holding times and counter-trade contribution.
+
+    With show=False it is drawn on a standalone Figure and only saved, for headless use.
+    """
+    analytics = trade_analytics(results)
+    if analytics.positions.empty:
+        logger.warning("No closed trades found to analyze")
+        return
+    by_margin_level = analytics.by_margin_level
+    fig = _new_figure((16, 12), show)
+    axes = fig.subplots(2, 2)
+
+    axes[0, 0].bar(by_margin_level.index.astype(str), by_margin_level['total_pnl'])
+    axes[0, 0].set_title('P&L by Margin Levels Used')
+    axes[0, 0].set_xlabel('Margin Levels Used')
+    axes[0, 0].set_ylabel('Total P&L')
+    axes[0, 0].grid(True)
+
+    axes[0, 1].bar(by_margin_level.index.astype(str), by_margin_level['win_rate'])
+    axes[0, 1].set_title('Win Rate by Margin Levels Used')
+    axes[0, 1].set_xlabel('Margin Levels Used')
+    axes[0, 1].set_ylabel('Win Rate %')
+    axes[0, 1].grid(True)
+
+    # Holds range from minutes to months, so bin them on a log scale
+    holding_minutes = analytics.positions['holding_minutes'].clip(lower=1)
+    axes[1, 0].hist(holding_minutes, bins=np.geomspace(holding_minutes.min(), holding_minutes.max() * 1.01, 31))
+    axes[1, 0].set_xscale('log')
+    axes[1, 0].set_title('Holding Time Distribution')
+    axes[1, 0].set_xlabel('Holding Time (minutes)')
+    axes[1, 0].set_ylabel('Frequency')
+    axes[1, 0].grid(True)
+
+    contribution = analytics.counter_trade_contribution
+    axes[1, 1].bar(['Main positions', 'Counter trades'],
+                   [contribution['main_pnl'], np.nan_to_num(contribution['counter_pnl'])])
+    axes[1, 1].set_title('P&L Contribution')
+    axes[1, 1].set_ylabel('Total P&L')
+    axes[1, 1].grid(True)
+
+    fig.tight_layout()
+
+    _finish_figure(fig, save_path, show)
+
+
+def sensitivity_table(sweep_results: pd.DataFrame, x: str, y: str, metric: str = 'percentage_return',
+                      aggfunc: str = 'mean') -> pd.DataFrame:
+    """
+    Metric of a sweep aggregated over every pair of values of two parameters.
+
+    Parameters:
+    - sweep_results: run_parameter_sweep output or ResultsStore.query() rows
+    - x, y: Parameter columns for the heatmap columns and rows
+    - metric: Metric column to aggregate
+    - aggfunc: Aggregation over the other parameters, e.g. 'mean', 'median' or 'max'
+
+    Returns:
+    - DataFrame with y values as index and x values as columns
+    """
+    frame = sweep_results[[x, y, metric]].copy()
+    for column in (x, y):
+        # Margin ladders are lists, which cannot be group keys
+        if frame[column].map(lambda value: isinstance(value, (list, tuple))).any():
+            frame[column] = frame[column].map(str)
+    return frame.pivot_table(index=y, columns=x, values=metric, aggfunc=aggfunc)
+
+
+def plot_sensitivity_heatmap(sweep_results: pd.DataFrame, x: str, y: str, metric: str = 'percentage_return',
+                             aggfunc: str = 'mean', save_path: str = None, show: bool = True):
+    """Plot sensitivity_table as an annotated heatmap (with show=False on a standalone Figure, only saved)."""
+    table = sensitivity_table(sweep_results, x, y, metric, aggfunc)
+    fig = _new_figure((max(8, table.shape[1]), max(6, table.shape[0] * 0.6)), show)
+    ax = fig.subplots()
+    sns.heatmap(table, annot=True, fmt='.1f', cmap='RdYlGn', center=0 if metric != 'win_rate' else None, ax=ax)
+    ax.set_title(f'{aggfunc.capitalize()} {metric} by {y} and {x}')
+
+    _finish_figure(fig, save_path, show)
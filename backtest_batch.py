@@ -0,0 +1,400 @@
+import math
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from backtestt import (CryptoTradingBot, MarketData, SUMMARY_METRICS, SWEEP_PARAMETERS,
+                       logger, signal_cache)
+
+DIRECTION_CODES = {"LONG": 0, "SHORT": 1}
+MAX_SEARCH_WINDOW = 1 << 16
+
+
+class BatchBacktester:
+    """
+    Simulate many parameter sets of the pump/dump strategy in one pass over the candles.
+
+    The state of every configuration (position, margin ladder, counter trade,
+    balance and metric accumulators) is held in arrays with one row per config,
+    and each config keeps its own candle cursor. Every step, flat configs jump
+    to their next entry signal and configs holding a position search a
+    (configs x candles) window of prices ahead of their cursor with the same
+    conditions as CryptoTradingBot._backtest_check_position. The window
+    doubles while nothing happens, so long holds need few steps. All events
+    found in a step are applied with vectorized updates.
+
+    CryptoTradingBot.run_backtest remains the reference implementation; use
+    validate_batch_backtest to compare both on a set of configurations.
+    """
+
+    def __init__(self, configs: List[dict], base_params: dict = None,
+                 search_window: int = 64, max_search_elements: int = 1 << 22):
+        """
+        Parameters:
+        - configs: Parameter overrides, one dict per configuration
+        - base_params: Bot constructor parameters shared by all configurations
+        - search_window: Initial number of candles searched ahead of an open position
+        - max_search_elements: Upper bound on the size of one (configs x candles) search matrix
+        """
+        reference = CryptoTradingBot(backtest_mode=True, **(base_params or {}))
+        defaults = {key: getattr(reference, key) for key in SWEEP_PARAMETERS}
+        self.configs = [{**defaults, **config} for config in configs]
+        if any(config['intrabar_fills'] for config in self.configs):
+            raise ValueError("The batch engine only supports close-only fills (intrabar_fills=False)")
+        self.search_window = search_window
+        self.max_search_elements = max_search_elements
+        self.signal_cache = signal_cache
+
+        def column(key, dtype=np.float64):
+            return np.array([config[key] for config in self.configs], dtype=dtype)
+
+        self.total_balance = column('total_balance')
+        self.entry_price_percentage = column('entry_price_percentage')
+        self.leverage = column('leverage')
+        self.take_profit_roi = column('take_profit_roi')
+        self.counter_trade_loss_roi = column('counter_trade_loss_roi')
+        self.counter_trade_margin_percentage = column('counter_trade_margin_percentage')
+        self.pump_dump_threshold = column('pump_dump_threshold')
+        self.detection_period_minutes = column('detection_period_minutes', np.int64)
+        self.direction = np.array([DIRECTION_CODES.get(config['position_direction'], -1)
+                                   for config in self.configs], dtype=np.int8)
+        self.margin_increase_levels, self.num_increase_levels = self._ladder('margin_increase_levels')
+        self.margin_loss_roi_levels, self.num_loss_levels = self._ladder('margin_loss_roi_levels')
+
+    def _ladder(self, key: str):
+        """Pad per-config ladders into a 2-D array plus the length of each row."""
+        lengths = np.array([len(config[key]) for config in self.configs], dtype=np.int64)
+        ladder = np.zeros((len(self.configs), max(lengths.max(initial=0), 1)))
+        for row, config in enumerate(self.configs):
+            ladder[row, :lengths[row]] = config[key]
+        return ladder, lengths
+
+    def run(self, historical_data) -> pd.DataFrame:
+        """
+        Backtest every configuration on the same candles.
+
+        Parameters:
+        - historical_data: DataFrame with OHLCV data, MarketData columns or a MarketData.save() directory
+
+        Returns:
+        - DataFrame with the summary metrics of _calculate_backtest_results, one row per config
+        """
+        historical_data = MarketData.coerce(historical_data)
+        close_prices = np.asarray(historical_data.close, dtype=np.float64)
+        num_candles = len(close_prices)
+        self._reset(num_candles)
+        self._prepare_entries(historical_data)
+        padded_prices = np.concatenate([close_prices, np.full(MAX_SEARCH_WINDOW, np.nan)])
+
+        while True:
+            rows = np.flatnonzero(self.cursor < num_candles)
+            if not len(rows):
+                break
+            flat_rows, flat_candles = self._next_entries(rows[~self.in_position[rows]])
+            held_rows, held_candles = self._next_position_events(rows[self.in_position[rows]], padded_prices)
+
+            rows = np.concatenate([flat_rows, held_rows])
+            candles = np.concatenate([flat_candles, held_candles])
+            if len(rows):
+                self._apply_events(rows, candles, close_prices[candles])
+                self.cursor[rows] = candles + 1
+
+        # Close any open position at the end
+        open_rows = np.flatnonzero(self.in_position)
+        if len(open_rows):
+            self._close_positions(open_rows, np.full(len(open_rows), close_prices[-1]))
+
+        return self._summary(num_candles)
+
+    def _prepare_entries(self, historical_data: MarketData):
+        """
+        Look up entry candles once per distinct signal and pack them into one sorted array.
+
+        Entries of signal k are stored as k * num_candles + candle, so the next
+        entry of every flat config is found with a single searchsorted call.
+        """
+        num_candles = len(historical_data)
+        keys = [(config['detection_period_minutes'], config['position_direction'], config['pump_dump_threshold'])
+                for config in self.configs]
+        signal_index = {key: code for code, key in enumerate(dict.fromkeys(keys))}
+        self.signal_code = np.array([signal_index[key] for key in keys], dtype=np.int64)
+        self.packed_entries = np.concatenate([
+            self.signal_cache.entry_indices(historical_data, *key) + code * num_candles
+            for key, code in signal_index.items()
+        ] + [np.empty(0, dtype=np.int64)])
+
+    def _next_entries(self, rows: np.ndarray):
+        """Next entry candle of each flat config; configs without one are finished."""
+        if not len(self.packed_entries):
+            self.cursor[rows] = self.num_candles
+            return rows[:0], rows[:0]
+
+        offset = self.signal_code[rows] * self.num_candles
+        found = np.searchsorted(self.packed_entries, offset + self.cursor[rows])
+        candidates = self.packed_entries[np.minimum(found, len(self.packed_entries) - 1)] - offset
+        has_entry = (found < len(self.packed_entries)) & (candidates < self.num_candles)
+        self.cursor[rows[~has_entry]] = self.num_candles
+        return rows[has_entry], candidates[has_entry]
+
+    def _next_position_events(self, rows: np.ndarray, padded_prices: np.ndarray):
+        """
+        Search a window ahead of each open position for the next state change.
+
+        Rows are grouped by their current window length; rows without an event
+        advance past their window and double it for the next step.
+        """
+        event_rows, event_candles = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        if not len(rows):
+            return event_rows[0], event_candles[0]
+
+        # Keep a single search matrix within max_search_elements
+        max_window = max(self.search_window,
+                         min(1 << int(np.log2(max(self.max_search_elements // len(rows), 1))), MAX_SEARCH_WINDOW))
+        for window in np.unique(self.window[rows]):
+            group = rows[self.window[rows] == window]
+            # Rows of a strided view; candles past the end are NaN and never trigger
+            prices = np.lib.stride_tricks.sliding_window_view(padded_prices, window)[self.cursor[group]]
+            events = self._event_matrix(group, prices)
+            has_event = events.any(axis=1)
+
+            missed = group[~has_event]
+            self.cursor[missed] += window
+            self.window[missed] = min(window * 2, max_window)
+
+            hit = group[has_event]
+            event_rows.append(hit)
+            event_candles.append(self.cursor[hit] + events[has_event].argmax(axis=1))
+            self.window[hit] = self.search_window
+
+        return np.concatenate(event_rows), np.concatenate(event_candles)
+
+    def _reset(self, num_candles: int):
+        size = len(self.configs)
+        self.num_candles = num_candles
+        self.balance = self.total_balance.copy()
+        self.in_position = np.zeros(size, dtype=bool)
+        self.entry_price = np.zeros(size)
+        self.current_margin = np.zeros(size)
+        self.margin_level = np.zeros(size, dtype=np.int64)
+        self.take_profit_price = np.zeros(size)
+        self.stop_loss_price = np.zeros(size)
+        self.counter_open = np.zeros(size, dtype=bool)
+        self.counter_entry_price = np.zeros(size)
+        self.counter_margin = np.zeros(size)
+        self.total_trades = np.zeros(size, dtype=np.int64)
+        self.winning_trades = np.zeros(size, dtype=np.int64)
+        # Equity curve accumulators over the samples where the balance changes
+        self.visible_balance = self.balance.copy()
+        self.peak_balance = self.balance.copy()
+        self.max_drawdown = np.zeros(size)
+        self.return_sum = np.zeros(size)
+        self.return_square_sum = np.zeros(size)
+        self.cursor = self.detection_period_minutes.copy()
+        self.window = np.full(size, self.search_window, dtype=np.int64)
+
+    def _event_matrix(self, rows: np.ndarray, prices: np.ndarray) -> np.ndarray:
+        """
+        Prices (one row of candles per config) at which the open position changes state.
+
+        Prices and barriers are multiplied by +1 for LONG and -1 for SHORT, which
+        is exact in floating point and turns both directions into the LONG tests.
+        """
+        sign = np.where(self.direction[rows] == 0, 1.0, -1.0)[:, None]
+        signed_prices = prices * sign
+        take_profit_hit = signed_prices >= self.take_profit_price[rows, None] * sign
+        stop_loss_hit = signed_prices <= self.stop_loss_price[rows, None] * sign
+
+        exhausted = self.margin_level[rows] >= self.num_increase_levels[rows]
+        if exhausted.any():
+            # Once the ladder is used up only a counter trade open/close changes state
+            subset = np.flatnonzero(exhausted)
+            exhausted_rows = rows[subset]
+            entry_price = self.entry_price[exhausted_rows, None]
+            roi = (((entry_price - prices[subset]) * sign[subset]) / entry_price) * 100 \
+                * self.leverage[exhausted_rows, None]
+            counter_change = ((roi >= self.counter_trade_loss_roi[exhausted_rows, None]) !=
+                              self.counter_open[exhausted_rows, None])
+            stop_loss_hit[subset] &= counter_change
+
+        return take_profit_hit | stop_loss_hit
+
+    def _apply_events(self, rows: np.ndarray, candles: np.ndarray, prices: np.ndarray):
+        """Apply one event per config, mirroring the CryptoTradingBot backtest methods."""
+        flat = ~self.in_position[rows]
+        self._open_positions(rows[flat], prices[flat])
+
+        held, held_prices = rows[~flat], prices[~flat]
+        is_long = self.direction[held] == 0
+        take_profit_hit = np.where(is_long, held_prices >= self.take_profit_price[held],
+                                   held_prices <= self.take_profit_price[held])
+        self._close_positions(held[take_profit_hit], held_prices[take_profit_hit])
+
+        # Remaining events are stop loss hits: add margin or manage the counter trade
+        held, held_prices = held[~take_profit_hit], held_prices[~take_profit_hit]
+        ladder_left = self.margin_level[held] < self.num_increase_levels[held]
+        self._add_margin(held[ladder_left], held_prices[ladder_left])
+        self._manage_counter_trades(held[~ladder_left], held_prices[~ladder_left])
+
+        self._record_equity(rows, candles)
+
+    def _record_equity(self, rows: np.ndarray, candles: np.ndarray):
+        """
+        Update drawdown and return accumulators where the balance changed.
+
+        Like EquityCurve, a balance change on candle i becomes visible in the
+        sample of candle i + 1, so changes on the last candle are not recorded.
+        """
+        changed = (candles + 1 < self.num_candles) & (self.balance[rows] != self.visible_balance[rows])
+        rows = rows[changed]
+        balance = self.balance[rows]
+        returns = balance / self.visible_balance[rows] - 1
+        self.return_sum[rows] += returns
+        self.return_square_sum[rows] += returns * returns
+        self.visible_balance[rows] = balance
+        self.peak_balance[rows] = np.maximum(self.peak_balance[rows], balance)
+        self.max_drawdown[rows] = np.minimum(self.max_drawdown[rows],
+                                             (balance / self.peak_balance[rows] - 1) * 100)
+
+    def _open_positions(self, rows: np.ndarray, prices: np.ndarray):
+        is_long = self.direction[rows] == 0
+        leverage = self.leverage[rows]
+        self.current_margin[rows] = self.balance[rows] * (self.entry_price_percentage[rows] / 100)
+        effective_tp_percentage = self.take_profit_roi[rows] / leverage
+        effective_sl_percentage = self.margin_loss_roi_levels[rows, 0] / leverage
+        self.take_profit_price[rows] = np.where(is_long, prices * (1 + effective_tp_percentage / 100),
+                                                prices * (1 - effective_tp_percentage / 100))
+        self.stop_loss_price[rows] = np.where(is_long, prices * (1 - effective_sl_percentage / 100),
+                                              prices * (1 + effective_sl_percentage / 100))
+        self.entry_price[rows] = prices
+        self.margin_level[rows] = 0
+        self.in_position[rows] = True
+
+    def _add_margin(self, rows: np.ndarray, prices: np.ndarray):
+        levels = self.margin_level[rows]
+        additional_margin = self.current_margin[rows] * (self.margin_increase_levels[rows, levels] / 100)
+        self.current_margin[rows] = self.current_margin[rows] + additional_margin
+        self.margin_level[rows] = levels + 1
+
+        # Update stop loss level for the next margin level
+        rows = rows[levels + 1 < self.num_loss_levels[rows]]
+        next_roi = self.margin_loss_roi_levels[rows, self.margin_level[rows]]
+        effective_sl_percentage = next_roi / self.leverage[rows]
+        entry_price = self.entry_price[rows]
+        self.stop_loss_price[rows] = np.where(self.direction[rows] == 0,
+                                              entry_price * (1 - effective_sl_percentage / 100),
+                                              entry_price * (1 + effective_sl_percentage / 100))
+
+    def _manage_counter_trades(self, rows: np.ndarray, prices: np.ndarray):
+        entry_price = self.entry_price[rows]
+        leverage = self.leverage[rows]
+        roi = np.where(self.direction[rows] == 0,
+                       ((entry_price - prices) / entry_price) * 100 * leverage,
+                       ((prices - entry_price) / entry_price) * 100 * leverage)
+        above = roi >= self.counter_trade_loss_roi[rows]
+
+        opening = rows[above & ~self.counter_open[rows]]
+        self.counter_margin[opening] = self.total_balance[opening] * (
+            self.counter_trade_margin_percentage[opening] / 100)
+        self.counter_entry_price[opening] = prices[above & ~self.counter_open[rows]]
+        self.counter_open[opening] = True
+
+        closing = ~above & self.counter_open[rows]
+        self._close_counter_trades(rows[closing], prices[closing])
+
+    def _close_counter_trades(self, rows: np.ndarray, prices: np.ndarray):
+        entry_price = self.counter_entry_price[rows]
+        leverage = self.leverage[rows]
+        # The counter trade is LONG when the main position is SHORT and vice versa
+        pnl_percentage = np.where(self.direction[rows] == 1,
+                                  ((prices - entry_price) / entry_price) * 100 * leverage,
+                                  ((entry_price - prices) / entry_price) * 100 * leverage)
+        self.balance[rows] += self.counter_margin[rows] * (pnl_percentage / 100)
+        self.counter_open[rows] = False
+
+    def _close_positions(self, rows: np.ndarray, prices: np.ndarray):
+        with_counter = self.counter_open[rows]
+        self._close_counter_trades(rows[with_counter], prices[with_counter])
+
+        entry_price = self.entry_price[rows]
+        leverage = self.leverage[rows]
+        pnl_percentage = np.where(self.direction[rows] == 0,
+                                  ((prices - entry_price) / entry_price) * 100 * leverage,
+                                  ((entry_price - prices) / entry_price) * 100 * leverage)
+        pnl_amount = self.current_margin[rows] * (pnl_percentage / 100)
+        self.balance[rows] += pnl_amount
+        self.total_trades[rows] += 1
+        self.winning_trades[rows] += pnl_amount > 0
+        self.in_position[rows] = False
+
+    def _summary(self, num_candles: int) -> pd.DataFrame:
+        """Summary metrics in the same form as CryptoTradingBot._calculate_backtest_results."""
+        rows = []
+        for row, config in enumerate(self.configs):
+            initial_balance = config['total_balance']
+            final_balance = float(self.balance[row])
+            total_trades = int(self.total_trades[row])
+            winning_trades = int(self.winning_trades[row])
+
+            # One sample for the first candle plus one per processed candle
+            num_returns = max(num_candles - int(self.detection_period_minutes[row]), 0)
+            if num_returns < 1:
+                sharpe_ratio = 0
+            elif num_returns < 2:
+                sharpe_ratio = np.nan
+            else:
+                mean = self.return_sum[row] / num_returns
+                variance = max(self.return_square_sum[row] - num_returns * mean ** 2, 0.0) / (num_returns - 1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    sharpe_ratio = np.float64(mean) / np.sqrt(variance) * np.sqrt(252)
+
+            rows.append({
+                'initial_balance': initial_balance,
+                'final_balance': final_balance,
+                'absolute_return': final_balance - initial_balance,
+                'percentage_return': ((final_balance - initial_balance) / initial_balance) * 100,
+                'total_trades': total_trades,
+                'winning_trades': winning_trades,
+                'losing_trades': total_trades - winning_trades,
+                'win_rate': (winning_trades / total_trades * 100) if total_trades > 0 else 0,
+                'max_drawdown': float(self.max_drawdown[row]),
+                'sharpe_ratio': sharpe_ratio,
+                **config,
+            })
+        return pd.DataFrame(rows)
+
+
+def run_batch_backtest(historical_data, configs: List[dict], base_params: dict = None,
+                       **engine_options) -> pd.DataFrame:
+    """Backtest all configs in one batched pass; see BatchBacktester."""
+    return BatchBacktester(configs, base_params, **engine_options).run(historical_data)
+
+
+def validate_batch_backtest(historical_data, configs: List[dict], base_params: dict = None,
+                            rel_tol: float = 1e-9) -> pd.DataFrame:
+    """
+    Compare the batched engine against CryptoTradingBot.run_backtest.
+
+    Returns:
+    - DataFrame with one row per config, the metrics that differ and a 'match' flag
+    """
+    batched = run_batch_backtest(historical_data, configs, base_params)
+    bot = CryptoTradingBot(backtest_mode=True, **(base_params or {}))
+    defaults = {key: getattr(bot, key) for key in SWEEP_PARAMETERS}
+
+    rows = []
+    for row, config in enumerate(configs):
+        reference = bot.run_backtest(historical_data, {**defaults, **config})
+        mismatches = []
+        for key in SUMMARY_METRICS:
+            expected, actual = float(reference[key]), float(batched.at[row, key])
+            if not (math.isclose(expected, actual, rel_tol=rel_tol, abs_tol=1e-12) or
+                    (math.isnan(expected) and math.isnan(actual))):
+                mismatches.append(key)
+        rows.append({**config, 'mismatches': mismatches, 'match': not mismatches})
+
+    report = pd.DataFrame(rows)
+    if not report['match'].all():
+        logger.warning(f"Batched backtest differs from run_backtest for "
+                       f"{(~report['match']).sum()} of {len(report)} configurations")
+    return report
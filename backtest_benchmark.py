@@ -0,0 +1,286 @@
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from datetime import datetime, timezone
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from backtest_analytics import clear_trade_analytics
+from backtestt import CryptoTradingBot, MarketData, logger, signal_cache
+
+DEFAULT_SIZES = (10_000, 1_000_000, 10_000_000)
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+# The default 200% take profit rarely closes on synthetic data; this keeps trades, margin adds and counter trades flowing
+DEFAULT_CONFIG = {'take_profit_roi': 20}
+# Timings compared against the baseline; higher is worse for all of them
+TIMED_METRICS = ('run_seconds', 'results_seconds', 'report_seconds')
+# Slowdowns smaller than this are timer noise, whatever their relative size
+MIN_REGRESSION_SECONDS = 0.002
+
+
+def generate_market(num_candles: int, seed: int = 0, start: str = '2024-01-01',
+                    start_price: float = 100.0, volatility: float = 0.001,
+                    pumps_per_day: float = 2.0, pump_size: float = 10.0, pump_minutes: int = 30,
+                    reversion: float = 0.6, symbol: str = 'SYNTH/USDT') -> MarketData:
+    """
+    Reproducible synthetic 1m candles: a geometric random walk with injected pumps and dumps.
+
+    Pump and dump starts follow a Poisson process. Each one moves the price by
+    pump_size percent (scaled by a random factor between 0.5 and 1.5) evenly
+    over pump_minutes, then gives back the reversion share of that move over
+    the following 4 * pump_minutes. All moves are added to the log returns
+    with a difference array, so the whole series is built in a few vectorized passes.
+
+    Parameters:
+    - num_candles: Number of 1m candles
+    - seed: Random seed; the same arguments always give the same series
+    - start: Timestamp of the first candle
+    - start_price: Close of the first candle before any move
+    - volatility: Standard deviation of the 1m log returns
+    - pumps_per_day: Expected number of pumps and dumps per 1440 candles
+    - pump_size: Mean size of a move in percent
+    - pump_minutes: Duration of a move
+    - reversion: Share of a move given back after it
+    - symbol: Symbol name of the series
+
+    Returns:
+    - MarketData with open, high, low, close and volume columns
+    """
+    rng = np.random.default_rng(seed)
+    log_returns = rng.normal(0.0, volatility, num_candles)
+
+    num_events = rng.poisson(num_candles * pumps_per_day / 1440)
+    revert_minutes = 4 * pump_minutes
+    starts = rng.integers(0, max(num_candles - pump_minutes - revert_minutes, 1), num_events)
+    signs = rng.choice([-1.0, 1.0], num_events)
+    moves = signs * np.log1p(pump_size / 100 * rng.uniform(0.5, 1.5, num_events))
+
+    # Constant drift per minute during each move and its reversion, spread with a difference array
+    drift = np.zeros(num_candles + 1)
+    for offset, length, total in ((0, pump_minutes, moves),
+                                  (pump_minutes, revert_minutes, -reversion * moves)):
+        begin = np.minimum(starts + offset, num_candles)
+        end = np.minimum(begin + length, num_candles)
+        np.add.at(drift, begin, total / length)
+        np.add.at(drift, end, -total / length)
+    log_returns += np.cumsum(drift[:-1])
+
+    close = start_price * np.exp(np.cumsum(log_returns))
+    open_ = np.empty_like(close)
+    open_[0] = start_price
+    open_[1:] = close[:-1]
+    wick = np.abs(rng.normal(0.0, volatility, (2, num_candles)))
+    high = np.maximum(open_, close) * (1 + wick[0])
+    low = np.minimum(open_, close) * (1 - wick[1])
+    volume = rng.lognormal(3.0, 1.0, num_candles)
+
+    start_ns = pd.Timestamp(start).value
+    times = start_ns + np.arange(num_candles, dtype=np.int64) * 60_000_000_000
+    return MarketData(times, close, open=open_, high=high, low=low, volume=volume, symbol_names=(symbol,))
+
+
+def _best_time(function, repeat: int) -> float:
+    """Fastest wall time of repeat calls of function."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _best_loop_time(function, repeat: int) -> float:
+    """Fastest mean time per call over repeat loops of at least 0.2 seconds, for sub-millisecond functions."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def benchmark_backtest(data: MarketData, config: dict = None, base_params: dict = None,
+                       repeat: int = 3, event_driven: bool = True) -> dict:
+    """
+    Time one backtest configuration on data.
+
+    The signal cache is cleared before every run, so each timing includes
+    signal detection. Peak memory is measured with tracemalloc in a separate
+    run, because tracing slows allocation down, and counts what the backtest
+    allocates on top of the candle arrays.
+
+    Parameters:
+    - data: Candles to backtest, e.g. from generate_market
+    - config: Optional config to override the bot's parameters
+    - base_params: Bot constructor parameters
+    - repeat: Number of timed runs; the fastest one is reported
+    - event_driven: Passed to run_backtest
+
+    Returns:
+    - dict with timings in seconds, candles per second and peak memory in bytes
+    """
+    bot = CryptoTradingBot(backtest_mode=True, **(base_params or {}))
+
+    def run():
+        signal_cache.clear()
+        return bot.run_backtest(data, config, event_driven=event_driven)
+
+    run_seconds = _best_time(run, repeat)
+
+    tracemalloc.start()
+    try:
+        results = run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    # The bot still holds the state of the last run, so the metrics can be recomputed as often as needed
+    results_seconds = _best_loop_time(bot._calculate_backtest_results, repeat)
+    def report():
+        # Without the cached trade analytics, as for the first report of a run
+        clear_trade_analytics(results)
+        return bot.generate_backtest_report(results)
+
+    report_seconds = _best_loop_time(report, repeat)
+
+    return {
+        'num_candles': len(data),
+        'run_seconds': run_seconds,
+        'candles_per_second': len(data) / run_seconds,
+        'results_seconds': results_seconds,
+        'report_seconds': report_seconds,
+        'peak_memory_bytes': peak_memory,
+        'total_trades': results['total_trades'],
+        'final_balance': results['final_balance'],
+    }
+
+
+def run_benchmarks(sizes: Sequence[int] = DEFAULT_SIZES, config: dict = None, base_params: dict = None,
+                   seed: int = 0, repeat: int = 3, event_driven: bool = True) -> dict:
+    """
+    Benchmark the backtester on synthetic markets of each size.
+
+    Parameters:
+    - sizes: Numbers of candles to benchmark
+    - config: Config to override the bot's parameters (defaults to DEFAULT_CONFIG)
+    - base_params, repeat, event_driven: See benchmark_backtest
+    - seed: Seed of generate_market
+
+    Returns:
+    - dict with the environment, the settings and one benchmark_backtest entry per size
+    """
+    config = DEFAULT_CONFIG if config is None else config
+    benchmarks = []
+    for num_candles in sizes:
+        data = generate_market(num_candles, seed)
+        entry = benchmark_backtest(data, config, base_params, repeat, event_driven)
+        logger.info(f"Benchmark {num_candles} candles: {entry['run_seconds']:.3f}s, "
+                    f"{entry['candles_per_second']:,.0f} candles/s, "
+                    f"peak {entry['peak_memory_bytes'] / 2 ** 20:.1f} MiB")
+        benchmarks.append(entry)
+        del data
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'environment': {
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'settings': {'config': config, 'base_params': base_params or {}, 'seed': seed,
+                     'repeat': repeat, 'event_driven': event_driven},
+        'benchmarks': benchmarks,
+    }
+
+
+def compare_benchmarks(current: dict, baseline: dict, tolerance: float = 0.10,
+                       min_seconds: float = MIN_REGRESSION_SECONDS) -> pd.DataFrame:
+    """
+    Compare the timings and peak memory of two run_benchmarks outputs, size by size.
+
+    Parameters:
+    - current: Latest run_benchmarks output
+    - baseline: Earlier run_benchmarks output
+    - tolerance: Relative slowdown (or memory growth) above which a metric counts as a regression
+    - min_seconds: Timings must also slow down by more than this many seconds, so
+      sub-millisecond metrics do not fail on timer noise
+
+    Returns:
+    - DataFrame with one row per size and metric, with the relative change and a regression flag
+    """
+    previous = {entry['num_candles']: entry for entry in baseline.get('benchmarks', [])}
+    rows = []
+    for entry in current['benchmarks']:
+        before = previous.get(entry['num_candles'])
+        if before is None:
+            continue
+        for metric in TIMED_METRICS + ('peak_memory_bytes',):
+            change = entry[metric] / before[metric] - 1 if before[metric] else 0.0
+            regression = change > tolerance
+            if metric in TIMED_METRICS:
+                regression &= entry[metric] - before[metric] > min_seconds
+            rows.append({'num_candles': entry['num_candles'], 'metric': metric,
+                         'baseline': before[metric], 'current': entry[metric],
+                         'change': change, 'regression': regression})
+        # Same data and parameters must give the same backtest, or the comparison is meaningless
+        if (entry['total_trades'], entry['final_balance']) != (before['total_trades'], before['final_balance']):
+            logger.warning(f"Benchmark {entry['num_candles']} candles: results differ from the baseline")
+    return pd.DataFrame(rows, columns=['num_candles', 'metric', 'baseline', 'current', 'change', 'regression'])
+
+
+def load_baseline(path: str = DEFAULT_BASELINE) -> dict:
+    """Read a saved benchmark run, or None if there is none yet."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(benchmarks: dict, path: str = DEFAULT_BASELINE):
+    """Write a run_benchmarks output for the next run to compare against."""
+    with open(path, 'w') as f:
+        json.dump(benchmarks, f, indent=2)
+    logger.info(f"Benchmark baseline saved to {path}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the backtester on synthetic pump/dump markets")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    parser.add_argument('--min-seconds', type=float, default=MIN_REGRESSION_SECONDS,
+                        help="Ignore timing regressions smaller than this")
+    parser.add_argument('--candle-by-candle', action='store_true', help="Run with event_driven=False")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="Replace the baseline with this run (it is only written automatically when missing)")
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.sizes, seed=args.seed, repeat=args.repeat,
+                             event_driven=not args.candle_by_candle)
+    table = pd.DataFrame(current['benchmarks']).set_index('num_candles')
+    print(table[['run_seconds', 'candles_per_second', 'results_seconds', 'report_seconds',
+                 'peak_memory_bytes']].to_string())
+
+    regressions: List[str] = []
+    baseline = load_baseline(args.baseline)
+    if baseline is not None:
+        comparison = compare_benchmarks(current, baseline, args.tolerance, args.min_seconds)
+        print(f"\nCompared with the baseline of {baseline['created']}:")
+        print(comparison.to_string(index=False, formatters={'change': '{:+.1%}'.format}))
+        regressions = [f"{row.metric} at {row.num_candles} candles"
+                       for row in comparison.itertuples() if row.regression]
+    # Replacing the baseline after every run would let a regression pass on the next one
+    if baseline is None or args.update_baseline:
+        save_baseline(current, args.baseline)
+    if regressions:
+        print(f"\nRegressions above {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,429 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from backtestt import (CryptoTradingBot, MarketData, SWEEP_PARAMETERS, SUMMARY_METRICS,
+                       TradeLog, MarginLog, CounterTradeLog, EquityCurve, DIRECTIONS, logger)
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:  # Numba is optional; the kernel then runs as plain Python
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+# Event kinds written by the kernel
+OPEN, CLOSE, COUNTER_OPEN, COUNTER_CLOSE, MARGIN_ADD = range(5)
+# Close reasons
+TAKE_PROFIT, END_OF_BACKTEST = range(2)
+# Event columns (all float64)
+KIND, INDEX, PRICE, QUANTITY, AMOUNT, PNL_PERCENTAGE, OPEN_PRICE, LEVEL, TOTAL_MARGIN, REASON, DIRECTION = range(11)
+NUM_EVENT_COLUMNS = 11
+
+
+@njit(cache=True)
+def _emit(events, count, kind, index, price, quantity, amount, pnl_percentage, open_price,
+          level, total_margin, reason, direction):
+    """Write one event row if there is room; events past capacity are only counted."""
+    if count < events.shape[0]:
+        row = events[count]
+        row[KIND] = kind
+        row[INDEX] = index
+        row[PRICE] = price
+        row[QUANTITY] = quantity
+        row[AMOUNT] = amount
+        row[PNL_PERCENTAGE] = pnl_percentage
+        row[OPEN_PRICE] = open_price
+        row[LEVEL] = level
+        row[TOTAL_MARGIN] = total_margin
+        row[REASON] = reason
+        row[DIRECTION] = direction
+    return count + 1
+
+
+@njit(cache=True)
+def simulate(close, entry_indices, start, total_balance, entry_price_percentage, leverage,
+             margin_loss_roi_levels, margin_increase_levels, take_profit_roi,
+             counter_trade_loss_roi, counter_trade_margin_percentage, direction, events):
+    """
+    Run the position state machine of CryptoTradingBot over a close price array.
+
+    Mirrors _backtest_open_position, _backtest_check_position,
+    _backtest_add_margin, _backtest_manage_counter_trade and the counter trade
+    and close methods operation for operation, so balances match bit for bit.
+
+    Parameters:
+    - close: float64 close prices
+    - entry_indices: Sorted candle indices with an entry signal
+    - start: First candle to process (detection_period_minutes)
+    - direction: 0 for LONG, 1 for SHORT
+    - events: float64 array of shape (capacity, NUM_EVENT_COLUMNS) receiving the events
+
+    Returns:
+    - tuple of (number of events, final balance); rerun with more capacity
+      when the number of events exceeds it
+    """
+    num_candles = len(close)
+    num_increase_levels = len(margin_increase_levels)
+    num_loss_levels = len(margin_loss_roi_levels)
+    is_long = direction == 0
+    balance = total_balance
+    count = 0
+    reason = TAKE_PROFIT
+
+    in_position = False
+    entry_price = 0.0
+    quantity = 0.0
+    current_margin = 0.0
+    margin_level = 0
+    total_margin_used = 0.0
+    take_profit_price = 0.0
+    stop_loss_price = 0.0
+
+    in_counter = False
+    counter_entry_price = 0.0
+    counter_margin = 0.0
+
+    next_entry = 0
+    i = start
+    while i < num_candles:
+        price = close[i]
+        if not in_position:
+            # Jump to the next candle with an entry signal
+            while next_entry < len(entry_indices) and entry_indices[next_entry] < i:
+                next_entry += 1
+            if next_entry == len(entry_indices):
+                break
+            i = entry_indices[next_entry]
+            price = close[i]
+
+            initial_margin = balance * (entry_price_percentage / 100)
+            quantity = (initial_margin * leverage) / price
+            entry_price = price
+            current_margin = initial_margin
+            margin_level = 0
+            total_margin_used = entry_price_percentage
+            effective_tp_percentage = take_profit_roi / leverage
+            effective_sl_percentage = margin_loss_roi_levels[0] / leverage
+            if is_long:
+                take_profit_price = price * (1 + effective_tp_percentage / 100)
+                stop_loss_price = price * (1 - effective_sl_percentage / 100)
+            else:
+                take_profit_price = price * (1 - effective_tp_percentage / 100)
+                stop_loss_price = price * (1 + effective_sl_percentage / 100)
+            in_position = True
+            count = _emit(events, count, OPEN, i, price, quantity, initial_margin, 0.0, 0.0,
+                          0, 0.0, 0, direction)
+            i += 1
+            continue
+
+        if (is_long and price >= take_profit_price) or (not is_long and price <= take_profit_price):
+            reason = TAKE_PROFIT
+        elif (is_long and price <= stop_loss_price) or (not is_long and price >= stop_loss_price):
+            if margin_level < num_increase_levels:
+                additional_margin = current_margin * (margin_increase_levels[margin_level] / 100)
+                new_total_margin = current_margin + additional_margin
+                quantity += (additional_margin * leverage) / price
+                current_margin = new_total_margin
+                margin_level += 1
+                total_margin_used += (additional_margin / total_balance) * 100
+                if margin_level < num_loss_levels:
+                    effective_sl_percentage = margin_loss_roi_levels[margin_level] / leverage
+                    if is_long:
+                        stop_loss_price = entry_price * (1 - effective_sl_percentage / 100)
+                    else:
+                        stop_loss_price = entry_price * (1 + effective_sl_percentage / 100)
+                count = _emit(events, count, MARGIN_ADD, i, price, 0.0, additional_margin, 0.0, 0.0,
+                              margin_level, new_total_margin, 0, direction)
+            else:
+                if is_long:
+                    roi = ((entry_price - price) / entry_price) * 100 * leverage
+                else:
+                    roi = ((price - entry_price) / entry_price) * 100 * leverage
+                if roi >= counter_trade_loss_roi:
+                    if not in_counter:
+                        counter_margin = total_balance * (counter_trade_margin_percentage / 100)
+                        counter_quantity = (counter_margin * leverage) / price
+                        counter_entry_price = price
+                        in_counter = True
+                        count = _emit(events, count, COUNTER_OPEN, i, price, counter_quantity, counter_margin,
+                                      0.0, 0.0, 0, 0.0, 0, 1 - direction)
+                elif in_counter:
+                    # Counter trades run opposite to the position
+                    if is_long:
+                        pnl_percentage = ((counter_entry_price - price) / counter_entry_price) * 100 * leverage
+                    else:
+                        pnl_percentage = ((price - counter_entry_price) / counter_entry_price) * 100 * leverage
+                    pnl_amount = counter_margin * (pnl_percentage / 100)
+                    balance += pnl_amount
+                    in_counter = False
+                    count = _emit(events, count, COUNTER_CLOSE, i, price, 0.0, pnl_amount, pnl_percentage,
+                                  counter_entry_price, 0, 0.0, 0, 1 - direction)
+            i += 1
+            continue
+        else:
+            i += 1
+            continue
+
+        # Close at take profit (or at the end of the data below)
+        if in_counter:
+            if is_long:
+                pnl_percentage = ((counter_entry_price - price) / counter_entry_price) * 100 * leverage
+            else:
+                pnl_percentage = ((price - counter_entry_price) / counter_entry_price) * 100 * leverage
+            pnl_amount = counter_margin * (pnl_percentage / 100)
+            balance += pnl_amount
+            in_counter = False
+            count = _emit(events, count, COUNTER_CLOSE, i, price, 0.0, pnl_amount, pnl_percentage,
+                          counter_entry_price, 0, 0.0, 0, 1 - direction)
+        if is_long:
+            pnl_percentage = ((price - entry_price) / entry_price) * 100 * leverage
+        else:
+            pnl_percentage = ((entry_price - price) / entry_price) * 100 * leverage
+        pnl_amount = current_margin * (pnl_percentage / 100)
+        balance += pnl_amount
+        in_position = False
+        count = _emit(events, count, CLOSE, i, price, 0.0, pnl_amount, pnl_percentage, entry_price,
+                      margin_level, total_margin_used, reason, direction)
+        i += 1
+
+    if in_position and num_candles > start:
+        # Close at the last candle, as finish_backtest does
+        i = num_candles - 1
+        price = close[i]
+        if in_counter:
+            if is_long:
+                pnl_percentage = ((counter_entry_price - price) / counter_entry_price) * 100 * leverage
+            else:
+                pnl_percentage = ((price - counter_entry_price) / counter_entry_price) * 100 * leverage
+            pnl_amount = counter_margin * (pnl_percentage / 100)
+            balance += pnl_amount
+            count = _emit(events, count, COUNTER_CLOSE, i, price, 0.0, pnl_amount, pnl_percentage,
+                          counter_entry_price, 0, 0.0, 0, 1 - direction)
+        if is_long:
+            pnl_percentage = ((price - entry_price) / entry_price) * 100 * leverage
+        else:
+            pnl_percentage = ((entry_price - price) / entry_price) * 100 * leverage
+        pnl_amount = current_margin * (pnl_percentage / 100)
+        balance += pnl_amount
+        count = _emit(events, count, CLOSE, i, price, 0.0, pnl_amount, pnl_percentage, entry_price,
+                      margin_level, total_margin_used, END_OF_BACKTEST, direction)
+
+    return count, balance
+
+
+def run_kernel(bot: CryptoTradingBot, data: MarketData, capacity: int = 1024):
+    """
+    Run simulate with the bot's parameters, growing the event array until every event fits.
+
+    Returns:
+    - tuple of (event array, final balance)
+    """
+    bot._set_backtest_data(data)
+    arguments = (np.ascontiguousarray(data.close, dtype=np.float64), bot._entry_indices.astype(np.int64),
+                 bot.detection_period_minutes, float(bot.total_balance), float(bot.entry_price_percentage),
+                 float(bot.leverage), np.asarray(bot.margin_loss_roi_levels, dtype=np.float64),
+                 np.asarray(bot.margin_increase_levels, dtype=np.float64), float(bot.take_profit_roi),
+                 float(bot.counter_trade_loss_roi), float(bot.counter_trade_margin_percentage),
+                 DIRECTIONS.index(bot.position_direction))
+    while True:
+        events = np.empty((capacity, NUM_EVENT_COLUMNS))
+        count, balance = simulate(*arguments, events)
+        if count <= capacity:
+            return events[:count], balance
+        capacity = count
+
+
+def _apply_events(bot: CryptoTradingBot, data: MarketData, events: np.ndarray, balance: float):
+    """Rebuild the bot's logs, equity curve and balance from kernel events."""
+    times = data.times
+    num_candles = len(data)
+    bot.trade_history = trade_history = TradeLog()
+    bot.margin_additions = margin_additions = MarginLog()
+    bot.counter_trades = counter_trades = CounterTradeLog()
+    bot.equity_curve = equity_curve = EquityCurve()
+    reasons = ('take_profit', 'end_of_backtest')
+    coin = None
+
+    running_balance = bot.total_balance
+    equity_curve.record(times[0], times[0], running_balance)
+    indices = events[:, INDEX].astype(np.int64)
+    for position, row in enumerate(events):
+        kind, index = int(row[KIND]), int(indices[position])
+        time = times[index]
+        direction = DIRECTIONS[int(row[DIRECTION])]
+        if kind == OPEN:
+            coin = data.symbol_at(index)
+            trade_history.record_open(time, coin, direction, row[PRICE], row[QUANTITY], row[AMOUNT])
+        elif kind == MARGIN_ADD:
+            margin_additions.append((time, int(row[LEVEL]), row[AMOUNT], row[TOTAL_MARGIN], row[PRICE]))
+        elif kind == COUNTER_OPEN:
+            counter_trades.append((time, int(row[DIRECTION]), row[PRICE], row[QUANTITY], row[AMOUNT]))
+        else:
+            if kind == COUNTER_CLOSE:
+                trade_history.record_counter_close(time, direction, row[OPEN_PRICE], row[PRICE],
+                                                   row[PNL_PERCENTAGE], row[AMOUNT])
+            else:
+                trade_history.record_close(time, reasons[int(row[REASON])], row[OPEN_PRICE], row[PRICE],
+                                           row[PNL_PERCENTAGE], row[AMOUNT], int(row[LEVEL]),
+                                           row[TOTAL_MARGIN], coin)
+            running_balance += row[AMOUNT]
+            # The new balance shows from the sample after the candle, once all its events are applied
+            last_of_candle = position + 1 == len(events) or indices[position + 1] != index
+            if last_of_candle and index + 1 < num_candles:
+                equity_curve.record(times[index + 1], times[index + 1], running_balance, 0)
+
+    if num_candles > bot.detection_period_minutes:
+        equity_curve.num_samples = 1 + num_candles - bot.detection_period_minutes
+        equity_curve.end_time = times[-1]
+    bot.current_balance = balance
+
+
+def run_kernel_backtest(historical_data, config: dict = None, base_params: dict = None,
+                        bot: CryptoTradingBot = None, use_numba: bool = None) -> dict:
+    """
+    Backtest one configuration with the compiled state machine kernel.
+
+    Parameters:
+    - historical_data: DataFrame with OHLCV data, MarketData columns or a MarketData.save() directory
+    - config: Optional config to override the bot's parameters
+    - base_params: Bot constructor parameters when no bot is given
+    - bot: Bot to run on (its logs and balance are replaced)
+    - use_numba: Run the kernel, compiled when Numba is installed (None runs it
+      only then); otherwise the pure-Python CryptoTradingBot.run_backtest path is used
+
+    Returns:
+    - dict with backtest results, as run_backtest returns
+    """
+    bot = bot or CryptoTradingBot(backtest_mode=True, **(base_params or {}))
+    if use_numba is None:
+        use_numba = NUMBA_AVAILABLE
+    if not use_numba or (config or {}).get('intrabar_fills', bot.intrabar_fills):
+        return bot.run_backtest(historical_data, config)
+
+    bot._reset_backtest(config)
+    data = MarketData.coerce(historical_data)
+    events, balance = run_kernel(bot, data)
+    _apply_events(bot, data, events, balance)
+    return bot._calculate_backtest_results()
+
+
+def validate_kernel_backtest(historical_data, configs: List[dict], base_params: dict = None,
+                             rel_tol: float = 1e-9) -> pd.DataFrame:
+    """
+    Compare the kernel with CryptoTradingBot.run_backtest on every configuration.
+
+    Without Numba the kernel runs as plain Python, so its logic is still checked.
+
+    Returns:
+    - DataFrame with one row per configuration, the reference trade, margin
+      addition and counter trade counts, the metrics that differ and a match flag
+    """
+    data = MarketData.coerce(historical_data)
+    bot = CryptoTradingBot(backtest_mode=True, **(base_params or {}))
+    defaults = {key: getattr(bot, key) for key in SWEEP_PARAMETERS}
+    rows = []
+    for config in configs:
+        kernel = run_kernel_backtest(data, {**defaults, **config}, bot=bot, use_numba=True)
+        kernel_logs = [kernel[key].to_records() for key in ('trade_history', 'margin_additions', 'counter_trades')]
+        kernel_summary = {key: kernel[key] for key in SUMMARY_METRICS}
+        reference = bot.run_backtest(data, {**defaults, **config})
+
+        mismatches = [key for key in SUMMARY_METRICS
+                      if not np.isclose(kernel_summary[key], reference[key], rtol=rel_tol, atol=0, equal_nan=True)]
+        for key, records in zip(('trade_history', 'margin_additions', 'counter_trades'), kernel_logs):
+            if records != reference[key].to_records():
+                mismatches.append(key)
+        rows.append({**config, 'total_trades': reference['total_trades'],
+                     'num_margin_additions': len(reference['margin_additions']),
+                     'num_counter_trades': len(reference['counter_trades']),
+                     'mismatches': mismatches, 'match': not mismatches})
+
+    report = pd.DataFrame(rows)
+    logger.info(f"Kernel validation: {int(report['match'].sum())}/{len(report)} configurations match")
+    return report
+
+
+# Configurations of the equivalence check
+CHECK_CONFIGS = [
+    {'position_direction': 'SHORT', 'take_profit_roi': 20},
+    # A LONG loss is bounded by a 100% drop, which the default 500% counter trade ROI at 5x leverage never reaches
+    {'position_direction': 'LONG', 'take_profit_roi': 20, 'leverage': 10, 'margin_loss_roi_levels': [100, 100],
+     'margin_increase_levels': [2, 2], 'counter_trade_loss_roi': 150},
+]
+# Fixed check data, generate_market(CHECK_CANDLES, seed) for every seed: each CHECK_CONFIGS
+# entry adds margin and opens counter trades on it, so every kernel branch is exercised
+CHECK_CANDLES = 200_000
+CHECK_SEEDS = (0, 1)
+
+
+def check_kernel_equivalence(num_candles: int = CHECK_CANDLES, seeds: List[int] = CHECK_SEEDS) -> pd.DataFrame:
+    """
+    Check that the kernel reproduces run_backtest on synthetic markets.
+
+    Every CHECK_CONFIGS entry must match run_backtest in its trade, margin and
+    counter trade logs and summary metrics. A configuration that never adds
+    margin or opens a counter trade still has to match, but leaves part of
+    the kernel unchecked; that is a property of the data, so it is only
+    marked in the 'covered' column and logged.
+
+    Parameters:
+    - num_candles: Candles of every synthetic market
+    - seeds: generate_market seeds, one market each
+
+    Returns:
+    - validate_kernel_backtest rows of every market, with 'seed' and 'covered' columns
+
+    Raises:
+    - AssertionError naming the configurations and results that differ
+    """
+    from backtest_benchmark import generate_market
+
+    reports = []
+    for seed in seeds:
+        report = validate_kernel_backtest(generate_market(num_candles, seed), CHECK_CONFIGS)
+        report.insert(0, 'seed', seed)
+        reports.append(report)
+    report = pd.concat(reports, ignore_index=True)
+    report['covered'] = (report['num_margin_additions'] > 0) & (report['num_counter_trades'] > 0)
+
+    if not report['covered'].all():
+        uncovered = report.loc[~report['covered'], ['seed', 'position_direction']]
+        logger.warning(f"Kernel check without margin additions or counter trades for: "
+                       f"{uncovered.to_dict('records')}")
+    mismatches = report.loc[~report['match'], ['seed', 'position_direction', 'mismatches']]
+    if not mismatches.empty:
+        raise AssertionError(f"Kernel does not match run_backtest: {mismatches.to_dict('records')}")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import subprocess
+    import sys
+
+    parser = argparse.ArgumentParser(description="Check the backtest kernel against CryptoTradingBot.run_backtest")
+    parser.add_argument('--candles', type=int, default=CHECK_CANDLES)
+    parser.add_argument('--seeds', type=int, nargs='+', default=list(CHECK_SEEDS))
+    args = parser.parse_args()
+
+    compiled = NUMBA_AVAILABLE and os.environ.get('NUMBA_DISABLE_JIT', '0') == '0'
+    print(f"Kernel path: {'compiled with Numba' if compiled else 'pure Python'}")
+    try:
+        report = check_kernel_equivalence(args.candles, args.seeds)
+    except AssertionError as error:
+        print(error)
+        sys.exit(1)
+    print(report.drop(columns=['margin_loss_roi_levels', 'margin_increase_levels'], errors='ignore').to_string())
+    if compiled:
+        # Check the same kernel source as plain Python too
+        pure = subprocess.run([sys.executable, __file__, *sys.argv[1:]], env={**os.environ, 'NUMBA_DISABLE_JIT': '1'})
+        if pure.returncode:
+            sys.exit(pure.returncode)
+    print("Kernel matches run_backtest")
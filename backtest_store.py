@@ -0,0 +1,217 @@
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from backtestt import MarketData, SUMMARY_METRICS, SWEEP_PARAMETERS, logger
+
+# Parameters stored as JSON text, decoded again when rows are read back
+LIST_PARAMETERS = ('margin_loss_roi_levels', 'margin_increase_levels')
+INDEXED_METRICS = ('percentage_return', 'max_drawdown', 'sharpe_ratio')
+# SQLite limits the number of host parameters in one statement
+QUERY_CHUNK = 500
+
+
+def _plain(value):
+    """Convert NumPy scalars and arrays to Python values JSON and SQLite understand."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, tuple)):
+        return [_plain(item) for item in value]
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    return value
+
+
+def _canonical(value):
+    """Plain value with every number as float, so 20 and 20.0 hash the same."""
+    value = _plain(value)
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+class ResultsStore:
+    """
+    SQLite store of sweep results that survives the process.
+
+    Every run is keyed by a hash of the data fingerprint and the full set of
+    sweepable parameters, so a re-launched sweep over the same data skips the
+    configurations it already has. Each parameter and summary metric is a
+    column of its own, and the fingerprint and the main ranking metrics are
+    indexed, so queries such as the top 20 runs by return with a drawdown
+    above -30% are answered by SQLite directly.
+    """
+    TABLE = 'runs'
+
+    def __init__(self, path: str):
+        """
+        Parameters:
+        - path: SQLite database file, created if missing (':memory:' for a temporary store)
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # WAL lets other processes query the store while a sweep is writing to it
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._intrabar_fingerprints = {}
+        self._create_schema()
+
+    def _create_schema(self):
+        columns = ['key TEXT PRIMARY KEY', 'fingerprint TEXT NOT NULL', 'created REAL']
+        # No declared types, so integer counts and float metrics read back as they were written
+        columns += SWEEP_PARAMETERS + SUMMARY_METRICS
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} ({', '.join(columns)})")
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {self.TABLE}_fingerprint "
+                                    f"ON {self.TABLE} (fingerprint)")
+            for metric in INDEXED_METRICS:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {self.TABLE}_{metric} "
+                                        f"ON {self.TABLE} ({metric})")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+    def dataset_fingerprint(self, data: MarketData, intrabar_fills: bool = False) -> str:
+        """
+        Fingerprint of the candles a run depends on.
+
+        Close-only runs depend on the timestamps and closes that
+        MarketData.fingerprint covers; intrabar runs also on the lows and highs.
+        """
+        if not intrabar_fills:
+            return data.fingerprint
+        fingerprint = self._intrabar_fingerprints.get(data.fingerprint)
+        if fingerprint is None:
+            digest = hashlib.blake2b(data.fingerprint.encode(), digest_size=16)
+            for values in (data.low, data.high):
+                digest.update(memoryview(np.ascontiguousarray(values)).cast('B'))
+            fingerprint = self._intrabar_fingerprints[data.fingerprint] = digest.hexdigest()
+        return fingerprint
+
+    @staticmethod
+    def run_key(fingerprint: str, params: dict) -> str:
+        """Stable hash of a data fingerprint and a full parameter set."""
+        canonical = {key: _canonical(params[key]) for key in SWEEP_PARAMETERS}
+        payload = json.dumps([fingerprint, canonical], sort_keys=True)
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    def describe_run(self, data: MarketData, params: dict) -> Tuple[str, str, dict]:
+        """
+        Identify a run of params on data.
+
+        Parameters:
+        - data: Candles the run uses
+        - params: Full parameter set, with every name of SWEEP_PARAMETERS
+
+        Returns:
+        - tuple of (run key, dataset fingerprint, params), the arguments of add() before the summary
+        """
+        fingerprint = self.dataset_fingerprint(data, params['intrabar_fills'])
+        return self.run_key(fingerprint, params), fingerprint, params
+
+    def add(self, key: str, fingerprint: str, params: dict, summary: dict):
+        """Store the summary metrics of one run, replacing an earlier result with the same key."""
+        values = [key, fingerprint, time.time()]
+        values += [json.dumps(_plain(params[name])) if name in LIST_PARAMETERS else _plain(params[name])
+                   for name in SWEEP_PARAMETERS]
+        values += [_plain(summary[name]) for name in SUMMARY_METRICS]
+        placeholders = ', '.join('?' * len(values))
+        with self.connection:
+            self.connection.execute(f"INSERT OR REPLACE INTO {self.TABLE} VALUES ({placeholders})", values)
+
+    def summaries(self, keys: Sequence[str]) -> Dict[str, dict]:
+        """Summary metrics of the stored runs among keys, by key."""
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        for start in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[start:start + QUERY_CHUNK]
+            rows = self.connection.execute(
+                f"SELECT key, {', '.join(SUMMARY_METRICS)} FROM {self.TABLE} "
+                f"WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+            for key, *metrics in rows:
+                # SQLite stores NaN (e.g. the Sharpe ratio of a run without returns) as NULL
+                found[key] = {name: np.nan if value is None else value
+                              for name, value in zip(SUMMARY_METRICS, metrics)}
+        return found
+
+    def query(self, where: str = None, args: Sequence = (), order_by: str = 'percentage_return',
+              ascending: bool = False, limit: int = None, fingerprint: str = None) -> pd.DataFrame:
+        """
+        Select stored runs.
+
+        Parameters:
+        - where: Optional SQL condition over the parameter and metric columns,
+          e.g. "max_drawdown > ? AND leverage <= ?"
+        - args: Values for the ? placeholders of where
+        - order_by: Column to rank by
+        - ascending: Rank in ascending order of order_by
+        - limit: Maximum number of rows
+        - fingerprint: Only runs on this dataset fingerprint
+
+        Returns:
+        - DataFrame with one row per run, ranked by order_by
+        """
+        columns = ('key', 'fingerprint', 'created') + SWEEP_PARAMETERS + SUMMARY_METRICS
+        if order_by not in columns:
+            raise ValueError(f"Unknown column to order by: {order_by}")
+        conditions, values = [], list(args)
+        if where:
+            conditions.append(f"({where})")
+        if fingerprint is not None:
+            conditions.append("fingerprint = ?")
+            values.append(fingerprint)
+
+        sql = f"SELECT * FROM {self.TABLE}"
+        if conditions:
+            sql += f" WHERE {' AND '.join(conditions)}"
+        sql += f" ORDER BY {order_by} {'ASC' if ascending else 'DESC'}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            values.append(int(limit))
+
+        results_df = pd.read_sql_query(sql, self.connection, params=values)
+        for name in LIST_PARAMETERS:
+            results_df[name] = results_df[name].map(json.loads)
+        results_df['intrabar_fills'] = results_df['intrabar_fills'].astype(bool)
+        return results_df
+
+    def top(self, n: int = 20, by: str = 'percentage_return', min_drawdown: float = None,
+            fingerprint: str = None) -> pd.DataFrame:
+        """
+        Best n runs by a metric.
+
+        Parameters:
+        - n: Number of runs
+        - by: Metric to rank by, highest first
+        - min_drawdown: Only runs whose max_drawdown (negative percent) is above this
+        - fingerprint: Only runs on this dataset fingerprint
+        """
+        if min_drawdown is None:
+            return self.query(order_by=by, limit=n, fingerprint=fingerprint)
+        return self.query("max_drawdown > ?", (min_drawdown,), order_by=by, limit=n, fingerprint=fingerprint)
+
+    def delete(self, fingerprint: str = None) -> int:
+        """Remove all runs, or only those on one dataset fingerprint, and return how many were removed."""
+        with self.connection:
+            if fingerprint is None:
+                cursor = self.connection.execute(f"DELETE FROM {self.TABLE}")
+            else:
+                cursor = self.connection.execute(f"DELETE FROM {self.TABLE} WHERE fingerprint = ?", (fingerprint,))
+        logger.info(f"Removed {cursor.rowcount} runs from the results store {self.path}")
+        return cursor.rowcount
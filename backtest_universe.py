@@ -0,0 +1,201 @@
+import heapq
+from typing import Tuple
+
+import numpy as np
+
+from backtestt import (CryptoTradingBot, MarketData, compute_entry_mask, compute_window_change,
+                       logger)
+
+
+def align_universe(historical_data) -> Tuple[np.ndarray, np.ndarray, Tuple[str, ...]]:
+    """
+    Align the candles of every symbol on the union of their timestamps.
+
+    The close matrix is stored symbol-major, one contiguous row per symbol, so
+    barrier searches over one symbol's prices read contiguous memory.
+
+    Parameters:
+    - historical_data: Multi-symbol DataFrame, MarketData or dataset directory,
+      or a list of per-symbol series
+
+    Returns:
+    - tuple of (int64 timestamps, close matrix of shape (symbols, timestamps)
+      with NaN where a symbol has no candle, symbol names)
+    """
+    if isinstance(historical_data, (list, tuple)):
+        data = MarketData.concatenate([MarketData.coerce(part) for part in historical_data])
+    else:
+        data = MarketData.coerce(historical_data)
+    symbol_codes = data.symbol_codes if data.symbol_codes is not None else np.zeros(len(data), dtype=np.int32)
+
+    times = np.unique(data.times)
+    close = np.full((len(data.symbol_names), len(times)), np.nan)
+    close[symbol_codes, np.searchsorted(times, data.times)] = data.close
+    return times, close, data.symbol_names
+
+
+class UniverseBacktester:
+    """
+    Backtest the pump/dump strategy over a whole market of symbols at once.
+
+    The detection-window change of every symbol at every timestamp is computed
+    in one vectorized pass over the aligned close matrix. Positions in
+    different symbols are held concurrently against one shared balance. Each
+    open position has a single pending event, the next candle where
+    _backtest_check_position would change its state, kept in a heap ordered by
+    timestamp, which is merged with the timestamps carrying entry signals.
+
+    Every position is handled by the bot's own _backtest_* methods: its
+    position and counter trade are swapped into active_position and
+    counter_trade_position while it is processed. With a single symbol and
+    max_positions=1 the results match CryptoTradingBot.run_backtest.
+    """
+
+    def __init__(self, bot: CryptoTradingBot = None, max_positions: int = 5):
+        """
+        Parameters:
+        - bot: Bot whose parameters, logs and balance are used (a backtest-mode bot by default)
+        - max_positions: Maximum number of symbols held at the same time
+        """
+        self.bot = bot or CryptoTradingBot(backtest_mode=True)
+        self.max_positions = max_positions
+        self._positions = {}
+
+    def run(self, historical_data, config: dict = None) -> dict:
+        """
+        Run the universe backtest.
+
+        Parameters:
+        - historical_data: Candles of all symbols, see align_universe
+        - config: Optional config to override the bot's parameters
+
+        Returns:
+        - dict with backtest results, plus the symbols scanned and peak concurrent positions
+        """
+        bot = self.bot
+        bot._reset_backtest(config)
+        if bot.intrabar_fills:
+            raise ValueError("The universe backtest only supports close-only fills (intrabar_fills=False)")
+        times, close, symbol_names = align_universe(historical_data)
+        self._times, self._close, self._symbol_names = times, close, symbol_names
+        self._positions = {}
+        num_times = len(times)
+        period = bot.detection_period_minutes
+
+        change = compute_window_change(close, period)
+        entry_mask = compute_entry_mask(change, bot.position_direction, bot.pump_dump_threshold)
+        # The window ends a candle before the entry, so a symbol can signal at a timestamp it has no close for
+        entry_mask &= ~np.isnan(close)
+        entry_rows = np.flatnonzero(entry_mask.any(axis=0))
+        logger.info(f"Universe backtest over {len(symbol_names)} symbols and {num_times} timestamps, "
+                    f"{len(entry_rows)} with entry signals")
+
+        bot.equity_curve.record(times[0], times[0], bot.current_balance)
+        queue = []  # (row, symbol code) of the next event of every open position
+        recorded = period  # first row whose equity sample has not been recorded
+        k = np.searchsorted(entry_rows, period)
+        peak_positions = 0
+
+        while True:
+            next_event = queue[0][0] if queue else num_times
+            next_entry = entry_rows[k] if k < len(entry_rows) else num_times
+            row = min(next_event, next_entry)
+            if row >= num_times:
+                break
+
+            # The balance only changes at events, so record the samples up to this row in bulk
+            bot.equity_curve.record(times[recorded], times[row], bot.current_balance, row - recorded + 1)
+            recorded = row + 1
+
+            # Positions checked at this row cannot be re-entered until the next one
+            checked = set()
+            while queue and queue[0][0] == row:
+                _, code = heapq.heappop(queue)
+                checked.add(code)
+                self._activate(code)
+                bot._backtest_check_position(times[row], close[code, row])
+                self._schedule(queue, code, row + 1)
+
+            if next_entry == row:
+                self._open_entries(queue, row, entry_mask[:, row], change[:, row], checked)
+                peak_positions = max(peak_positions, len(self._positions))
+                k += 1
+
+        if recorded < num_times:
+            bot.equity_curve.record(times[recorded], times[-1], bot.current_balance, num_times - recorded)
+        self._close_all()
+
+        results = bot._calculate_backtest_results()
+        results.update({'symbols': symbol_names, 'max_positions': self.max_positions,
+                        'peak_positions': peak_positions})
+        if bot.profiler is not None:
+            results['profile'] = bot.profiler.table()
+        return results
+
+    def _activate(self, code: int):
+        """Swap the position of symbol code into the bot."""
+        self.bot.active_position, self.bot.counter_trade_position = self._positions[code]
+
+    def _deactivate(self, code: int):
+        """Store the bot's position back under symbol code, forgetting it once closed."""
+        bot = self.bot
+        if bot.active_position is None:
+            del self._positions[code]
+        else:
+            self._positions[code] = (bot.active_position, bot.counter_trade_position)
+        bot.active_position = bot.counter_trade_position = None
+
+    def _schedule(self, queue: list, code: int, start: int):
+        """
+        Queue the next event of the active position of symbol code, then deactivate it.
+
+        Timestamps where the symbol has no candle are NaN in its close row, and
+        every barrier comparison against NaN is False, so they are never events.
+        """
+        if self.bot.active_position is not None:
+            next_row = self.bot._find_next_position_event(self._close[code], start, len(self._times))
+            if next_row < len(self._times):
+                heapq.heappush(queue, (next_row, code))
+        self._deactivate(code)
+
+    def _committed_margin(self) -> float:
+        """Margin held by open positions and their counter trades."""
+        return sum(position.current_margin + (counter.margin if counter else 0.0)
+                   for position, counter in self._positions.values())
+
+    def _open_entries(self, queue: list, row: int, signals: np.ndarray, change: np.ndarray, checked: set):
+        """Open positions in the signalled symbols, strongest move first, while slots and balance allow."""
+        bot = self.bot
+        candidates = np.flatnonzero(signals)
+        candidates = candidates[np.argsort(-np.abs(change[candidates]), kind='stable')]
+
+        for code in candidates.tolist():
+            if len(self._positions) >= self.max_positions:
+                break
+            if code in self._positions or code in checked:
+                continue
+            # A new entry must fit in the balance not yet committed to other open positions;
+            # alone, a position opens exactly as in run_backtest
+            initial_margin = bot.current_balance * (bot.entry_price_percentage / 100)
+            if self._positions and self._committed_margin() + initial_margin > bot.current_balance:
+                break
+
+            bot.active_position = bot.counter_trade_position = None
+            bot._backtest_open_position(self._times[row], self._close[code, row], self._symbol_names[code])
+            self._positions[code] = (bot.active_position, None)
+            self._schedule(queue, code, row + 1)
+
+    def _close_all(self):
+        """Close the remaining positions at the last close of their symbol."""
+        for code in sorted(self._positions):
+            last = np.flatnonzero(~np.isnan(self._close[code]))[-1]
+            self._activate(code)
+            self.bot._backtest_close_position(self._times[last], self._close[code, last], "end_of_backtest")
+            self._deactivate(code)
+
+
+def run_universe_backtest(historical_data, config: dict = None, base_params: dict = None,
+                          max_positions: int = 5) -> dict:
+    """Convenience wrapper around UniverseBacktester with a fresh backtest-mode bot."""
+    bot = CryptoTradingBot(backtest_mode=True, **(base_params or {}))
+    return UniverseBacktester(bot, max_positions).run(historical_data, config)
@@ -3,6 +3,7 @@ import ccxt
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sns
 from datetime import datetime, timedelta
 import logging
@@ -13,6 +14,14 @@ import random
 from tqdm import tqdm
 import itertools
 import json
+import hashlib
+import pickle
+import cProfile
+import functools
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 
 # Configure logging
 logging.basicConfig(
@@ -25,6 +34,1535 @@ logging.basicConfig(
 )
 logger = logging.getLogger("CryptoTradingBot")
 
+def _to_epoch_ns(index) -> np.ndarray:
+    """Convert a timestamp index to int64 nanoseconds since the epoch."""
+    return pd.DatetimeIndex(index).as_unit('ns').asi8
+
+
+def compute_window_change(close_prices: np.ndarray, detection_period_minutes: int) -> np.ndarray:
+    """
+    Percentage move over the detection window before every candle.
+    
+    change[i] is the percentage move from close[i - detection_period_minutes]
+    to close[i - 1], matching the window checked before candle i. Candles
+    without a full window get NaN and never signal an entry.
+    """
+    period = detection_period_minutes
+    num_candles = close_prices.shape[-1]
+    change = np.full(close_prices.shape, np.nan)
+    
+    # Works along the last axis, so a (symbols, times) matrix is handled in one pass
+    if 0 < period < num_candles:
+        start_prices = close_prices[..., :num_candles - period]
+        end_prices = close_prices[..., period - 1:num_candles - 1]
+        change[..., period:] = ((end_prices - start_prices) / start_prices) * 100
+    
+    return change
+
+
+def compute_entry_mask(change: np.ndarray, position_direction: str, pump_dump_threshold: float) -> np.ndarray:
+    """Candles whose detection-window change triggers an entry in the given direction."""
+    # For LONG positions, look for coins that have dumped
+    if position_direction == "LONG":
+        return change <= -pump_dump_threshold
+    # For SHORT positions, look for coins that have pumped
+    if position_direction == "SHORT":
+        return change >= pump_dump_threshold
+    # Any other direction never enters; same shape as change, so (symbols, times) matrices work too
+    return np.zeros(change.shape, dtype=bool)
+
+
+def compute_entry_signals(close_prices: np.ndarray, detection_period_minutes: int,
+                          position_direction: str, pump_dump_threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the detection-window change series and entry mask in one vectorized pass.
+    
+    Returns:
+    - tuple of (change percentages, boolean entry mask)
+    """
+    change = compute_window_change(close_prices, detection_period_minutes)
+    return change, compute_entry_mask(change, position_direction, pump_dump_threshold)
+
+
+# Allowed difference between the compounded margin ladder and TKM, in percent
+MARGIN_TOLERANCE = 0.01
+
+
+def ladder_total_margin(entry_price_percentage, margin_increase_levels):
+    """
+    Total margin percentage used once every level of the ladder has been added.
+    
+    Works on scalars or, with a 2-D array of ladders (one per row), returns
+    the totals of all ladders using the same floating point operations.
+    """
+    # Initial entry percentage
+    total_used = entry_price_percentage
+    
+    # Calculate how much each margin addition contributes
+    current_margin = entry_price_percentage
+    levels = margin_increase_levels.T if isinstance(margin_increase_levels, np.ndarray) else margin_increase_levels
+    for increase_percentage in levels:
+        margin_addition = current_margin * (increase_percentage / 100)
+        total_used += margin_addition
+        current_margin += margin_addition
+    
+    return total_used
+
+
+# Prefixes extended at once while enumerating margin ladders; bounds the working memory
+LADDER_CHUNK_ROWS = 4096
+
+
+def _ladder_values(ladders: np.ndarray) -> List[List[float]]:
+    """Ladder rows as lists, with whole percentages as ints."""
+    if np.all(ladders % 1 == 0):
+        return ladders.astype(np.int64).tolist()
+    return [[value.item() if value % 1 else int(value) for value in ladder] for ladder in ladders]
+
+
+def iter_margin_ladders(entry_price_percentage: float, tkm_percentage: float, num_levels: int = 4,
+                        level_values=range(1, 201), tolerance: float = MARGIN_TOLERANCE):
+    """
+    Yield every margin ladder whose compounded additions use exactly TKM within tolerance.
+    
+    Ladders are built level by level. Each prefix is only extended by the
+    levels that keep TKM reachable with the smallest and largest values left
+    for the remaining levels, and at most LADDER_CHUNK_ROWS prefixes are
+    extended at once, depth first, so the working memory stays bounded however
+    many ladders there are. The last level is solved for the same way, so only
+    valid ladders are produced, in lexicographic order.
+    
+    Parameters: see generate_margin_ladders
+    
+    Yields:
+    - margin_increase_levels lists
+    """
+    values = np.unique(np.asarray(list(level_values), dtype=np.float64))
+    if num_levels < 1 or not len(values):
+        return
+    
+    stack = [(np.empty((1, 0)), np.ones(1))]
+    while stack:
+        prefixes, ratios = stack.pop()
+        if len(prefixes) > LADDER_CHUNK_ROWS:
+            # Split so the first half is extended (and yielded) first
+            half = len(prefixes) // 2
+            stack.append((prefixes[half:], ratios[half:]))
+            stack.append((prefixes[:half], ratios[:half]))
+            continue
+        remaining = num_levels - 1 - prefixes.shape[1]
+        prefixes, ratios = _extend_ladders(prefixes, ratios, values, entry_price_percentage,
+                                           tkm_percentage, tolerance, remaining)
+        if remaining:
+            if len(prefixes):
+                stack.append((prefixes, ratios))
+            continue
+        # Confirm with the exact computation used by _validate_margin_percentages
+        totals = ladder_total_margin(entry_price_percentage, prefixes)
+        yield from _ladder_values(prefixes[np.abs(totals - tkm_percentage) <= tolerance])
+
+
+def _extend_ladders(prefixes: np.ndarray, ratios: np.ndarray, values: np.ndarray, entry_price_percentage: float,
+                    tkm_percentage: float, tolerance: float, remaining: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Append to every prefix each level that keeps TKM reachable with remaining more levels.
+    
+    Returns:
+    - tuple of (extended prefixes, their products of 1 + level / 100)
+    """
+    # Every ladder multiplies the entry by prod(1 + level / 100)
+    max_ratio = (tkm_percentage + tolerance) / entry_price_percentage
+    min_ratio = (tkm_percentage - tolerance) / entry_price_percentage
+    factors = 1 + values / 100
+    # Bounds on this level's factor, given the smallest and largest products the remaining levels allow
+    upper = max_ratio / (ratios * factors[0] ** remaining)
+    lower = min_ratio / (ratios * factors[-1] ** remaining)
+    low = np.searchsorted(values, (lower - 1) * 100 - 1e-9, side='left')
+    high = np.searchsorted(values, (upper - 1) * 100 + 1e-9, side='right')
+    counts = np.maximum(high - low, 0)
+    rows = np.repeat(np.arange(len(prefixes)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    columns = low[rows] + offsets
+    return np.hstack([prefixes[rows], values[columns][:, None]]), ratios[rows] * factors[columns]
+
+
+def generate_margin_ladders(entry_price_percentage: float, tkm_percentage: float, num_levels: int = 4,
+                            level_values=range(1, 201), tolerance: float = MARGIN_TOLERANCE,
+                            n_samples: int = None, seed: int = None) -> List[List[float]]:
+    """
+    Margin ladders whose compounded additions use exactly TKM within tolerance.
+    
+    Enumerates iter_margin_ladders, or samples random prefixes and solves for
+    their last level, so _validate_margin_percentages accepts every ladder.
+    With many levels the valid ladders alone can fill the memory; iterate
+    iter_margin_ladders or pass n_samples instead.
+    
+    Parameters:
+    - entry_price_percentage: Initial entry percentage of the ladder
+    - tkm_percentage: Total margin percentage the ladder must add up to
+    - num_levels: Number of margin additions
+    - level_values: Allowed margin increase percentages for every level
+    - tolerance: Allowed difference from tkm_percentage
+    - n_samples: Return at most this many ladders sampled without enumerating the
+      whole space (None enumerates every valid ladder)
+    - seed: Random seed for sampling
+    
+    Returns:
+    - list of margin_increase_levels lists
+    """
+    if n_samples is None:
+        return list(iter_margin_ladders(entry_price_percentage, tkm_percentage, num_levels, level_values, tolerance))
+    
+    values = np.unique(np.asarray(list(level_values), dtype=np.float64))
+    if num_levels < 1 or not len(values):
+        return []
+    rng = np.random.default_rng(seed)
+    prefixes = rng.choice(values, size=(n_samples * 20, num_levels - 1))
+    ratios = np.prod(1 + prefixes / 100, axis=1)
+    ladders, _ = _extend_ladders(prefixes, ratios, values, entry_price_percentage, tkm_percentage, tolerance, 0)
+    
+    # Confirm with the exact computation used by _validate_margin_percentages
+    totals = ladder_total_margin(entry_price_percentage, ladders)
+    ladders = ladders[np.abs(totals - tkm_percentage) <= tolerance]
+    ladders = np.unique(ladders, axis=0)
+    return _ladder_values(ladders[rng.permutation(len(ladders))[:n_samples]])
+
+
+def margin_ladder_configs(entry_price_percentages, tkm_percentage: float, param_grid: Dict[str, list] = None,
+                          **ladder_options) -> List[dict]:
+    """
+    Sweep configurations pairing every entry percentage with its valid ladders.
+    
+    The result can be passed as param_grid to run_parameter_sweep or
+    run_successive_halving; when param_grid is given, every ladder config is
+    combined with each of its grid points.
+    
+    Parameters:
+    - entry_price_percentages: Entry percentages to generate ladders for
+    - tkm_percentage: Total margin percentage every ladder must add up to
+    - param_grid: Other parameters to combine with the ladders
+    - ladder_options: Passed on to generate_margin_ladders
+    """
+    configs = []
+    for entry_price_percentage in entry_price_percentages:
+        for ladder in generate_margin_ladders(entry_price_percentage, tkm_percentage, **ladder_options):
+            configs.append({'tkm_percentage': tkm_percentage,
+                            'entry_price_percentage': entry_price_percentage,
+                            'margin_increase_levels': ladder})
+    if param_grid:
+        configs = [{**config, **point} for config in configs for point in _grid_configs(param_grid)]
+    return configs
+
+
+class SignalCache:
+    """
+    LRU cache of detection-window change series and entry candles.
+    
+    Entries are keyed by the data fingerprint plus the window (change series)
+    or window, direction and threshold (entry candles), so backtests that only
+    vary the TP or margin ladder reuse the signal of an earlier run. The
+    least recently used arrays are evicted once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key, value: np.ndarray) -> np.ndarray:
+        # Cached arrays are shared between runs, so make them read-only
+        value.flags.writeable = False
+        if value.nbytes > self.max_bytes:
+            return value
+        self._entries[key] = value
+        self.current_bytes += value.nbytes
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+        return value
+
+    def change_series(self, data: 'MarketData', detection_period_minutes: int) -> np.ndarray:
+        """Detection-window change of every candle, see compute_window_change."""
+        key = ('change', data.fingerprint, detection_period_minutes)
+        change = self._get(key)
+        if change is None:
+            change = self._put(key, compute_window_change(data.close, detection_period_minutes))
+        return change
+
+    def entry_indices(self, data: 'MarketData', detection_period_minutes: int,
+                      position_direction: str, pump_dump_threshold: float) -> np.ndarray:
+        """Sorted indices of the candles where an entry signal fires."""
+        key = ('entries', data.fingerprint, detection_period_minutes, position_direction, pump_dump_threshold)
+        indices = self._get(key)
+        if indices is None:
+            change = self.change_series(data, detection_period_minutes)
+            indices = self._put(key, np.flatnonzero(compute_entry_mask(change, position_direction,
+                                                                       pump_dump_threshold)))
+        return indices
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+
+# Shared by all bots in the process; set CryptoTradingBot.signal_cache to None to disable
+signal_cache = SignalCache()
+
+
+# MarketData built from DataFrames still alive, by id(frame): (signature, MarketData)
+_frame_conversions = {}
+
+
+def _coerce_frame(historical_data: pd.DataFrame) -> 'MarketData':
+    """MarketData.from_frame, memoized per DataFrame object until it is garbage collected."""
+    index = historical_data.index
+    signature = (historical_data.shape, tuple(historical_data.columns),
+                 (index[0], index[-1]) if len(index) else None)
+    key = id(historical_data)
+    cached = _frame_conversions.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    data = MarketData.from_frame(historical_data)
+    if cached is None:
+        weakref.finalize(historical_data, _frame_conversions.pop, key, None)
+    _frame_conversions[key] = (signature, data)
+    return data
+
+
+class MarketData:
+    """
+    Candle series stored as fixed-dtype NumPy columns.
+    
+    run_backtest accepts this in place of a DataFrame. Columns can be plain
+    arrays, shared memory buffers or memory-mapped files, and are never copied.
+    save() writes a dataset directory with one .npy file per column, which
+    load() maps back read-only so processes share the OS page cache.
+    """
+    COLUMNS = ('open', 'high', 'low', 'close', 'volume')
+    METADATA_FILE = 'dataset.json'
+
+    def __init__(self, times: np.ndarray, close: np.ndarray, open: np.ndarray = None,
+                 high: np.ndarray = None, low: np.ndarray = None, volume: np.ndarray = None,
+                 symbol_codes: np.ndarray = None, symbol_names: Tuple[str, ...] = ('',)):
+        """
+        Parameters:
+        - times: int64 candle timestamps in nanoseconds since the epoch
+        - close, open, high, low, volume: float64 price and volume columns
+        - symbol_codes: Optional int32 index into symbol_names for every candle
+        - symbol_names: Symbols referenced by symbol_codes, or the single symbol of the series
+        """
+        self.times = times
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.symbol_codes = symbol_codes
+        self.symbol_names = tuple(symbol_names)
+        self.path = None  # dataset directory when the columns are memory-mapped
+        self._fingerprint = None
+        self._pyramids = {}
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the timestamps and close prices, computed once per object."""
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(digest_size=16)
+            for values in (self.times, self.close):
+                digest.update(memoryview(np.ascontiguousarray(values)).cast('B'))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def price_pyramid(self, intrabar: bool = False) -> 'PricePyramid':
+        """Barrier search pyramid over the closes, or over the lows and highs for intrabar fills."""
+        pyramid = self._pyramids.get(intrabar)
+        if pyramid is None:
+            if intrabar and (self.low is None or self.high is None):
+                raise ValueError("Intrabar fills need low and high columns")
+            pyramid = PricePyramid(self.low, self.high) if intrabar else PricePyramid(self.close, self.close)
+            self._pyramids[intrabar] = pyramid
+        return pyramid
+
+    @classmethod
+    def from_frame(cls, historical_data: pd.DataFrame) -> 'MarketData':
+        """Build column arrays from an OHLCV DataFrame indexed by timestamp."""
+        columns = {
+            name: historical_data[name].to_numpy(dtype=np.float64)
+            for name in cls.COLUMNS if name in historical_data.columns
+        }
+        symbol_codes, symbol_names = None, ('',)
+        if 'symbol' in historical_data.columns:
+            codes, uniques = pd.factorize(historical_data['symbol'])
+            symbol_codes, symbol_names = codes.astype(np.int32), tuple(uniques)
+        return cls(_to_epoch_ns(historical_data.index), symbol_codes=symbol_codes,
+                   symbol_names=symbol_names, **columns)
+
+    def save(self, directory: str):
+        """Write every column to <directory>/<name>.npy plus the dataset metadata."""
+        os.makedirs(directory, exist_ok=True)
+        for name, values in self.arrays().items():
+            np.save(os.path.join(directory, f'{name}.npy'), np.ascontiguousarray(values))
+        self.write_metadata(directory)
+
+    def write_metadata(self, directory: str):
+        """Record symbol names and the fingerprint so load() does not rehash the columns."""
+        metadata = {'symbol_names': list(self.symbol_names), 'fingerprint': self.fingerprint,
+                    'num_candles': len(self)}
+        with open(os.path.join(directory, self.METADATA_FILE), 'w') as f:
+            json.dump(metadata, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: str = 'r') -> 'MarketData':
+        """
+        Open a dataset directory written by save().
+        
+        Parameters:
+        - directory: Dataset directory
+        - mmap_mode: np.load mmap_mode; 'r' maps the files read-only, None reads them into memory
+        """
+        with open(os.path.join(directory, cls.METADATA_FILE)) as f:
+            metadata = json.load(f)
+        columns = {}
+        for name in ('times',) + cls.COLUMNS + ('symbol_codes',):
+            path = os.path.join(directory, f'{name}.npy')
+            if os.path.exists(path):
+                columns[name] = np.load(path, mmap_mode=mmap_mode)
+        data = cls(symbol_names=metadata['symbol_names'], **columns)
+        data._fingerprint = metadata['fingerprint']
+        if mmap_mode is not None:
+            data.path = os.path.abspath(directory)
+        return data
+
+    @classmethod
+    def coerce(cls, historical_data) -> 'MarketData':
+        """
+        Accept a DataFrame, a dataset directory path or MarketData.
+        
+        The conversion of a DataFrame is kept while the frame lives, so later
+        runs on it reuse the columns, fingerprint and price pyramids. It is
+        matched by object, shape and first and last timestamp, so a frame
+        edited in place must be passed as a copy. Sweeps should pass MarketData.
+        """
+        if isinstance(historical_data, pd.DataFrame):
+            return _coerce_frame(historical_data)
+        if isinstance(historical_data, (str, os.PathLike)):
+            return cls.load(historical_data)
+        return historical_data
+
+    @classmethod
+    def concatenate(cls, parts: List['MarketData']) -> 'MarketData':
+        """Join candle series back to back, merging their symbol tables."""
+        symbol_names = list(dict.fromkeys(name for part in parts for name in part.symbol_names))
+        columns = {}
+        for name in ('times',) + cls.COLUMNS:
+            if all(getattr(part, name) is not None for part in parts):
+                columns[name] = np.concatenate([getattr(part, name) for part in parts])
+        if len(symbol_names) > 1:
+            lookup = {name: code for code, name in enumerate(symbol_names)}
+            codes = []
+            for part in parts:
+                remap = np.array([lookup[name] for name in part.symbol_names], dtype=np.int32)
+                codes.append(remap[part.symbol_codes] if part.symbol_codes is not None
+                             else np.full(len(part), remap[0], dtype=np.int32))
+            columns['symbol_codes'] = np.concatenate(codes)
+        return cls(symbol_names=symbol_names, **columns)
+
+    def slice(self, start: int = None, stop: int = None, copy: bool = False) -> 'MarketData':
+        """Candles start:stop as views of the columns, or as copies that do not keep the source alive."""
+        columns = {name: values[start:stop] for name, values in self.arrays().items()}
+        if copy:
+            columns = {name: np.array(values) for name, values in columns.items()}
+        return MarketData(symbol_names=self.symbol_names, **columns)
+
+    def chunks(self, chunk_size: int):
+        """Yield consecutive slices of chunk_size candles, e.g. for run_backtest_stream."""
+        for start in range(0, len(self), chunk_size):
+            yield self.slice(start, start + chunk_size)
+
+    def __len__(self):
+        return len(self.close)
+
+    def symbol_at(self, i: int):
+        if self.symbol_codes is None:
+            return self.symbol_names[0]
+        return self.symbol_names[self.symbol_codes[i]]
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """All non-empty columns, including times and symbol codes."""
+        names = ('times',) + self.COLUMNS + ('symbol_codes',)
+        return {name: getattr(self, name) for name in names if getattr(self, name) is not None}
+
+
+class PricePyramid:
+    """
+    Min/max price aggregates over buckets of 1, 15 and 240 candles (1m -> 15m -> 4h).
+    
+    Barrier searches test whole coarse buckets first and only drill down to
+    single candles inside buckets whose price range can touch a barrier, so a
+    long hold costs a scan over a few hundred 4h buckets instead of every minute.
+    """
+    FACTORS = (15, 16)
+    HEAD_SIZE = 256  # candles checked one by one before using the coarse levels
+
+    def __init__(self, low: np.ndarray, high: np.ndarray, factors: Tuple[int, ...] = FACTORS):
+        """
+        Parameters:
+        - low, high: Per-candle price bounds (the close for both in close-only mode)
+        - factors: Number of buckets of each level merged into one bucket of the next
+        """
+        self.levels = [(low, high)]
+        self.sizes = [1]
+        for factor in factors:
+            low, high = self.levels[-1]
+            num_buckets = -(-len(low) // factor)
+            padding = num_buckets * factor - len(low)
+            low = np.pad(low, (0, padding), constant_values=np.inf).reshape(num_buckets, factor)
+            high = np.pad(high, (0, padding), constant_values=-np.inf).reshape(num_buckets, factor)
+            # fmin/fmax skip NaN prices instead of poisoning the whole bucket
+            self.levels.append((np.fmin.reduce(low, axis=1), np.fmax.reduce(high, axis=1)))
+            self.sizes.append(self.sizes[-1] * factor)
+
+    def find_first(self, bucket_mask, start: int, stop: int) -> int:
+        """
+        First candle in [start, stop) for which bucket_mask holds.
+        
+        Parameters:
+        - bucket_mask: Function of (low, high) arrays marking buckets whose price
+          range can trigger; exact on single candles, a superset on coarse buckets
+        
+        Returns:
+        - index of the candle, or stop if there is none
+        """
+        # Most holds end within a few candles, which a single flat scan finds fastest
+        head_stop = min(start + self.HEAD_SIZE, stop)
+        found = self._search(0, start, head_stop, bucket_mask)
+        if found < head_stop:
+            return found
+        return self._search(len(self.levels) - 1, head_stop, stop, bucket_mask)
+
+    def _search(self, level: int, start: int, stop: int, bucket_mask) -> int:
+        if start >= stop:
+            return stop
+        low, high = self.levels[level]
+        if level == 0:
+            hits = bucket_mask(low[start:stop], high[start:stop])
+            return start + int(hits.argmax()) if hits.any() else stop
+        
+        # Candles before the first whole bucket of this level are searched one level down
+        size = self.sizes[level]
+        first_full = min(-(-start // size) * size, stop)
+        found = self._search(level - 1, start, first_full, bucket_mask)
+        if found < first_full:
+            return found
+        
+        # Whole buckets in doubling blocks, descending only into those that can trigger
+        last_full = max(stop // size * size, first_full)
+        bucket, end_bucket = first_full // size, last_full // size
+        block_size = 64
+        while bucket < end_bucket:
+            block_end = min(bucket + block_size, end_bucket)
+            for candidate in bucket + np.flatnonzero(bucket_mask(low[bucket:block_end], high[bucket:block_end])):
+                bucket_stop = (int(candidate) + 1) * size
+                found = self._search(level - 1, int(candidate) * size, bucket_stop, bucket_mask)
+                if found < bucket_stop:
+                    return found
+            bucket = block_end
+            block_size = min(block_size * 2, 4096)
+        
+        return self._search(level - 1, last_full, stop, bucket_mask)
+
+
+class SharedMarketData:
+    """
+    Copy of MarketData columns in shared memory for worker processes.
+    
+    The owner creates the blocks and unlinks them on close(); workers call
+    attach() with the picklable descriptor to map the same pages without a copy.
+    Memory-mapped datasets are not copied: workers map the same files instead.
+    """
+
+    def __init__(self, data: MarketData):
+        self._blocks = []
+        self.descriptor = {'symbol_names': data.symbol_names, 'fingerprint': data.fingerprint, 'columns': {}}
+        if data.path is not None:
+            self.descriptor['path'] = data.path
+            return
+        for name, values in data.arrays().items():
+            values = np.ascontiguousarray(values)
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+            self._blocks.append(block)
+            self.descriptor['columns'][name] = (block.name, values.shape, values.dtype.str)
+
+    @staticmethod
+    def attach(descriptor: dict) -> Tuple[MarketData, list]:
+        """
+        Map shared columns described by descriptor.
+        
+        Returns:
+        - tuple of (MarketData, shared memory handles that must be kept alive)
+        """
+        if 'path' in descriptor:
+            return MarketData.load(descriptor['path']), []
+        handles = []
+        columns = {}
+        for name, (block_name, shape, dtype) in descriptor['columns'].items():
+            try:
+                block = shared_memory.SharedMemory(name=block_name, track=False)
+            except TypeError:  # Python < 3.13 registers with the owner's resource tracker instead
+                block = shared_memory.SharedMemory(name=block_name)
+            handles.append(block)
+            columns[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        data = MarketData(symbol_names=descriptor['symbol_names'], **columns)
+        data._fingerprint = descriptor.get('fingerprint')
+        return data, handles
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class BacktestPosition:
+    """Main position held during a backtest."""
+    __slots__ = ('coin', 'entry_time', 'entry_price', 'quantity', 'direction', 'current_margin',
+                 'margin_level', 'total_margin_used', 'take_profit_price', 'stop_loss_price')
+
+    def __init__(self, coin, entry_time, entry_price, quantity, direction, current_margin,
+                 margin_level, total_margin_used, take_profit_price=0.0, stop_loss_price=0.0):
+        self.coin = coin
+        self.entry_time = entry_time
+        self.entry_price = entry_price
+        self.quantity = quantity
+        self.direction = direction
+        self.current_margin = current_margin
+        self.margin_level = margin_level
+        self.total_margin_used = total_margin_used
+        self.take_profit_price = take_profit_price
+        self.stop_loss_price = stop_loss_price
+
+
+class CounterTradePosition:
+    """Counter (hedge) trade held against the main position during a backtest."""
+    __slots__ = ('entry_time', 'entry_price', 'quantity', 'direction', 'margin')
+
+    def __init__(self, entry_time, entry_price, quantity, direction, margin):
+        self.entry_time = entry_time
+        self.entry_price = entry_price
+        self.quantity = quantity
+        self.direction = direction
+        self.margin = margin
+
+
+class BacktestState:
+    """
+    Snapshot of a backtest in progress: parameters, positions, balance, logs and cursor.
+    
+    Logs are append-only, so only their checkpoints are recorded together with
+    the log objects; restoring rolls them back. The state is picklable and
+    can be handed to another process with the same candles.
+    """
+    __slots__ = ('parameters', 'active_position', 'counter_trade_position', 'current_balance',
+                 'cursor', 'logs', 'log_checkpoints')
+
+    def __init__(self, bot: 'CryptoTradingBot'):
+        self.parameters = {key: getattr(bot, key) for key in SWEEP_PARAMETERS}
+        self.active_position = _copy_slots(bot.active_position)
+        self.counter_trade_position = _copy_slots(bot.counter_trade_position)
+        self.current_balance = bot.current_balance
+        self.cursor = bot._backtest_cursor
+        self.logs = (bot.trade_history, bot.margin_additions, bot.counter_trades, bot.equity_curve)
+        self.log_checkpoints = tuple(log.checkpoint() for log in self.logs)
+
+    def restore(self, bot: 'CryptoTradingBot'):
+        for key, value in self.parameters.items():
+            setattr(bot, key, value)
+        bot.tkm = bot.total_balance * (bot.tkm_percentage / 100)
+        bot.active_position = _copy_slots(self.active_position)
+        bot.counter_trade_position = _copy_slots(self.counter_trade_position)
+        bot.current_balance = self.current_balance
+        bot._backtest_cursor = self.cursor
+        for log, checkpoint in zip(self.logs, self.log_checkpoints):
+            log.rollback(checkpoint)
+        bot.trade_history, bot.margin_additions, bot.counter_trades, bot.equity_curve = self.logs
+
+
+def _copy_slots(obj):
+    """Shallow copy of a __slots__ position object (or None)."""
+    if obj is None:
+        return None
+    copy = object.__new__(type(obj))
+    for name in type(obj).__slots__:
+        setattr(copy, name, getattr(obj, name))
+    return copy
+
+
+class ColumnarLog:
+    """
+    Append-only event log backed by a preallocated NumPy structured array.
+    
+    Capacity doubles whenever the array is full, so appends are amortized O(1)
+    and every column is available as a contiguous array without building dicts.
+    version changes with every append and truncate, so caches of derived data
+    can tell when the rows changed even if the length is the same after a rollback.
+    """
+    dtype = np.dtype([])
+
+    def __init__(self, capacity: int = 64):
+        self._data = np.zeros(max(capacity, 1), dtype=self.dtype)
+        self._size = 0
+        self.version = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, row: tuple):
+        """Append one row given as a tuple in dtype field order."""
+        if self._size == len(self._data):
+            grown = np.zeros(len(self._data) * 2, dtype=self.dtype)
+            grown[:self._size] = self._data
+            self._data = grown
+        self._data[self._size] = row
+        self._size += 1
+        self.version += 1
+
+    def truncate(self, size: int):
+        """Drop rows recorded after the first size rows."""
+        self._size = min(size, self._size)
+        self.version += 1
+
+    def checkpoint(self):
+        """Marker of the current contents for rollback()."""
+        return self._size
+
+    def rollback(self, checkpoint):
+        """Drop everything recorded after checkpoint."""
+        self.truncate(checkpoint)
+
+    @property
+    def array(self) -> np.ndarray:
+        """Structured array view of the recorded rows."""
+        return self._data[:self._size]
+
+    def column(self, name: str) -> np.ndarray:
+        """View of a single column of the recorded rows."""
+        return self._data[name][:self._size]
+
+    def to_records(self) -> List[dict]:
+        """Expand the log into the list-of-dicts format used by older reports."""
+        return [self._row_to_dict(row) for row in self.array]
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, metadata: dict = None) -> 'ColumnarLog':
+        """
+        Wrap recorded rows without copying them, e.g. a memory-mapped file.
+        
+        The first append after wrapping copies the rows into a new, larger array.
+        """
+        log = cls(capacity=1)
+        log._data = array
+        log._size = len(array)
+        log._restore(metadata or {})
+        return log
+
+    def _metadata(self) -> dict:
+        """State beyond the rows that save_backtest_results writes to the summary."""
+        return {}
+
+    def _restore(self, metadata: dict):
+        pass
+
+    def _row_to_dict(self, row) -> dict:
+        return {name: row[name].item() for name in self.dtype.names}
+
+
+DIRECTIONS = ('LONG', 'SHORT')
+
+
+class TradeLog(ColumnarLog):
+    """Open, close and counter-trade close events of a backtest."""
+    ACTIONS = ('open', 'close', 'close_counter')
+    REASONS = ('', 'take_profit', 'end_of_backtest')
+    dtype = np.dtype([
+        ('action', 'i1'),
+        ('time', 'i8'),
+        ('coin', 'i4'),
+        ('direction', 'i1'),
+        ('reason', 'i1'),
+        ('price', 'f8'),
+        ('quantity', 'f8'),
+        ('margin', 'f8'),
+        ('open_price', 'f8'),
+        ('close_price', 'f8'),
+        ('pnl_percentage', 'f8'),
+        ('pnl_amount', 'f8'),
+        ('margin_levels_used', 'i4'),
+        ('total_margin_used', 'f8'),
+    ])
+
+    def __init__(self, capacity: int = 64):
+        super().__init__(capacity)
+        self.coins = []
+        self._coin_codes = {}
+        self.reasons = list(self.REASONS)
+
+    def _coin_code(self, coin) -> int:
+        code = self._coin_codes.get(coin)
+        if code is None:
+            code = len(self.coins)
+            self._coin_codes[coin] = code
+            self.coins.append(coin)
+        return code
+
+    def _metadata(self) -> dict:
+        return {'coins': self.coins, 'reasons': self.reasons}
+
+    def _restore(self, metadata: dict):
+        self.coins = list(metadata.get('coins', []))
+        self._coin_codes = {coin: code for code, coin in enumerate(self.coins)}
+        self.reasons = list(metadata.get('reasons', self.REASONS))
+
+    def _reason_code(self, reason: str) -> int:
+        if reason not in self.reasons:
+            self.reasons.append(reason)
+        return self.reasons.index(reason)
+
+    def record_open(self, time, coin, direction, price, quantity, margin):
+        self.append((0, time, self._coin_code(coin), DIRECTIONS.index(direction), 0,
+                     price, quantity, margin, 0.0, 0.0, 0.0, 0.0, 0, 0.0))
+
+    def record_close(self, time, reason, open_price, close_price, pnl_percentage, pnl_amount,
+                     margin_levels_used, total_margin_used, coin=None):
+        coin_code = -1 if coin is None else self._coin_code(coin)
+        self.append((1, time, coin_code, -1, self._reason_code(reason), 0.0, 0.0, 0.0,
+                     open_price, close_price, pnl_percentage, pnl_amount,
+                     margin_levels_used, total_margin_used))
+
+    def record_counter_close(self, time, direction, open_price, close_price, pnl_percentage, pnl_amount):
+        self.append((2, time, -1, DIRECTIONS.index(direction), 0, 0.0, 0.0, 0.0,
+                     open_price, close_price, pnl_percentage, pnl_amount, 0, 0.0))
+
+    def closed_trades(self) -> np.ndarray:
+        """Rows of main positions that were closed."""
+        rows = self.array
+        return rows[rows['action'] == 1]
+
+    def trade_counts(self) -> Tuple[int, int, int]:
+        """Number of closed main positions, winners and losers."""
+        closed_pnl = self.closed_trades()['pnl_amount']
+        winning_trades = int(np.count_nonzero(closed_pnl > 0))
+        return len(closed_pnl), winning_trades, len(closed_pnl) - winning_trades
+
+    def closed_trades_frame(self) -> pd.DataFrame:
+        """Closed main positions as a DataFrame with decoded columns."""
+        rows = self.closed_trades()
+        coins = np.array(self.coins + [None], dtype=object)  # code -1 (coin not recorded) maps to None
+        return pd.DataFrame({
+            'time': pd.to_datetime(rows['time'], unit='ns'),
+            'coin': coins[rows['coin']],
+            'reason': np.array(self.reasons, dtype=object)[rows['reason']],
+            'open_price': rows['open_price'],
+            'close_price': rows['close_price'],
+            'pnl_percentage': rows['pnl_percentage'],
+            'pnl_amount': rows['pnl_amount'],
+            'margin_levels_used': rows['margin_levels_used'],
+            'total_margin_used': rows['total_margin_used'],
+        })
+
+    def _row_to_dict(self, row) -> dict:
+        action = self.ACTIONS[row['action']]
+        record = {'time': pd.Timestamp(int(row['time'])), 'action': action}
+        if action == 'open':
+            record.update({
+                'coin': self.coins[row['coin']],
+                'direction': DIRECTIONS[row['direction']],
+                'price': row['price'].item(),
+                'quantity': row['quantity'].item(),
+                'margin': row['margin'].item(),
+            })
+            return record
+        if action == 'close':
+            record['reason'] = self.reasons[row['reason']]
+        else:
+            record['direction'] = DIRECTIONS[row['direction']]
+        record.update({
+            'open_price': row['open_price'].item(),
+            'close_price': row['close_price'].item(),
+            'pnl_percentage': row['pnl_percentage'].item(),
+            'pnl_amount': row['pnl_amount'].item(),
+        })
+        if action == 'close':
+            record['margin_levels_used'] = int(row['margin_levels_used'])
+            record['total_margin_used'] = row['total_margin_used'].item()
+        return record
+
+
+class MarginLog(ColumnarLog):
+    """Margin ladder additions of a backtest."""
+    dtype = np.dtype([
+        ('time', 'i8'),
+        ('level', 'i4'),
+        ('amount', 'f8'),
+        ('total_margin', 'f8'),
+        ('price', 'f8'),
+    ])
+
+    def _row_to_dict(self, row) -> dict:
+        record = super()._row_to_dict(row)
+        record['time'] = pd.Timestamp(record['time'])
+        return record
+
+
+class CounterTradeLog(ColumnarLog):
+    """Counter trades opened during a backtest."""
+    dtype = np.dtype([
+        ('time', 'i8'),
+        ('direction', 'i1'),
+        ('price', 'f8'),
+        ('quantity', 'f8'),
+        ('margin', 'f8'),
+    ])
+
+    def _row_to_dict(self, row) -> dict:
+        record = super()._row_to_dict(row)
+        record['time'] = pd.Timestamp(record['time'])
+        record['direction'] = DIRECTIONS[record['direction']]
+        return record
+
+
+class EquityCurve(ColumnarLog):
+    """
+    Run-length encoded balance history of a backtest.
+    
+    Only the samples where the balance changes are stored, together with the
+    total number of samples and the timestamp of the last one. Because the
+    balance only moves when a trade closes, this is a tiny fraction of the
+    per-candle series, which can still be rebuilt with expand().
+    """
+    dtype = np.dtype([
+        ('time', 'i8'),
+        ('balance', 'f8'),
+    ])
+
+    def __init__(self, capacity: int = 64):
+        super().__init__(capacity)
+        self.num_samples = 0
+        self.end_time = None
+
+    def record(self, start_time, end_time, balance, count: int = 1):
+        """Record count consecutive samples from start_time to end_time holding balance."""
+        if self._size == 0 or self._data['balance'][self._size - 1] != balance:
+            self.append((start_time, balance))
+        self.num_samples += count
+        self.end_time = end_time
+
+    def checkpoint(self):
+        return self._size, self.num_samples, self.end_time
+
+    def rollback(self, checkpoint):
+        size, self.num_samples, self.end_time = checkpoint
+        self.truncate(size)
+
+    def _metadata(self) -> dict:
+        return {'num_samples': self.num_samples,
+                'end_time': None if self.end_time is None else int(self.end_time)}
+
+    def _restore(self, metadata: dict):
+        self.num_samples = metadata.get('num_samples', len(self))
+        self.end_time = metadata.get('end_time')
+
+    @property
+    def times(self) -> np.ndarray:
+        return self.column('time')
+
+    @property
+    def balances(self) -> np.ndarray:
+        return self.column('balance')
+
+    def max_drawdown(self) -> float:
+        """Maximum drawdown in percent; constant runs cannot add new lows."""
+        balances = self.balances
+        if not len(balances):
+            return 0
+        drawdown = (balances / np.maximum.accumulate(balances) - 1) * 100
+        return drawdown.min()
+
+    def sharpe_ratio(self, periods_per_year: int = 252) -> float:
+        """
+        Annualized Sharpe ratio of the per-sample returns.
+        
+        Every sample between change points has a return of exactly zero, so the
+        mean and sample standard deviation are computed from the change points
+        and the count of zero returns.
+        """
+        num_returns = self.num_samples - 1
+        if num_returns < 1:
+            return 0
+        
+        balances = self.balances
+        returns = balances[1:] / balances[:-1] - 1
+        num_zero = num_returns - len(returns)
+        mean = returns.sum() / num_returns
+        
+        if num_returns < 2:
+            return np.nan
+        squared_deviation = ((returns - mean) ** 2).sum() + num_zero * mean ** 2
+        std = np.sqrt(squared_deviation / (num_returns - 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.float64(mean) / std * np.sqrt(periods_per_year)
+
+    def expand(self, sample_times: np.ndarray) -> pd.Series:
+        """
+        Materialize the balance at each of the given int64 sample timestamps.
+        
+        Parameters:
+        - sample_times: Sorted int64 nanosecond timestamps to evaluate
+        
+        Returns:
+        - Series of balances indexed by timestamp
+        """
+        sample_times = np.asarray(sample_times, dtype=np.int64)
+        positions = np.searchsorted(self.times, sample_times, side='right') - 1
+        balances = self.balances[np.clip(positions, 0, None)]
+        return pd.Series(balances, index=pd.to_datetime(sample_times, unit='ns'), name='balance')
+
+    def to_step_frame(self) -> pd.DataFrame:
+        """Change points plus the final sample, enough to draw the curve as steps."""
+        times = self.times
+        balances = self.balances
+        if len(times) and self.end_time is not None and self.end_time > times[-1]:
+            times = np.append(times, self.end_time)
+            balances = np.append(balances, balances[-1])
+        return pd.DataFrame({'balance': balances}, index=pd.to_datetime(times, unit='ns'))
+
+
+class TradeStats:
+    """
+    Win/loss counters standing in for TradeLog in lean backtests.
+    
+    Accepts the same record_* calls but keeps no rows.
+    """
+
+    def __init__(self):
+        self.total_trades = 0
+        self.winning_trades = 0
+
+    def __len__(self):
+        return 0
+
+    def record_open(self, time, coin, direction, price, quantity, margin):
+        pass
+
+    def record_close(self, time, reason, open_price, close_price, pnl_percentage, pnl_amount,
+                     margin_levels_used, total_margin_used, coin=None):
+        self.total_trades += 1
+        if pnl_amount > 0:
+            self.winning_trades += 1
+
+    def record_counter_close(self, time, direction, open_price, close_price, pnl_percentage, pnl_amount):
+        pass
+
+    def trade_counts(self) -> Tuple[int, int, int]:
+        return self.total_trades, self.winning_trades, self.total_trades - self.winning_trades
+
+    def checkpoint(self):
+        return self.total_trades, self.winning_trades
+
+    def rollback(self, checkpoint):
+        self.total_trades, self.winning_trades = checkpoint
+
+
+class NullLog:
+    """Log that discards every row, for margin and counter-trade events in lean backtests."""
+
+    def __len__(self):
+        return 0
+
+    def append(self, row: tuple):
+        pass
+
+    def checkpoint(self):
+        return None
+
+    def rollback(self, checkpoint):
+        pass
+
+
+class EquityStats:
+    """
+    Streaming drawdown and Sharpe accumulators standing in for EquityCurve in lean backtests.
+    
+    Keeps the running peak and deepest drawdown of the balance, and Welford
+    mean/variance of the non-zero returns between balance changes. Samples
+    between changes have zero return and are folded in when the ratio is taken.
+    """
+
+    def __init__(self):
+        self.num_samples = 0
+        self.end_time = None
+        self.balance = None
+        self.peak = None
+        self.drawdown = 0.0
+        self.num_changes = 0
+        self.mean_change = 0.0
+        self.squared_change_deviation = 0.0
+
+    def __len__(self):
+        return 0
+
+    def record(self, start_time, end_time, balance, count: int = 1):
+        """Record count consecutive samples from start_time to end_time holding balance."""
+        if self.balance is None:
+            self.balance = self.peak = balance
+            self.drawdown = min(self.drawdown, (balance / self.peak - 1) * 100)
+        elif balance != self.balance:
+            change = balance / self.balance - 1
+            self.num_changes += 1
+            delta = change - self.mean_change
+            self.mean_change += delta / self.num_changes
+            self.squared_change_deviation += delta * (change - self.mean_change)
+            self.balance = balance
+            self.peak = max(self.peak, balance)
+            self.drawdown = min(self.drawdown, (balance / self.peak - 1) * 100)
+        self.num_samples += count
+        self.end_time = end_time
+
+    def max_drawdown(self) -> float:
+        """Maximum drawdown in percent, as EquityCurve.max_drawdown."""
+        return self.drawdown
+
+    def sharpe_ratio(self, periods_per_year: int = 252) -> float:
+        """Annualized Sharpe ratio of the per-sample returns, as EquityCurve.sharpe_ratio."""
+        num_returns = self.num_samples - 1
+        if num_returns < 1:
+            return 0
+        mean = self.mean_change * self.num_changes / num_returns
+        if num_returns < 2:
+            return np.nan
+        num_zero = num_returns - self.num_changes
+        squared_deviation = (self.squared_change_deviation
+                             + self.num_changes * (self.mean_change - mean) ** 2 + num_zero * mean ** 2)
+        std = np.sqrt(squared_deviation / (num_returns - 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.float64(mean) / std * np.sqrt(periods_per_year)
+
+    def checkpoint(self):
+        return (self.num_samples, self.end_time, self.balance, self.peak, self.drawdown,
+                self.num_changes, self.mean_change, self.squared_change_deviation)
+
+    def rollback(self, checkpoint):
+        (self.num_samples, self.end_time, self.balance, self.peak, self.drawdown,
+         self.num_changes, self.mean_change, self.squared_change_deviation) = checkpoint
+
+
+class MarkToMarketEquity:
+    """
+    Equity per sample including the unrealized PnL of the open position and counter trade.
+    
+    Sampled like EquityCurve (the first candle, then every candle from the end
+    of the first detection window), but valued at each candle's close after
+    its events, so drawdown while a leveraged position is underwater shows up.
+    """
+
+    def __init__(self, times: np.ndarray, equity: np.ndarray):
+        self.times = times
+        self.equity = equity
+
+    def __len__(self):
+        return len(self.equity)
+
+    def max_drawdown(self) -> float:
+        """Maximum drawdown in percent."""
+        if not len(self.equity):
+            return 0
+        drawdown = (self.equity / np.maximum.accumulate(self.equity) - 1) * 100
+        return drawdown.min()
+
+    def sharpe_ratio(self, periods_per_year: int = 252) -> float:
+        """Annualized Sharpe ratio of the per-sample returns."""
+        returns = self.equity[1:] / self.equity[:-1] - 1
+        if len(returns) < 1:
+            return 0
+        if len(returns) < 2:
+            return np.nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return returns.mean() / returns.std(ddof=1) * np.sqrt(periods_per_year)
+
+    def to_series(self) -> pd.Series:
+        return pd.Series(self.equity, index=pd.to_datetime(self.times, unit='ns'), name='equity')
+
+
+def _unrealized_pnl(num_candles: int, close_prices: np.ndarray, interval_starts: np.ndarray,
+                    interval_stops: np.ndarray, segment_starts: np.ndarray, margins: np.ndarray,
+                    entry_prices: np.ndarray, directions: np.ndarray, leverage: float) -> np.ndarray:
+    """
+    Unrealized PnL per candle of non-overlapping positions.
+    
+    A position is held over candle indices [interval_starts[k], interval_stops[k]);
+    its exposure changes at segment_starts (sorted), each segment carrying the
+    margin, entry price and direction in force from that candle on. Segment and
+    interval ids per candle come from a difference array and a cumulative sum.
+    """
+    pnl = np.zeros(num_candles)
+    if not len(interval_starts):
+        return pnl
+    candles = np.arange(num_candles)
+    interval = np.bincount(interval_starts, minlength=num_candles)[:num_candles].cumsum() - 1
+    held = interval >= 0
+    held[held] = candles[held] < interval_stops[interval[held]]
+    segment = (np.bincount(segment_starts, minlength=num_candles)[:num_candles].cumsum() - 1)[held]
+    
+    # Same operations as _backtest_close_position, so a close at a candle's price realizes exactly this
+    prices, entry_prices = close_prices[held], entry_prices[segment]
+    price_change = np.where(directions[segment] == 0, prices - entry_prices, entry_prices - prices)
+    pnl_percentage = (price_change / entry_prices) * 100 * leverage
+    pnl[held] = margins[segment] * (pnl_percentage / 100)
+    return pnl
+
+
+def mark_to_market_equity(results: dict, historical_data) -> MarkToMarketEquity:
+    """
+    Mark-to-market equity of a single-position backtest in one vectorized pass.
+    
+    Position intervals are rebuilt from the trade, margin and counter-trade
+    logs: each main position holds its opening margin, then the total after
+    every margin addition, from its open to its close; counter trades hold
+    their margin from open to close. Realized balance comes from the equity curve.
+    
+    Parameters:
+    - results: run_backtest results with full logs (not lean_backtest)
+    - historical_data: The candles the backtest ran on, sorted by time
+    
+    Returns:
+    - MarkToMarketEquity with one value per equity sample
+    """
+    if not isinstance(results['trade_history'], TradeLog) or 'symbols' in results:
+        raise ValueError("Mark-to-market equity needs the full logs of a single-position backtest")
+    data = MarketData.coerce(historical_data)
+    times, close_prices = data.times, np.asarray(data.close, dtype=np.float64)
+    if np.any(np.diff(times) < 0):
+        raise ValueError("Mark-to-market equity needs candles sorted by time")
+    num_candles = len(times)
+    leverage = results['parameters']['leverage']
+    period = results['parameters']['detection_period_minutes']
+    
+    trades = results['trade_history'].array
+    opens = trades[trades['action'] == 0]
+    closes = trades[trades['action'] == 1]
+    counter_closes = trades[trades['action'] == 2]
+    additions = results['margin_additions'].array
+    counters = results['counter_trades'].array
+    
+    def candle_index(event_times):
+        return np.searchsorted(times, event_times)
+    
+    def interval_stops(starts, stop_times):
+        # A position still open (e.g. from evaluate_backtest state) runs to the end
+        stops = np.full(len(starts), num_candles)
+        stops[:len(stop_times)] = candle_index(stop_times)
+        return stops
+    
+    open_index = candle_index(opens['time'])
+    addition_index = candle_index(additions['time'])
+    owner = np.searchsorted(open_index, addition_index, side='right') - 1
+    segment_starts = np.concatenate([open_index, addition_index])
+    order = np.argsort(segment_starts, kind='stable')
+    main_pnl = _unrealized_pnl(
+        num_candles, close_prices, open_index, interval_stops(open_index, closes['time']),
+        segment_starts[order],
+        np.concatenate([opens['margin'], additions['total_margin']])[order],
+        np.concatenate([opens['price'], opens['price'][owner]])[order],
+        np.concatenate([opens['direction'], opens['direction'][owner]])[order], leverage)
+    
+    counter_index = candle_index(counters['time'])
+    counter_pnl = _unrealized_pnl(
+        num_candles, close_prices, counter_index, interval_stops(counter_index, counter_closes['time']),
+        counter_index, counters['margin'], counters['price'], counters['direction'], leverage)
+    
+    # Balance after each candle's events is the balance sampled at the next candle
+    realized = np.append(results['equity_curve'].expand(times).to_numpy()[1:], results['final_balance'])
+    equity = realized + main_pnl + counter_pnl
+    
+    samples = np.concatenate([[0], np.arange(period, num_candles)]) if num_candles > period else np.array([0])
+    return MarkToMarketEquity(times[samples], equity[samples])
+
+
+RESULTS_SUMMARY_FILE = 'summary.json'
+RESULT_LOG_CLASSES = {cls.__name__: cls for cls in (TradeLog, MarginLog, CounterTradeLog, EquityCurve)}
+MTM_DTYPE = np.dtype([('time', 'i8'), ('equity', 'f8')])
+
+
+def _json_default(value):
+    """Encode the NumPy values found in results dicts."""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Cannot serialize {type(value).__name__} in backtest results")
+
+
+def save_backtest_results(results: dict, directory: str):
+    """
+    Write backtest results as one .npy file per log plus a small JSON summary.
+    
+    Every log is stored as its structured array, so thousands of runs take
+    little space and load_backtest_results maps them back without parsing.
+    Lean results keep no logs, so only their summary is written. Tables such
+    as the profile are stored in the summary and rebuilt as DataFrames.
+    
+    Parameters:
+    - results: Results dict returned by run_backtest
+    - directory: Directory to write, created if missing
+    """
+    os.makedirs(directory, exist_ok=True)
+    summary, logs, tables = {}, {}, {}
+    for key, value in results.items():
+        if isinstance(value, pd.DataFrame):
+            tables[key] = {'index_name': value.index.name, **value.to_dict('split')}
+        elif isinstance(value, ColumnarLog):
+            np.save(os.path.join(directory, f'{key}.npy'), value.array)
+            logs[key] = {'class': type(value).__name__, **value._metadata()}
+        elif isinstance(value, MarkToMarketEquity):
+            array = np.empty(len(value), dtype=MTM_DTYPE)
+            array['time'], array['equity'] = value.times, value.equity
+            np.save(os.path.join(directory, f'{key}.npy'), array)
+            logs[key] = {'class': MarkToMarketEquity.__name__}
+        elif not isinstance(value, (TradeStats, NullLog, EquityStats)):
+            summary[key] = value
+    with open(os.path.join(directory, RESULTS_SUMMARY_FILE), 'w') as f:
+        json.dump({'results': summary, 'logs': logs, 'tables': tables}, f, default=_json_default)
+
+
+def load_backtest_results(directory: str, mmap_mode: str = 'r') -> dict:
+    """
+    Open results written by save_backtest_results.
+    
+    Parameters:
+    - directory: Results directory
+    - mmap_mode: np.load mmap_mode; 'r' maps the logs read-only, None reads them into memory
+    
+    Returns:
+    - Results dict with the same keys and log types as run_backtest returned
+    """
+    with open(os.path.join(directory, RESULTS_SUMMARY_FILE)) as f:
+        saved = json.load(f)
+    results = saved['results']
+    for key, metadata in saved['logs'].items():
+        array = np.load(os.path.join(directory, f'{key}.npy'), mmap_mode=mmap_mode)
+        if metadata['class'] == MarkToMarketEquity.__name__:
+            results[key] = MarkToMarketEquity(array['time'], array['equity'])
+        else:
+            results[key] = RESULT_LOG_CLASSES[metadata['class']].from_array(array, metadata)
+    for key, table in saved.get('tables', {}).items():
+        results[key] = pd.DataFrame(table['data'], index=pd.Index(table['index'], name=table['index_name']),
+                                    columns=table['columns'])
+    return results
+
+
+def _coerce_results(results) -> dict:
+    """Accept a results dict or a directory written by save_backtest_results."""
+    if isinstance(results, (str, os.PathLike)):
+        return load_backtest_results(results)
+    return results
+
+
+def _trade_analytics(results):
+    """Cached backtest_analytics.TradeAnalytics of results."""
+    # backtest_analytics builds on this module, so it is imported when first needed
+    from backtest_analytics import trade_analytics
+    return trade_analytics(results)
+
+
+def minmax_downsample(values: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Indices of at most about max_points samples that keep every bucket's extremes.
+    
+    The series is cut into max_points / 4 equal buckets, and the first, last,
+    lowest and highest sample of each is kept, so peaks and troughs (and hence
+    the drawdown) look the same as in the full series.
+    
+    Returns:
+    - Sorted int64 indices into values
+    """
+    num_values = len(values)
+    if num_values <= max_points:
+        return np.arange(num_values)
+    bucket_size = -(-num_values // max(max_points // 4, 1))
+    num_buckets = -(-num_values // bucket_size)
+    padded = np.full(num_buckets * bucket_size, np.nan)
+    padded[:num_values] = values
+    padded = padded.reshape(num_buckets, bucket_size)
+    starts = np.arange(num_buckets) * bucket_size
+    
+    return np.unique(np.concatenate([
+        starts,
+        np.minimum(starts + bucket_size - 1, num_values - 1),
+        starts + np.nanargmin(padded, axis=1),
+        starts + np.nanargmax(padded, axis=1),
+    ]))
+
+
+def lttb_downsample(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Indices of max_points samples chosen with Largest-Triangle-Three-Buckets.
+    
+    Keeps the first and last sample and, from each bucket in between, the one
+    forming the largest triangle with the previously kept sample and the mean
+    of the next bucket. Bucket means are computed in one pass; the selection
+    loops over buckets, not samples.
+    
+    Returns:
+    - Sorted int64 indices into x and y
+    """
+    num_values = len(y)
+    if num_values <= max_points or max_points < 3:
+        return np.arange(num_values)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    
+    # max_points - 2 buckets over the samples between the first and the last
+    edges = np.linspace(1, num_values - 1, max_points - 1).astype(np.int64)
+    counts = np.diff(edges)
+    mean_x = np.append(np.add.reduceat(x[:edges[-1]], edges[:-1]) / counts, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:edges[-1]], edges[:-1]) / counts, y[-1])
+    
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, num_values - 1
+    previous = 0
+    for bucket in range(max_points - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_x, next_y = mean_x[bucket + 1], mean_y[bucket + 1]
+        area = np.abs((x[previous] - next_x) * (y[start:stop] - y[previous])
+                      - (x[previous] - x[start:stop]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def downsample_indices(times: np.ndarray, values: np.ndarray, max_points: int = None,
+                       method: str = 'minmax') -> np.ndarray:
+    """Indices of the samples to plot: all of them, or 'minmax' or 'lttb' downsampling to max_points."""
+    if not max_points or method is None:
+        return np.arange(len(values))
+    if method == 'minmax':
+        return minmax_downsample(values, max_points)
+    if method == 'lttb':
+        return lttb_downsample(times, values, max_points)
+    raise ValueError(f"Unknown downsampling method: {method}")
+
+
+def _new_figure(figsize: Tuple[float, float], show: bool):
+    """
+    Figure to plot on: a pyplot figure to show, or a standalone Figure otherwise.
+    
+    A standalone Figure is not managed by pyplot and renders with Agg
+    whatever backend is active, so headless plotting needs no backend switch
+    and leaves no figures open.
+    """
+    return plt.figure(figsize=figsize) if show else Figure(figsize=figsize)
+
+
+def _finish_figure(fig, save_path: str = None, show: bool = True):
+    """Save the figure if save_path is given, then show it if it is a pyplot figure to show."""
+    if save_path:
+        fig.savefig(save_path)
+    if show:
+        plt.show()
+
+
+# Bot methods timed by BacktestProfiler, grouped into backtest stages
+PROFILED_STAGES = {
+    '_set_backtest_data': 'signal_detection',
+    'advance_backtest': 'candle_loop',
+    '_position_bucket_mask': 'barrier_search',
+    '_find_next_position_event': 'barrier_search',
+    '_backtest_check_position': 'check_position',
+    '_backtest_check_position_intrabar': 'check_position',
+    '_backtest_open_position': 'open_position',
+    '_backtest_add_margin': 'margin_ladder',
+    '_backtest_manage_counter_trade': 'counter_trade',
+    '_backtest_open_counter_trade': 'counter_trade',
+    '_backtest_close_counter_trade': 'counter_trade',
+    '_backtest_close_position': 'close_position',
+    '_calculate_backtest_results': 'results',
+}
+
+
+class BacktestProfiler:
+    """
+    Call counts and wall time per backtest stage.
+    
+    install() replaces the methods listed in PROFILED_STAGES on one bot
+    instance with timing wrappers, so bots without a profiler run the plain
+    class methods at no cost. Total time includes nested stages (a close
+    inside check_position), own time excludes them, so own times add up to
+    the instrumented part of the run.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = dict.fromkeys(PROFILED_STAGES.values(), 0)
+        self.total_seconds = dict.fromkeys(self.calls, 0.0)
+        self.own_seconds = dict.fromkeys(self.calls, 0.0)
+        self._child_seconds = []  # time spent in nested stages, one entry per open call
+        self._started = time.perf_counter()
+
+    def install(self, bot: 'CryptoTradingBot'):
+        """Wrap the profiled methods of bot in place."""
+        for name, stage in PROFILED_STAGES.items():
+            setattr(bot, name, self._wrap(stage, getattr(bot, name)))
+
+    def _wrap(self, stage: str, method):
+        perf_counter = time.perf_counter
+        child_seconds = self._child_seconds
+
+        @functools.wraps(method)
+        def profiled(*args, **kwargs):
+            child_seconds.append(0.0)
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                self.calls[stage] += 1
+                self.total_seconds[stage] += elapsed
+                self.own_seconds[stage] += elapsed - child_seconds.pop()
+                if child_seconds:
+                    child_seconds[-1] += elapsed
+        return profiled
+
+    def table(self) -> pd.DataFrame:
+        """Profile of the stages called since the last reset, by own time."""
+        wall_seconds = time.perf_counter() - self._started
+        profile = pd.DataFrame({'calls': self.calls, 'total_seconds': self.total_seconds,
+                                'own_seconds': self.own_seconds})
+        profile = profile[profile['calls'] > 0]
+        profile['own_percentage'] = profile['own_seconds'] / wall_seconds * 100
+        profile.index.name = 'stage'
+        return profile.sort_values('own_seconds', ascending=False)
+
+
 class CryptoTradingBot:
     def __init__(self, 
                  api_key: str = None, 
@@ -41,7 +1579,11 @@ class CryptoTradingBot:
                  position_direction: str = "SHORT",
                  detection_period_minutes: int = 45,
                  pump_dump_threshold: float = 7.0,
-                 backtest_mode: bool = False):
+                 backtest_mode: bool = False,
+                 intrabar_fills: bool = False,
+                 lean_backtest: bool = False,
+                 mark_to_market: bool = False,
+                 profile_backtest: bool = False):
         """
         Initialize the crypto trading bot with the specified parameters.
         
@@ -61,6 +1603,15 @@ class CryptoTradingBot:
         - detection_period_minutes: Period to detect pump/dump in minutes
         - pump_dump_threshold: Percentage change to trigger trade
         - backtest_mode: Whether to run in backtest mode
+        - intrabar_fills: In backtests, fill take profit and stop levels when a
+          candle's high/low touches them instead of checking the close only
+        - lean_backtest: Keep only streaming metric accumulators in backtests
+          instead of trade, margin, counter-trade and equity logs, and skip
+          per-event logging; results then hold the summary metrics only
+        - mark_to_market: Add mark-to-market equity, drawdown and Sharpe ratio,
+          including unrealized PnL, to run_backtest results
+        - profile_backtest: Count calls and time per backtest stage and add the
+          table to results as 'profile'
         """
         if not backtest_mode and (api_key is None or api_secret is None):
             raise ValueError("API key and secret are required for live trading")
@@ -96,16 +1647,25 @@ class CryptoTradingBot:
         # Coin detection parameters
         self.detection_period_minutes = detection_period_minutes
         self.pump_dump_threshold = pump_dump_threshold
+        self.intrabar_fills = intrabar_fills
+        self.lean_backtest = lean_backtest
+        self.mark_to_market = mark_to_market
         
         # Internal state
         self.active_position = None
         self.counter_trade_position = None
+        self.signal_cache = signal_cache
         
         # For backtesting
-        self.trade_history = []
-        self.equity_curve = []
-        self.margin_additions = []
-        self.counter_trades = []
+        self.trade_history = TradeLog()
+        self.equity_curve = EquityCurve()
+        self.margin_additions = MarginLog()
+        self.counter_trades = CounterTradeLog()
+        self._log_events = logger.isEnabledFor(logging.DEBUG)
+        self.profiler = None
+        if profile_backtest:
+            self.profiler = BacktestProfiler()
+            self.profiler.install(self)
         
         # Validate margin increase percentages
         if not backtest_mode:
@@ -118,18 +1678,10 @@ class CryptoTradingBot:
     
     def _validate_margin_percentages(self):
         """Validate that margin increase percentages sum up correctly to match TKM."""
-        # Initial entry percentage
-        total_used = self.entry_price_percentage
-        
-        # Calculate how much each margin addition contributes
-        current_margin = self.entry_price_percentage
-        for increase_percentage in self.margin_increase_levels:
-            margin_addition = current_margin * (increase_percentage / 100)
-            total_used += margin_addition
-            current_margin += margin_addition
+        total_used = ladder_total_margin(self.entry_price_percentage, self.margin_increase_levels)
         
         # Check if total matches TKM (with small tolerance for floating point errors)
-        if abs(total_used - self.tkm_percentage) > 0.01:
+        if abs(total_used - self.tkm_percentage) > MARGIN_TOLERANCE:
             error_msg = (f"Margin percentages do not add up to TKM. "
                         f"Total used: {total_used}%, TKM: {self.tkm_percentage}%")
             logger.error(error_msg)
@@ -153,17 +1705,60 @@ class CryptoTradingBot:
             logger.error(f"Error checking hedge mode: {e}")
             
     # Backtest methods
-    def run_backtest(self, historical_data: pd.DataFrame, config: dict = None) -> dict:
+    def run_backtest(self, historical_data, config: dict = None,
+                     event_driven: bool = True, snapshot_path: str = None,
+                     profile_path: str = None) -> dict:
         """
         Run a backtest using historical data.
         
         Parameters:
-        - historical_data: DataFrame with OHLCV data
+        - historical_data: DataFrame with OHLCV data, MarketData columns or a MarketData.save() directory
+          (sweeps should pass MarketData; see MarketData.coerce)
         - config: Optional config to override instance parameters
+        - event_driven: Jump straight to the next candle that can change an open
+          position instead of checking it on every candle
+        - snapshot_path: Save the state before the final close here, so
+          resume_backtest can continue on candles appended later
+        - profile_path: Run under cProfile and dump the pstats file here
         
         Returns:
         - dict with backtest results
         """
+        if profile_path:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(self.run_backtest, historical_data, config, event_driven, snapshot_path)
+            finally:
+                profile.dump_stats(profile_path)
+                logger.info(f"Backtest profile saved to {profile_path}")
+        
+        self.start_backtest(historical_data, config)
+        self.advance_backtest(event_driven=event_driven)
+        if snapshot_path:
+            self.save_backtest_snapshot(snapshot_path)
+        results = self.finish_backtest()
+        
+        if self.mark_to_market and not self.lean_backtest:
+            mtm_equity = mark_to_market_equity(results, self._backtest_data)
+            results.update({'mtm_equity': mtm_equity, 'mtm_max_drawdown': mtm_equity.max_drawdown(),
+                            'mtm_sharpe_ratio': mtm_equity.sharpe_ratio()})
+        return results
+    
+    def start_backtest(self, historical_data, config: dict = None):
+        """
+        Reset the backtest state and prepare the candles without processing any of them.
+        
+        Use advance_backtest to process candles in steps and finish_backtest to
+        close out and get results; run_backtest does all three at once.
+        """
+        self._reset_backtest(config)
+        self._set_backtest_data(historical_data)
+        self.equity_curve.record(self._backtest_data.times[0], self._backtest_data.times[0],
+                                 self.current_balance)
+        self._backtest_cursor = self.detection_period_minutes
+    
+    def _reset_backtest(self, config: dict = None):
+        """Apply config overrides and clear positions, balance and logs."""
         if config:
             # Override instance parameters with provided config
             for key, value in config.items():
@@ -176,52 +1771,261 @@ class CryptoTradingBot:
         self.active_position = None
         self.counter_trade_position = None
         self.current_balance = self.total_balance
-        self.trade_history = []
-        self.equity_curve = [{"timestamp": historical_data.index[0], "balance": self.current_balance}]
-        self.margin_additions = []
-        self.counter_trades = []
-        
-        # Process each candle
-        for i in range(self.detection_period_minutes, len(historical_data)):
-            # Current candle
-            current_time = historical_data.index[i]
-            current_price = historical_data.iloc[i]['close']
-            
-            # Record equity for this timestamp
-            self.equity_curve.append({
-                "timestamp": current_time,
-                "balance": self.current_balance
-            })
-            
-            # If we have an active position, check it
+        if self.lean_backtest:
+            self.trade_history = TradeStats()
+            self.margin_additions = NullLog()
+            self.counter_trades = NullLog()
+            self.equity_curve = EquityStats()
+        else:
+            self.trade_history = TradeLog()
+            self.margin_additions = MarginLog()
+            self.counter_trades = CounterTradeLog()
+            self.equity_curve = EquityCurve()
+        # Formatting debug messages for every event is measurable in long backtests
+        self._log_events = not self.lean_backtest and logger.isEnabledFor(logging.DEBUG)
+        if self.profiler is not None:
+            self.profiler.reset()
+    
+    def run_backtest_stream(self, chunks, config: dict = None, event_driven: bool = True,
+                            snapshot_path: str = None) -> dict:
+        """
+        Run a backtest over an iterator of consecutive candle chunks.
+        
+        Positions, balance, logs and the trailing detection window carry over
+        between chunks, so memory is bounded by the chunk size rather than the
+        history length, and the results match run_backtest on the joined data.
+        
+        Parameters:
+        - chunks: Iterable of DataFrames, MarketData or dataset directories, e.g.
+          MarketData.chunks() or OHLCVStore.iter_chunks()
+        - config: Optional config to override instance parameters
+        - event_driven: Jump straight to the next candle that can change an open position
+        - snapshot_path: Save the state before the final close, as in run_backtest
+        
+        Returns:
+        - dict with backtest results
+        """
+        self.start_backtest_stream(config)
+        for chunk in chunks:
+            self.feed_backtest(chunk, event_driven=event_driven)
+        if self._backtest_data is None:
+            raise ValueError("No candles to backtest")
+        if snapshot_path:
+            self.save_backtest_snapshot(snapshot_path)
+        return self.finish_backtest()
+    
+    def save_backtest_snapshot(self, path: str):
+        """
+        Write the state of the backtest in progress to path.
+        
+        The snapshot holds the parameters, positions, balance, logs and the
+        trailing detection window, so it must be taken before finish_backtest
+        closes the open position.
+        """
+        keep_from = max(0, self._backtest_cursor - max(self.detection_period_minutes, 1))
+        state = self.get_backtest_state()
+        state.cursor -= keep_from
+        snapshot = {'state': state, 'window': self._backtest_data.slice(keep_from, copy=True)}
+        
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    
+    def resume_backtest(self, snapshot_path: str, new_data, event_driven: bool = True,
+                        save_snapshot: bool = True) -> dict:
+        """
+        Continue a saved backtest on candles appended after it, e.g. in a nightly job.
+        
+        Runs in time proportional to the new candles only. Leading candles of
+        new_data that the snapshot already covers are skipped, which assumes
+        new_data is ordered by time.
+        
+        Parameters:
+        - snapshot_path: Snapshot written by run_backtest or save_backtest_snapshot
+        - new_data: Appended candles (DataFrame, MarketData or dataset directory)
+        - event_driven: Jump straight to the next candle that can change an open position
+        - save_snapshot: Replace the snapshot with the state after the new candles
+        
+        Returns:
+        - dict with backtest results over the whole history
+        """
+        with open(snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+        snapshot['state'].restore(self)
+        window = snapshot['window']
+        self._backtest_data = window
+        
+        new_data = MarketData.coerce(new_data)
+        if len(window) and self._backtest_cursor > 0:
+            last_time = window.times[min(self._backtest_cursor, len(window)) - 1]
+            new_data = new_data.slice(np.searchsorted(new_data.times, last_time, side='right'))
+        self.feed_backtest(new_data, event_driven=event_driven)
+        
+        if save_snapshot:
+            self.save_backtest_snapshot(snapshot_path)
+        return self.finish_backtest()
+    
+    def start_backtest_stream(self, config: dict = None):
+        """Reset the backtest state for candles that arrive through feed_backtest."""
+        self._reset_backtest(config)
+        self._backtest_data = None
+        self._backtest_cursor = self.detection_period_minutes
+    
+    def feed_backtest(self, chunk, event_driven: bool = True):
+        """
+        Process the next chunk of candles of a streamed backtest.
+        
+        Only the last detection_period_minutes processed candles (plus any not
+        processed yet) are kept afterwards, as the window for the next chunk.
+        """
+        chunk = MarketData.coerce(chunk)
+        if not len(chunk):
+            return
+        if self._backtest_data is None:
+            window = chunk
+            self.equity_curve.record(chunk.times[0], chunk.times[0], self.current_balance)
+        else:
+            window = MarketData.concatenate([self._backtest_data, chunk])
+        
+        # Every window is seen once, so caching its signals would only evict useful entries
+        self._set_backtest_data(window, use_cache=False)
+        self.advance_backtest(event_driven=event_driven)
+        
+        keep_from = max(0, self._backtest_cursor - max(self.detection_period_minutes, 1))
+        self._backtest_data = window.slice(keep_from, copy=True)
+        self._backtest_cursor -= keep_from
+    
+    def _set_backtest_data(self, historical_data, use_cache: bool = True):
+        """Convert the candles to columns and precompute entry signals once instead of per candle."""
+        historical_data = MarketData.coerce(historical_data)
+        self._backtest_data = historical_data
+        
+        if use_cache and self.signal_cache is not None:
+            self._entry_indices = self.signal_cache.entry_indices(
+                historical_data, self.detection_period_minutes,
+                self.position_direction, self.pump_dump_threshold)
+        else:
+            _, entry_mask = self._compute_entry_signals(historical_data.close)
+            self._entry_indices = np.flatnonzero(entry_mask)
+    
+    def advance_backtest(self, stop: int = None, event_driven: bool = True):
+        """
+        Process candles from the current cursor up to (not including) stop.
+        
+        Parameters:
+        - stop: Candle index to stop at (defaults to the end of the data)
+        - event_driven: Jump straight to the next candle that can change an open
+          position instead of checking it on every candle
+        """
+        historical_data = self._backtest_data
+        times = historical_data.times
+        close_prices = historical_data.close
+        entry_indices = self._entry_indices
+        num_candles = len(historical_data) if stop is None else min(stop, len(historical_data))
+        pyramid = None
+        
+        # Only visit candles where an entry is possible or a position is open
+        i = self._backtest_cursor
+        while i < num_candles:
             if self.active_position:
-                self._backtest_check_position(current_time, current_price)
-            else:
-                # Check for entry signal
-                detection_window = historical_data.iloc[i-self.detection_period_minutes:i]
-                start_price = detection_window.iloc[0]['close']
-                end_price = detection_window.iloc[-1]['close']
+                if event_driven:
+                    # Nothing happens until a barrier is hit, so skip to that candle
+                    if pyramid is None:
+                        pyramid = historical_data.price_pyramid(self.intrabar_fills)
+                    next_event = pyramid.find_first(self._position_bucket_mask, i, num_candles)
+                    last = min(next_event, num_candles - 1)
+                    self.equity_curve.record(times[i], times[last], self.current_balance, last - i + 1)
+                    if next_event >= num_candles:
+                        i = num_candles
+                        break
+                    i = next_event
+                else:
+                    # Record equity for this timestamp
+                    self.equity_curve.record(times[i], times[i], self.current_balance)
                 
-                change_percentage = ((end_price - start_price) / start_price) * 100
-                
-                # For LONG positions, look for coins that have dumped
-                if self.position_direction == "LONG" and change_percentage <= -self.pump_dump_threshold:
-                    self._backtest_open_position(current_time, current_price, historical_data.iloc[i]['symbol'])
-                    
-                # For SHORT positions, look for coins that have pumped
-                elif self.position_direction == "SHORT" and change_percentage >= self.pump_dump_threshold:
-                    self._backtest_open_position(current_time, current_price, historical_data.iloc[i]['symbol'])
-        
-        # Close any open position at the end
-        if self.active_position:
-            final_price = historical_data.iloc[-1]['close']
-            self._backtest_close_position(historical_data.index[-1], final_price, "end_of_backtest")
+                if self.intrabar_fills:
+                    self._backtest_check_position_intrabar(times[i], historical_data.open[i], historical_data.high[i],
+                                                           historical_data.low[i], close_prices[i])
+                else:
+                    self._backtest_check_position(times[i], close_prices[i])
+                i += 1
+                continue
+            
+            # Jump to the next candle with an entry signal
+            k = np.searchsorted(entry_indices, i)
+            next_entry = entry_indices[k] if k < len(entry_indices) else num_candles
+            
+            # Balance cannot change while flat, so record the skipped candles in bulk
+            last = min(next_entry, num_candles - 1)
+            self.equity_curve.record(times[i], times[last], self.current_balance, last - i + 1)
+            if next_entry >= num_candles:
+                i = num_candles
+                break
+            
+            self._backtest_open_position(times[next_entry], close_prices[next_entry],
+                                        historical_data.symbol_at(next_entry))
+            i = next_entry + 1
+        
+        self._backtest_cursor = max(i, self._backtest_cursor)
+    
+    def finish_backtest(self) -> dict:
+        """Close any open position at the last processed candle and calculate results."""
+        self._backtest_close_at_cursor()
         
         # Calculate backtest results
         results = self._calculate_backtest_results()
+        if self.profiler is not None:
+            results['profile'] = self.profiler.table()
         
         return results
     
+    def _backtest_close_at_cursor(self):
+        """Close the open position at the close of the last processed candle."""
+        if self.active_position:
+            last = min(self._backtest_cursor, len(self._backtest_data)) - 1
+            final_price = self._backtest_data.close[last]
+            self._backtest_close_position(self._backtest_data.times[last], final_price, "end_of_backtest")
+    
+    def evaluate_backtest(self) -> dict:
+        """
+        Summary metrics as if the backtest ended at the current cursor.
+        
+        The open position is closed on a snapshot only, so the backtest can
+        continue with advance_backtest afterwards.
+        
+        Returns:
+        - dict with the SUMMARY_METRICS of _calculate_backtest_results
+        """
+        state = self.get_backtest_state()
+        self._backtest_close_at_cursor()
+        results = self._calculate_backtest_results()
+        summary = {key: results[key] for key in SUMMARY_METRICS}
+        self.set_backtest_state(state)
+        return summary
+    
+    def get_backtest_state(self) -> 'BacktestState':
+        """Capture the backtest state so it can be resumed later with set_backtest_state."""
+        return BacktestState(self)
+    
+    def set_backtest_state(self, state: 'BacktestState', historical_data=None):
+        """
+        Restore a state captured with get_backtest_state.
+        
+        Parameters:
+        - state: Saved backtest state
+        - historical_data: Candles to continue on; required when the bot has not
+          been backtesting on the same data already
+        """
+        state.restore(self)
+        if historical_data is not None:
+            self._set_backtest_data(historical_data)
+    
+    def _compute_entry_signals(self, close_prices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Detection-window change series and entry mask for the current parameters."""
+        return compute_entry_signals(close_prices, self.detection_period_minutes,
+                                     self.position_direction, self.pump_dump_threshold)
+    
     def _backtest_open_position(self, timestamp, price, symbol):
         """Open a position in backtest mode."""
         # Calculate quantity based on entry percentage and leverage
@@ -229,16 +2033,16 @@ class CryptoTradingBot:
         quantity = (initial_margin * self.leverage) / price
         
         # Store position information
-        self.active_position = {
-            'coin': symbol,
-            'entry_time': timestamp,
-            'entry_price': price,
-            'quantity': quantity,
-            'direction': self.position_direction,
-            'current_margin': initial_margin,
-            'margin_level': 0,  # Starting at level 0
-            'total_margin_used': self.entry_price_percentage  # Track total margin percentage used
-        }
+        self.active_position = BacktestPosition(
+            coin=symbol,
+            entry_time=timestamp,
+            entry_price=price,
+            quantity=quantity,
+            direction=self.position_direction,
+            current_margin=initial_margin,
+            margin_level=0,  # Starting at level 0
+            total_margin_used=self.entry_price_percentage  # Track total margin percentage used
+        )
         
         # Calculate take profit and stop loss
         effective_tp_percentage = self.take_profit_roi / self.leverage
@@ -251,33 +2055,26 @@ class CryptoTradingBot:
             take_profit_price = price * (1 - effective_tp_percentage / 100)
             stop_loss_price = price * (1 + effective_sl_percentage / 100)
             
-        self.active_position['take_profit_price'] = take_profit_price
-        self.active_position['stop_loss_price'] = stop_loss_price
+        self.active_position.take_profit_price = take_profit_price
+        self.active_position.stop_loss_price = stop_loss_price
         
         # Log trade
-        trade_log = {
-            'action': 'open',
-            'time': timestamp,
-            'coin': symbol,
-            'direction': self.position_direction,
-            'price': price,
-            'quantity': quantity,
-            'margin': initial_margin
-        }
-        self.trade_history.append(trade_log)
+        self.trade_history.record_open(timestamp, symbol, self.position_direction,
+                                       price, quantity, initial_margin)
         
-        logger.debug(f"Backtest: Opened {self.position_direction} position at {price}")
+        if self._log_events:
+            logger.debug(f"Backtest: Opened {self.position_direction} position at {price}")
     
     def _backtest_add_margin(self, timestamp, price):
         """Add margin in backtest mode."""
-        current_level = self.active_position['margin_level']
+        current_level = self.active_position.margin_level
         
         # Check if we've already used all margin levels
         if current_level >= len(self.margin_increase_levels):
             return False
             
         # Calculate additional margin
-        current_margin = self.active_position['current_margin']
+        current_margin = self.active_position.current_margin
         margin_increase_percentage = self.margin_increase_levels[current_level]
         additional_margin = current_margin * (margin_increase_percentage / 100)
         
@@ -288,35 +2085,30 @@ class CryptoTradingBot:
         additional_quantity = (additional_margin * self.leverage) / price
         
         # Update position information
-        self.active_position['quantity'] += additional_quantity
-        self.active_position['current_margin'] = new_total_margin
-        self.active_position['margin_level'] += 1
+        self.active_position.quantity += additional_quantity
+        self.active_position.current_margin = new_total_margin
+        self.active_position.margin_level += 1
         
         # Track total margin percentage used
         margin_percentage_added = (additional_margin / self.total_balance) * 100
-        self.active_position['total_margin_used'] += margin_percentage_added
+        self.active_position.total_margin_used += margin_percentage_added
         
         # Update stop loss level for the next margin level
-        if self.active_position['margin_level'] < len(self.margin_loss_roi_levels):
-            next_roi = self.margin_loss_roi_levels[self.active_position['margin_level']]
+        if self.active_position.margin_level < len(self.margin_loss_roi_levels):
+            next_roi = self.margin_loss_roi_levels[self.active_position.margin_level]
             effective_sl_percentage = next_roi / self.leverage
             
-            if self.active_position['direction'] == "LONG":
-                self.active_position['stop_loss_price'] = self.active_position['entry_price'] * (1 - effective_sl_percentage / 100)
+            if self.active_position.direction == "LONG":
+                self.active_position.stop_loss_price = self.active_position.entry_price * (1 - effective_sl_percentage / 100)
             else:  # SHORT
-                self.active_position['stop_loss_price'] = self.active_position['entry_price'] * (1 + effective_sl_percentage / 100)
+                self.active_position.stop_loss_price = self.active_position.entry_price * (1 + effective_sl_percentage / 100)
         
         # Log margin addition
-        margin_log = {
-            'time': timestamp,
-            'level': self.active_position['margin_level'],
-            'amount': additional_margin,
-            'total_margin': new_total_margin,
-            'price': price
-        }
-        self.margin_additions.append(margin_log)
+        self.margin_additions.append((timestamp, self.active_position.margin_level,
+                                      additional_margin, new_total_margin, price))
         
-        logger.debug(f"Backtest: Added margin level {self.active_position['margin_level']} at {price}")
+        if self._log_events:
+            logger.debug(f"Backtest: Added margin level {self.active_position.margin_level} at {price}")
         return True
     
     def _backtest_open_counter_trade(self, timestamp, price):
@@ -331,28 +2123,23 @@ class CryptoTradingBot:
         quantity = (counter_margin * self.leverage) / price
         
         # Determine direction (opposite of original position)
-        counter_direction = "SHORT" if self.active_position['direction'] == "LONG" else "LONG"
+        counter_direction = "SHORT" if self.active_position.direction == "LONG" else "LONG"
         
         # Store counter position information
-        self.counter_trade_position = {
-            'entry_time': timestamp,
-            'entry_price': price,
-            'quantity': quantity,
-            'direction': counter_direction,
-            'margin': counter_margin
-        }
+        self.counter_trade_position = CounterTradePosition(
+            entry_time=timestamp,
+            entry_price=price,
+            quantity=quantity,
+            direction=counter_direction,
+            margin=counter_margin
+        )
         
         # Log counter trade
-        counter_log = {
-            'time': timestamp,
-            'direction': counter_direction,
-            'price': price,
-            'quantity': quantity,
-            'margin': counter_margin
-        }
-        self.counter_trades.append(counter_log)
+        self.counter_trades.append((timestamp, DIRECTIONS.index(counter_direction),
+                                    price, quantity, counter_margin))
         
-        logger.debug(f"Backtest: Opened counter trade {counter_direction} at {price}")
+        if self._log_events:
+            logger.debug(f"Backtest: Opened counter trade {counter_direction} at {price}")
         return True
     
     def _backtest_close_counter_trade(self, timestamp, price):
@@ -361,34 +2148,27 @@ class CryptoTradingBot:
             return False
             
         # Calculate profit/loss
-        entry_price = self.counter_trade_position['entry_price']
+        entry_price = self.counter_trade_position.entry_price
         
-        if self.counter_trade_position['direction'] == "LONG":
+        if self.counter_trade_position.direction == "LONG":
             pnl_percentage = ((price - entry_price) / entry_price) * 100 * self.leverage
-            pnl_amount = self.counter_trade_position['margin'] * (pnl_percentage / 100)
+            pnl_amount = self.counter_trade_position.margin * (pnl_percentage / 100)
         else:  # SHORT
             pnl_percentage = ((entry_price - price) / entry_price) * 100 * self.leverage
-            pnl_amount = self.counter_trade_position['margin'] * (pnl_percentage / 100)
+            pnl_amount = self.counter_trade_position.margin * (pnl_percentage / 100)
         
         # Update balance
         self.current_balance += pnl_amount
         
         # Log counter trade close
-        counter_close_log = {
-            'time': timestamp,
-            'action': 'close_counter',
-            'direction': self.counter_trade_position['direction'],
-            'open_price': entry_price,
-            'close_price': price,
-            'pnl_percentage': pnl_percentage,
-            'pnl_amount': pnl_amount
-        }
-        self.trade_history.append(counter_close_log)
+        self.trade_history.record_counter_close(timestamp, self.counter_trade_position.direction,
+                                                entry_price, price, pnl_percentage, pnl_amount)
         
         # Reset counter trade position
         self.counter_trade_position = None
         
-        logger.debug(f"Backtest: Closed counter trade at {price}, PnL: {pnl_percentage:.2f}%")
+        if self._log_events:
+            logger.debug(f"Backtest: Closed counter trade at {price}, PnL: {pnl_percentage:.2f}%")
         return True
     
     def _backtest_close_position(self, timestamp, price, reason):
@@ -401,36 +2181,29 @@ class CryptoTradingBot:
             self._backtest_close_counter_trade(timestamp, price)
         
         # Calculate profit/loss
-        entry_price = self.active_position['entry_price']
+        entry_price = self.active_position.entry_price
         
-        if self.active_position['direction'] == "LONG":
+        if self.active_position.direction == "LONG":
             pnl_percentage = ((price - entry_price) / entry_price) * 100 * self.leverage
-            pnl_amount = self.active_position['current_margin'] * (pnl_percentage / 100)
+            pnl_amount = self.active_position.current_margin * (pnl_percentage / 100)
         else:  # SHORT
             pnl_percentage = ((entry_price - price) / entry_price) * 100 * self.leverage
-            pnl_amount = self.active_position['current_margin'] * (pnl_percentage / 100)
+            pnl_amount = self.active_position.current_margin * (pnl_percentage / 100)
         
         # Update balance
         self.current_balance += pnl_amount
         
         # Log trade close
-        close_log = {
-            'time': timestamp,
-            'action': 'close',
-            'reason': reason,
-            'open_price': entry_price,
-            'close_price': price,
-            'pnl_percentage': pnl_percentage,
-            'pnl_amount': pnl_amount,
-            'margin_levels_used': self.active_position['margin_level'],
-            'total_margin_used': self.active_position['total_margin_used']
-        }
-        self.trade_history.append(close_log)
+        self.trade_history.record_close(timestamp, reason, entry_price, price, pnl_percentage, pnl_amount,
+                                        self.active_position.margin_level,
+                                        self.active_position.total_margin_used,
+                                        self.active_position.coin)
         
         # Reset position
         self.active_position = None
         
-        logger.debug(f"Backtest: Closed position at {price}, Reason: {reason}, PnL: {pnl_percentage:.2f}%")
+        if self._log_events:
+            logger.debug(f"Backtest: Closed position at {price}, Reason: {reason}, PnL: {pnl_percentage:.2f}%")
         return True
     
     def _backtest_check_position(self, timestamp, price):
@@ -439,31 +2212,138 @@ class CryptoTradingBot:
             return
             
         # Check take profit condition
-        if ((self.active_position['direction'] == "LONG" and price >= self.active_position['take_profit_price']) or
-            (self.active_position['direction'] == "SHORT" and price <= self.active_position['take_profit_price'])):
+        if ((self.active_position.direction == "LONG" and price >= self.active_position.take_profit_price) or
+            (self.active_position.direction == "SHORT" and price <= self.active_position.take_profit_price)):
             self._backtest_close_position(timestamp, price, "take_profit")
             return
             
         # Check stop loss condition
-        if ((self.active_position['direction'] == "LONG" and price <= self.active_position['stop_loss_price']) or
-            (self.active_position['direction'] == "SHORT" and price >= self.active_position['stop_loss_price'])):
+        if ((self.active_position.direction == "LONG" and price <= self.active_position.stop_loss_price) or
+            (self.active_position.direction == "SHORT" and price >= self.active_position.stop_loss_price)):
             
             # Check if we can add more margin
-            if self.active_position['margin_level'] < len(self.margin_increase_levels):
+            if self.active_position.margin_level < len(self.margin_increase_levels):
                 self._backtest_add_margin(timestamp, price)
             else:
                 # If all margin levels used, manage with counter trades
                 self._backtest_manage_counter_trade(timestamp, price)
     
+    def _backtest_check_position_intrabar(self, timestamp, open_price, high, low, close):
+        """
+        Check position in backtest mode against the candle's range instead of its close.
+        
+        The adverse extreme is assumed to come first: every stop level it
+        touches adds margin at the stop price (or at the open if the candle
+        gapped through it), and take profit is only filled at its price when
+        the stop was not touched. Counter trades, once all margin levels are
+        used, still follow the close.
+        """
+        position = self.active_position
+        if not position:
+            return
+        
+        if position.direction == "LONG":
+            adverse, favourable = low, high
+            stop_hit = lambda price: price <= position.stop_loss_price
+            take_profit_hit = lambda price: price >= position.take_profit_price
+        else:  # SHORT
+            adverse, favourable = high, low
+            stop_hit = lambda price: price >= position.stop_loss_price
+            take_profit_hit = lambda price: price <= position.take_profit_price
+        
+        stop_touched = stop_hit(adverse)
+        if stop_touched and position.margin_level < len(self.margin_increase_levels):
+            while position.margin_level < len(self.margin_increase_levels) and stop_hit(adverse):
+                fill_price = open_price if stop_hit(open_price) else position.stop_loss_price
+                self._backtest_add_margin(timestamp, fill_price)
+            return
+        
+        if not stop_touched and take_profit_hit(favourable):
+            fill_price = open_price if take_profit_hit(open_price) else position.take_profit_price
+            self._backtest_close_position(timestamp, fill_price, "take_profit")
+            return
+        
+        self._backtest_check_position(timestamp, close)
+    
+    def _position_event_mask(self, prices: np.ndarray) -> np.ndarray:
+        """
+        Vectorized version of the _backtest_check_position conditions.
+        
+        Marks every price at which checking the active position would change
+        state: take profit, the current stop level while margin levels remain,
+        and a crossing of the counter trade ROI threshold once they are used up.
+        """
+        return self._position_bucket_mask(prices, prices)
+    
+    def _position_bucket_mask(self, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+        """
+        Buckets whose price range [low, high] can change the state of the active position.
+        
+        Exact when low and high are the same price, so it is also the per-candle
+        check. For wider ranges it may flag a bucket in which nothing happens,
+        but it never misses one.
+        """
+        position = self.active_position
+        
+        if position.direction == "LONG":
+            adverse, favourable = low, high
+            take_profit_hit = favourable >= position.take_profit_price
+            stop_loss_hit = adverse <= position.stop_loss_price
+        else:  # SHORT
+            adverse, favourable = high, low
+            take_profit_hit = favourable <= position.take_profit_price
+            stop_loss_hit = adverse >= position.stop_loss_price
+        
+        if position.margin_level < len(self.margin_increase_levels):
+            return take_profit_hit | stop_loss_hit
+        
+        # All margin levels used: only a counter trade open/close changes state
+        entry_price = position.entry_price
+        if self.counter_trade_position:
+            # Closes once ROI falls back below the threshold, which the favourable extreme reaches first
+            prices = favourable
+        else:
+            prices = adverse
+        if position.direction == "LONG":
+            roi = ((entry_price - prices) / entry_price) * 100 * self.leverage
+        else:  # SHORT
+            roi = ((prices - entry_price) / entry_price) * 100 * self.leverage
+        
+        counter_trade_change = (roi >= self.counter_trade_loss_roi) != bool(self.counter_trade_position)
+        return take_profit_hit | (stop_loss_hit & counter_trade_change)
+    
+    def _find_next_position_event(self, close_prices: np.ndarray, start: int, stop: int = None) -> int:
+        """
+        Find the first candle in [start, stop) where the active position changes state.
+        
+        The remaining prices are searched in doubling blocks so that short holds
+        only scan a few candles while long holds need a handful of searches.
+        
+        Returns:
+        - index of the event candle, or stop if no barrier is hit
+        """
+        num_candles = len(close_prices) if stop is None else stop
+        block_size = 256
+        
+        while start < num_candles:
+            stop = min(start + block_size, num_candles)
+            hits = self._position_event_mask(close_prices[start:stop])
+            if hits.any():
+                return start + int(hits.argmax())
+            start = stop
+            block_size = min(block_size * 2, 1 << 16)
+        
+        return num_candles
+    
     def _backtest_manage_counter_trade(self, timestamp, price):
         """Manage counter trade in backtest mode."""
         if not self.active_position:
             return
             
         # Calculate current ROI (with leverage effect)
-        entry_price = self.active_position['entry_price']
+        entry_price = self.active_position.entry_price
         
-        if self.active_position['direction'] == "LONG":
+        if self.active_position.direction == "LONG":
             roi = ((entry_price - price) / entry_price) * 100 * self.leverage
         else:  # SHORT
             roi = ((price - entry_price) / entry_price) * 100 * self.leverage
@@ -480,15 +2360,8 @@ class CryptoTradingBot:
     
     def _calculate_backtest_results(self):
         """Calculate performance metrics from backtest."""
-        # Convert equity curve to DataFrame
-        equity_df = pd.DataFrame(self.equity_curve)
-        if not equity_df.empty:
-            equity_df.set_index('timestamp', inplace=True)
-        
         # Calculate trade statistics
-        total_trades = len([t for t in self.trade_history if t.get('action') == 'close'])
-        winning_trades = len([t for t in self.trade_history if t.get('action') == 'close' and t.get('pnl_amount', 0) > 0])
-        losing_trades = len([t for t in self.trade_history if t.get('action') == 'close' and t.get('pnl_amount', 0) <= 0])
+        total_trades, winning_trades, losing_trades = self.trade_history.trade_counts()
         
         win_rate = (winning_trades / total_trades * 100) if total_trades > 0 else 0
         
@@ -498,20 +2371,9 @@ class CryptoTradingBot:
         absolute_return = final_balance - initial_balance
         percentage_return = (absolute_return / initial_balance) * 100
         
-        # Calculate drawdown
-        if not equity_df.empty:
-            equity_df['cummax'] = equity_df['balance'].cummax()
-            equity_df['drawdown'] = (equity_df['balance'] / equity_df['cummax'] - 1) * 100
-            max_drawdown = equity_df['drawdown'].min()
-        else:
-            max_drawdown = 0
-        
-        # Calculate Sharpe ratio (if more than one data point)
-        if len(equity_df) > 1:
-            equity_df['returns'] = equity_df['balance'].pct_change()
-            sharpe_ratio = equity_df['returns'].mean() / equity_df['returns'].std() * np.sqrt(252)  # Annualized
-        else:
-            sharpe_ratio = 0
+        # Calculate drawdown and Sharpe ratio from the run-length equity curve
+        max_drawdown = self.equity_curve.max_drawdown()
+        sharpe_ratio = self.equity_curve.sharpe_ratio()  # Annualized
         
         # Create results dictionary
         results = {
@@ -547,58 +2409,75 @@ class CryptoTradingBot:
         return results
     
     # Backtest visualization methods
-    def plot_equity_curve(self, results: dict, save_path: str = None):
-        """Plot equity curve from backtest results."""
+    def plot_equity_curve(self, results, save_path: str = None, max_points: int = 5000,
+                          downsample: str = 'minmax', show: bool = True):
+        """
+        Plot equity curve from backtest results (a dict or a saved results directory).
+        
+        Parameters:
+        - results: Backtest results
+        - save_path: Optional image file to save the plot to
+        - max_points: Approximate number of points drawn per line; longer series are downsampled
+        - downsample: 'minmax' (keeps every bucket's extremes, so drawdowns stay exact),
+          'lttb' (Largest-Triangle-Three-Buckets) or None to draw every point
+        - show: Show the figure; otherwise it is drawn on a standalone Figure, only saved
+        """
+        results = _coerce_results(results)
         if not results.get('equity_curve'):
             logger.warning("No equity curve data available to plot")
             return
         
-        # Create DataFrame from equity curve
-        equity_data = pd.DataFrame(results['equity_curve'])
-        equity_data.set_index('timestamp', inplace=True)
+        # Draw the change points as steps instead of one point per candle
+        equity_data = results['equity_curve'].to_step_frame()
+        keep = downsample_indices(equity_data.index.asi8, equity_data['balance'].to_numpy(), max_points, downsample)
+        equity_data = equity_data.iloc[keep]
         
-        plt.figure(figsize=(12, 6))
-        plt.plot(equity_data.index, equity_data['balance'], label='Balance')
+        fig = _new_figure((12, 6), show)
+        ax = fig.subplots()
+        ax.plot(equity_data.index, equity_data['balance'], drawstyle='steps-post', label='Balance')
+        if results.get('mtm_equity'):
+            mtm = results['mtm_equity']
+            keep = downsample_indices(mtm.times, mtm.equity, max_points, downsample)
+            ax.plot(pd.to_datetime(mtm.times[keep], unit='ns'), mtm.equity[keep],
+                    linewidth=0.8, alpha=0.7, label='Mark-to-market equity')
         
         # Plot horizontal line at initial balance
-        plt.axhline(y=results['initial_balance'], color='r', linestyle='--', label='Initial Balance')
-        
-        plt.title('Equity Curve')
-        plt.xlabel('Date')
-        plt.ylabel('Balance')
-        plt.legend()
-        plt.grid(True)
+        ax.axhline(y=results['initial_balance'], color='r', linestyle='--', label='Initial Balance')
         
-        if save_path:
-            plt.savefig(save_path)
+        ax.set_title('Equity Curve')
+        ax.set_xlabel('Date')
+        ax.set_ylabel('Balance')
+        ax.legend()
+        ax.grid(True)
         
-        plt.show()
+        _finish_figure(fig, save_path, show)
     
-    def plot_trade_analysis(self, results: dict, save_path: str = None):
-        """Plot detailed trade analysis from backtest results."""
+    def plot_trade_analysis(self, results, save_path: str = None, show: bool = True):
+        """
+        Plot detailed trade analysis from backtest results (a dict or a saved results directory).
+        
+        With show=False it is drawn on a standalone Figure and only saved.
+        """
+        results = _coerce_results(results)
         if not results.get('trade_history'):
             logger.warning("No trade history available to plot")
             return
         
-        # Create DataFrame from trade history
-        trades = [t for t in results['trade_history'] if t.get('action') == 'close']
+        # Positions and breakdowns are computed once per results and cached
+        analytics = _trade_analytics(results)
+        trade_df = analytics.positions.copy()
         
-        if not trades:
+        if trade_df.empty:
             logger.warning("No closed trades found to analyze")
             return
         
-        trade_df = pd.DataFrame(trades)
-        
-        # Convert time to datetime if it's not already
-        if trade_df['time'].dtype != 'datetime64[ns]':
-            trade_df['time'] = pd.to_datetime(trade_df['time'])
-        
         # Set up figure
-        fig, axes = plt.subplots(2, 2, figsize=(16, 12))
+        fig = _new_figure((16, 12), show)
+        axes = fig.subplots(2, 2)
         
         # Plot 1: Cumulative P&L
         trade_df['cumulative_pnl'] = trade_df['pnl_amount'].cumsum()
-        axes[0, 0].plot(trade_df['time'], trade_df['cumulative_pnl'])
+        axes[0, 0].plot(trade_df['close_time'], trade_df['cumulative_pnl'])
         axes[0, 0].set_title('Cumulative P&L')
         axes[0, 0].set_xlabel('Date')
         axes[0, 0].set_ylabel('Profit/Loss')
@@ -612,34 +2491,30 @@ class CryptoTradingBot:
         axes[0, 1].grid(True)
         
         # Plot 3: P&L by Close Reason
-        if 'reason' in trade_df.columns:
-            reason_groups = trade_df.groupby('reason')['pnl_amount'].sum()
-            axes[1, 0].bar(reason_groups.index, reason_groups.values)
-            axes[1, 0].set_title('P&L by Close Reason')
-            axes[1, 0].set_xlabel('Reason')
-            axes[1, 0].set_ylabel('Total P&L')
-            axes[1, 0].grid(True)
+        reason_groups = analytics.by_reason['total_pnl']
+        axes[1, 0].bar(reason_groups.index, reason_groups.values)
+        axes[1, 0].set_title('P&L by Close Reason')
+        axes[1, 0].set_xlabel('Reason')
+        axes[1, 0].set_ylabel('Total P&L')
+        axes[1, 0].grid(True)
         
         # Plot 4: Rolling Win Rate
         window_size = min(10, len(trade_df))
-        trade_df['win'] = trade_df['pnl_amount'] > 0
         trade_df['rolling_win_rate'] = trade_df['win'].rolling(window=window_size).mean() * 100
         
-        axes[1, 1].plot(trade_df['time'], trade_df['rolling_win_rate'])
+        axes[1, 1].plot(trade_df['close_time'], trade_df['rolling_win_rate'])
         axes[1, 1].set_title(f'Rolling {window_size}-Trade Win Rate')
         axes[1, 1].set_xlabel('Date')
         axes[1, 1].set_ylabel('Win Rate %')
         axes[1, 1].grid(True)
         
-        plt.tight_layout()
+        fig.tight_layout()
         
-        if save_path:
-            plt.savefig(save_path)
-        
-        plt.show()
+        _finish_figure(fig, save_path, show)
     
-    def generate_backtest_report(self, results: dict, save_path: str = None):
-        """Generate a comprehensive backtest report."""
+    def generate_backtest_report(self, results, save_path: str = None):
+        """Generate a comprehensive backtest report from results (a dict or a saved results directory)."""
+        results = _coerce_results(results)
         if not results:
             logger.warning("No results available to generate report")
             return
@@ -654,7 +2529,11 @@ class CryptoTradingBot:
         report += f"- Absolute Return: ${results['absolute_return']:.2f}\n"
         report += f"- Percentage Return: {results['percentage_return']:.2f}%\n"
         report += f"- Max Drawdown: {results['max_drawdown']:.2f}%\n"
-        report += f"- Sharpe Ratio: {results['sharpe_ratio']:.4f}\n\n"
+        report += f"- Sharpe Ratio: {results['sharpe_ratio']:.4f}\n"
+        if 'mtm_max_drawdown' in results:
+            report += f"- Mark-to-Market Max Drawdown: {results['mtm_max_drawdown']:.2f}%\n"
+            report += f"- Mark-to-Market Sharpe Ratio: {results['mtm_sharpe_ratio']:.4f}\n"
+        report += "\n"
         
         # Trade statistics
         report += "## Trade Statistics\n\n"
@@ -663,15 +2542,357 @@ class CryptoTradingBot:
         report += f"- Losing Trades: {results['losing_trades']}\n"
         report += f"- Win Rate: {results['win_rate']:.2f}%\n\n"
         
+        # Margin ladder and counter trade usage
+        report += "## Position Management\n\n"
+        if isinstance(results.get('trade_history'), TradeLog):
+            closed = results['trade_history'].closed_trades()
+            if len(closed):
+                report += f"- Average Margin Levels Used: {closed['margin_levels_used'].mean():.2f}\n"
+        # Lean backtests keep TradeStats and NullLog stand-ins that record no rows
+        if isinstance(results.get('margin_additions'), ColumnarLog):
+            report += f"- Margin Additions: {len(results['margin_additions'])}\n"
+        if isinstance(results.get('counter_trades'), ColumnarLog):
+            report += f"- Counter Trades: {len(results['counter_trades'])}\n"
+        if isinstance(results.get('trade_history'), TradeStats):
+            report += "- Not recorded in lean backtests\n"
+        report += "\n"
+        
+        if isinstance(results.get('trade_history'), TradeLog):
+            report += _trade_analytics(results).report_section()
+        
         # Strategy parameters
         report += "## Strategy Parameters\n\n"
         for key, value in results['parameters'].items():
             report += f"- {key}: {value}\n"
         
+        # Time per backtest stage when profiling was enabled
+        if isinstance(results.get('profile'), pd.DataFrame):
+            report += "\n## Profile\n\n"
+            report += f"```\n{results['profile'].to_string(float_format='{:.6f}'.format)}\n```\n"
+        
         # Save report to file if specified
         if save_path:
             with open(save_path, 'w') as f:
                 f.write(report)
             logger.info(f"Backtest report saved to {save_path}")
         
-        return report
\ No newline at end of file
+        return report
+
+# Parameter sweeps
+SWEEP_PARAMETERS = (
+    'total_balance', 'tkm_percentage', 'entry_price_percentage', 'leverage',
+    'margin_loss_roi_levels', 'margin_increase_levels', 'take_profit_roi',
+    'counter_trade_loss_roi', 'counter_trade_margin_percentage', 'position_direction',
+    'detection_period_minutes', 'pump_dump_threshold', 'intrabar_fills'
+)
+SUMMARY_METRICS = (
+    'initial_balance', 'final_balance', 'absolute_return', 'percentage_return',
+    'total_trades', 'winning_trades', 'losing_trades', 'win_rate', 'max_drawdown', 'sharpe_ratio'
+)
+
+# Per-process state of sweep workers, set once by _sweep_worker_init
+_worker_state = {}
+
+
+def _sweep_defaults(bot: 'CryptoTradingBot') -> dict:
+    """Values of the sweepable parameters of a bot, which configs are applied on top of."""
+    return {key: getattr(bot, key) for key in SWEEP_PARAMETERS}
+
+
+def _sweep_worker_init(descriptor: dict, base_params: dict):
+    """Attach the shared candle arrays and build one reusable bot per worker process."""
+    data, handles = SharedMarketData.attach(descriptor)
+    # Workers only return summary metrics, so skip building logs unless asked otherwise
+    bot = CryptoTradingBot(backtest_mode=True, **{'lean_backtest': True, **base_params})
+    _worker_state.update({
+        'data': data,
+        'handles': handles,
+        'bot': bot,
+        'defaults': _sweep_defaults(bot),
+    })
+
+
+def _sweep_worker_run(config: dict) -> dict:
+    """Run one configuration and return only its summary metrics."""
+    bot = _worker_state['bot']
+    # Start from the base parameters so overrides of earlier tasks do not leak
+    results = bot.run_backtest(_worker_state['data'], {**_worker_state['defaults'], **config})
+    summary = {key: results[key] for key in SUMMARY_METRICS}
+    summary.update(config)
+    return summary
+
+
+def _grid_configs(param_grid, n_iter: int = None, seed: int = None) -> List[dict]:
+    """
+    Expand a parameter grid, or sample n_iter distinct points from it without building the full product.
+    
+    param_grid may also be a ready list of config dicts, e.g. from margin_ladder_configs.
+    """
+    if isinstance(param_grid, list):
+        if n_iter is None:
+            return list(param_grid)
+        return random.Random(seed).sample(param_grid, min(n_iter, len(param_grid)))
+    
+    keys = list(param_grid)
+    values = [list(param_grid[key]) for key in keys]
+    if n_iter is None:
+        return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+    
+    total = 1
+    for options in values:
+        total *= len(options)
+    configs = []
+    for flat_index in random.Random(seed).sample(range(total), min(n_iter, total)):
+        # Decode the flat index as a mixed-radix number over the grid axes
+        config = {}
+        for key, options in zip(reversed(keys), reversed(values)):
+            flat_index, choice = divmod(flat_index, len(options))
+            config[key] = options[choice]
+        configs.append({key: config[key] for key in keys})
+    return configs
+
+
+def run_parameter_sweep(historical_data, param_grid, n_iter: int = None,
+                        base_params: dict = None, max_workers: int = None,
+                        sort_by: str = 'percentage_return', ascending: bool = False,
+                        seed: int = None, store=None) -> pd.DataFrame:
+    """
+    Backtest many parameter sets in parallel and rank them.
+    
+    Candle columns are placed in shared memory once and every worker process
+    maps them directly, so tasks only carry their parameter dict.
+    
+    With a results store, every finished configuration is written as soon as
+    it completes, and configurations already stored for the same data and
+    full parameter set are read back instead of run again, so an interrupted
+    sweep resumes where it stopped.
+    
+    Parameters:
+    - historical_data: DataFrame with OHLCV data, MarketData columns or a MarketData.save() directory
+    - param_grid: Mapping of CryptoTradingBot parameter name to candidate values,
+      or a list of config dicts such as margin_ladder_configs returns
+    - n_iter: Number of random grid points to evaluate (None runs the full grid)
+    - base_params: Bot constructor parameters shared by all runs
+    - max_workers: Number of worker processes (defaults to all cores, 1 runs in-process)
+    - sort_by: Metric used to rank the results
+    - ascending: Rank in ascending order of sort_by
+    - seed: Random seed for n_iter sampling
+    - store: Optional backtest_store.ResultsStore to cache results in
+    
+    Returns:
+    - DataFrame with one row per configuration, best first
+    """
+    historical_data = MarketData.coerce(historical_data)
+    base_params = base_params or {}
+    configs = _grid_configs(param_grid, n_iter, seed)
+    
+    rows = []
+    pending = list(enumerate(configs))
+    if store is not None:
+        defaults = _sweep_defaults(CryptoTradingBot(backtest_mode=True, **base_params))
+        runs = [store.describe_run(historical_data, {**defaults, **config}) for config in configs]
+        stored = store.summaries([key for key, _, _ in runs])
+        rows = [{**stored[runs[i][0]], **config} for i, config in pending if runs[i][0] in stored]
+        pending = [(i, config) for i, config in pending if runs[i][0] not in stored]
+        logger.info(f"{len(configs) - len(pending)} of {len(configs)} configurations found in the results store")
+    logger.info(f"Running parameter sweep over {len(pending)} configurations")
+    
+    def finished(i, summary):
+        rows.append(summary)
+        if store is not None:
+            store.add(*runs[i], summary)
+    
+    with SharedMarketData(historical_data) as shared:
+        if max_workers == 1:
+            _sweep_worker_init(shared.descriptor, base_params)
+            for i, config in tqdm(pending, desc="Parameter sweep"):
+                finished(i, _sweep_worker_run(config))
+            _worker_state.clear()
+        elif pending:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_sweep_worker_init,
+                                     initargs=(shared.descriptor, base_params)) as executor:
+                futures = {executor.submit(_sweep_worker_run, config): i for i, config in pending}
+                for future in tqdm(as_completed(futures), total=len(futures), desc="Parameter sweep"):
+                    finished(futures[future], future.result())
+    
+    results_df = pd.DataFrame(rows)
+    if not results_df.empty:
+        results_df = results_df.sort_values(sort_by, ascending=ascending, ignore_index=True)
+    return results_df
+
+
+def _halving_worker_run(config: dict, state: Optional[BacktestState], stop: int, final: bool):
+    """
+    Continue one candidate up to stop, resuming from its saved state if it has one.
+    
+    Returns:
+    - tuple of (summary metrics, state to resume from, or None after the final rung)
+    """
+    bot = _worker_state['bot']
+    if state is None:
+        bot.start_backtest(_worker_state['data'], {**_worker_state['defaults'], **config})
+    else:
+        bot.set_backtest_state(state, _worker_state['data'])
+    bot.advance_backtest(stop)
+    
+    if final:
+        results = bot.finish_backtest()
+        summary, state = {key: results[key] for key in SUMMARY_METRICS}, None
+    else:
+        summary, state = bot.evaluate_backtest(), bot.get_backtest_state()
+    summary.update(config)
+    return summary, state
+
+
+def return_drawdown_score(summary: dict) -> float:
+    """Rank candidates by percentage return per percent of max drawdown."""
+    return summary['percentage_return'] / max(abs(summary['max_drawdown']), 1.0)
+
+
+def run_successive_halving(historical_data, param_grid, n_iter: int = None,
+                           base_params: dict = None, eta: int = 3, num_rungs: int = 4,
+                           score=return_drawdown_score, max_workers: int = None,
+                           seed: int = None) -> pd.DataFrame:
+    """
+    Search a parameter grid with successive halving.
+    
+    Every candidate is first backtested on the first eta**-(num_rungs - 1)
+    share of the history. Only the best 1/eta by score are promoted to the
+    next, eta times longer slice, until the survivors reach the full history.
+    Promoted candidates resume from their saved BacktestState rather than
+    starting again from the first candle.
+    
+    Parameters:
+    - historical_data: DataFrame with OHLCV data, MarketData columns or a MarketData.save() directory
+    - param_grid: Mapping of CryptoTradingBot parameter name to candidate values,
+      or a list of config dicts such as margin_ladder_configs returns
+    - n_iter: Number of random grid points to start with (None uses the full grid)
+    - base_params: Bot constructor parameters shared by all runs
+    - eta: Reduction factor between rungs
+    - num_rungs: Number of history slices, the last one being the full history
+    - score: Function of a summary dict used to rank candidates (higher is better)
+    - max_workers: Number of worker processes (defaults to all cores, 1 runs in-process)
+    - seed: Random seed for n_iter sampling
+    
+    Returns:
+    - DataFrame with the last evaluation of every candidate, full-history survivors first
+    """
+    historical_data = MarketData.coerce(historical_data)
+    base_params = base_params or {}
+    configs = _grid_configs(param_grid, n_iter, seed)
+    num_candles = len(historical_data)
+    candidates = [{'config': config, 'state': None} for config in configs]
+    finished = []
+    
+    with SharedMarketData(historical_data) as shared:
+        executor = None
+        if max_workers != 1:
+            executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_sweep_worker_init,
+                                           initargs=(shared.descriptor, base_params))
+        else:
+            _sweep_worker_init(shared.descriptor, base_params)
+        
+        try:
+            for rung in range(num_rungs):
+                final = rung == num_rungs - 1
+                stop = num_candles if final else max(int(num_candles * eta ** (rung - num_rungs + 1)), 1)
+                logger.info(f"Successive halving rung {rung + 1}/{num_rungs}: "
+                            f"{len(candidates)} candidates on {stop} candles")
+                
+                tasks = [(c['config'], c['state'], stop, final) for c in candidates]
+                if executor is None:
+                    outputs = [_halving_worker_run(*task) for task in tqdm(tasks, desc=f"Rung {rung + 1}")]
+                else:
+                    futures = [executor.submit(_halving_worker_run, *task) for task in tasks]
+                    for _ in tqdm(as_completed(futures), total=len(futures), desc=f"Rung {rung + 1}"):
+                        pass
+                    outputs = [future.result() for future in futures]
+                
+                for candidate, (summary, state) in zip(candidates, outputs):
+                    candidate.update(summary=summary, state=state,
+                                     score=score(summary), rung=rung + 1, candles=stop)
+                if final:
+                    break
+                
+                # Promote the best 1/eta of the candidates to the next, longer slice
+                candidates.sort(key=lambda c: np.nan_to_num(c['score'], nan=-np.inf), reverse=True)
+                keep = max(len(candidates) // eta, 1)
+                finished.extend(candidates[keep:])
+                candidates = candidates[:keep]
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            _worker_state.clear()
+    
+    rows = [{**c['summary'], 'score': c['score'], 'rung': c['rung'], 'candles': c['candles']}
+            for c in candidates + finished]
+    results_df = pd.DataFrame(rows)
+    if not results_df.empty:
+        results_df = results_df.sort_values(['rung', 'score'], ascending=False, ignore_index=True)
+    return results_df
+
+
+# Headless report rendering
+REPORT_FILES = ('report.md', 'equity_curve.png', 'trade_analysis.png')
+
+
+# Bot of a report rendering worker process
+_render_state = {}
+
+
+def _render_worker_init():
+    """Build the bot a worker process renders with."""
+    _render_state['bot'] = CryptoTradingBot(backtest_mode=True)
+
+
+def _render_run(bot: 'CryptoTradingBot', name: str, results, output_dir: str, max_points: int) -> str:
+    """Write the report and plots of one run to output_dir/name and return that directory."""
+    results = _coerce_results(results)
+    run_dir = os.path.join(output_dir, name)
+    os.makedirs(run_dir, exist_ok=True)
+    report_file, equity_file, trades_file = (os.path.join(run_dir, file) for file in REPORT_FILES)
+    bot.generate_backtest_report(results, report_file)
+    bot.plot_equity_curve(results, equity_file, max_points=max_points, show=False)
+    bot.plot_trade_analysis(results, trades_file, show=False)
+    return run_dir
+
+
+def _render_worker_run(name: str, results, output_dir: str, max_points: int) -> str:
+    """_render_run in a worker process."""
+    return _render_run(_render_state['bot'], name, results, output_dir, max_points)
+
+
+def render_backtest_reports(runs: Dict[str, object], output_dir: str, max_workers: int = None,
+                            max_points: int = 5000) -> Dict[str, str]:
+    """
+    Render the report and plots of many runs headlessly in parallel worker processes.
+    
+    Each run gets output_dir/<name>/ with report.md, equity_curve.png and
+    trade_analysis.png. Pass save_backtest_results directories rather than
+    results dicts, so workers map the logs instead of receiving pickled copies.
+    Plots are drawn on standalone Figures, so the active pyplot backend and
+    its open figures are left alone.
+    
+    Parameters:
+    - runs: Mapping of run name to results dict or saved results directory
+    - output_dir: Directory for the per-run output directories
+    - max_workers: Number of worker processes (defaults to all cores, 1 renders in-process)
+    - max_points: Approximate number of points drawn per equity line
+    
+    Returns:
+    - dict of run name to its output directory
+    """
+    logger.info(f"Rendering reports of {len(runs)} backtests to {output_dir}")
+    rendered = {}
+    if max_workers == 1:
+        bot = CryptoTradingBot(backtest_mode=True)
+        for name, results in tqdm(runs.items(), desc="Rendering reports"):
+            rendered[name] = _render_run(bot, name, results, output_dir, max_points)
+        return rendered
+    
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_render_worker_init) as executor:
+        futures = {executor.submit(_render_worker_run, name, results, output_dir, max_points): name
+                   for name, results in runs.items()}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Rendering reports"):
+            rendered[futures[future]] = future.result()
+    return rendered
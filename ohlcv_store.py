@@ -0,0 +1,425 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import ccxt
+import ccxt.async_support as ccxt_async
+
+from backtestt import MarketData
+
+logger = logging.getLogger("OHLCVStore")
+
+CANDLE_DTYPE = np.dtype([
+    ('time', 'i8'),  # candle open time in nanoseconds since the epoch
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('volume', 'f8'),
+])
+NS_PER_MS = 1_000_000
+
+
+def timeframe_ns(timeframe: str) -> int:
+    """Length of a ccxt timeframe such as '1m' or '4h' in nanoseconds."""
+    return int(ccxt.Exchange.parse_timeframe(timeframe)) * 1_000_000_000
+
+
+class OHLCVStore:
+    """
+    Local columnar candle store with one .npy file per symbol and month.
+
+    Files hold CANDLE_DTYPE rows sorted by time without duplicates, e.g.
+    <root>/BTC_USDT_USDT/2024-01.npy. Writes go through a temporary file and
+    os.replace, so an interrupted download never leaves a truncated month.
+    Ranges the exchange returned no candles for (delistings, outages) are
+    recorded in empty_ranges.json, so they are not requested again.
+    """
+    EMPTY_RANGES_FILE = 'empty_ranges.json'
+
+    def __init__(self, root: str, timeframe: str = '1m'):
+        self.root = root
+        self.timeframe = timeframe
+        self.timeframe_ns = timeframe_ns(timeframe)
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def _symbol_dir_name(symbol: str) -> str:
+        return symbol.replace('/', '_').replace(':', '_')
+
+    def _symbol_dir(self, symbol: str) -> str:
+        return os.path.join(self.root, self._symbol_dir_name(symbol))
+
+    def _month_files(self, symbol: str) -> List[str]:
+        directory = self._symbol_dir(symbol)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                      if name.endswith('.npy'))
+
+    def symbols(self) -> List[str]:
+        """Symbols with stored candles, as recorded in each symbol directory."""
+        symbols = []
+        for name in sorted(os.listdir(self.root)):
+            meta_path = os.path.join(self.root, name, 'symbol.json')
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    symbols.append(json.load(f)['symbol'])
+        return symbols
+
+    def last_timestamp(self, symbol: str) -> Optional[int]:
+        """Open time (ns) of the newest stored candle, or None if nothing is stored."""
+        files = self._month_files(symbol)
+        if not files:
+            return None
+        rows = np.load(files[-1], mmap_mode='r')
+        return int(rows['time'][-1]) if len(rows) else None
+
+    def append(self, symbol: str, candles: np.ndarray):
+        """
+        Merge CANDLE_DTYPE rows into the month files of symbol.
+
+        Rows may overlap stored candles (e.g. when filling gaps); duplicates
+        are replaced by the newly downloaded values.
+        """
+        if not len(candles):
+            return
+        directory = self._symbol_dir(symbol)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, 'symbol.json'), 'w') as f:
+                json.dump({'symbol': symbol, 'timeframe': self.timeframe}, f)
+
+        months = pd.to_datetime(candles['time'], unit='ns').strftime('%Y-%m').to_numpy()
+        for month in np.unique(months):
+            new_rows = candles[months == month]
+            path = os.path.join(directory, f'{month}.npy')
+            if os.path.exists(path):
+                # New rows come first so they win when de-duplicating
+                new_rows = np.concatenate([new_rows, np.load(path)])
+            _, first = np.unique(new_rows['time'], return_index=True)
+            merged = new_rows[first]
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, merged)
+            os.replace(tmp_path, path)
+
+    def _iter_month_rows(self, symbol: str, start: int = None, end: int = None):
+        """Stored rows with start <= time < end (ns), one month file at a time."""
+        for path in self._month_files(symbol):
+            rows = np.load(path, mmap_mode='r')
+            if not len(rows):
+                continue
+            if (start is not None and rows['time'][-1] < start) or (end is not None and rows['time'][0] >= end):
+                continue
+            lo = 0 if start is None else np.searchsorted(rows['time'], start)
+            hi = len(rows) if end is None else np.searchsorted(rows['time'], end)
+            yield np.asarray(rows[lo:hi])
+
+    @staticmethod
+    def _to_market_data(symbol: str, rows: np.ndarray) -> MarketData:
+        return MarketData(rows['time'].copy(), rows['close'].copy(), open=rows['open'].copy(),
+                          high=rows['high'].copy(), low=rows['low'].copy(),
+                          volume=rows['volume'].copy(), symbol_names=(symbol,))
+
+    def load_candles(self, symbol: str, start: int = None, end: int = None) -> np.ndarray:
+        """Stored CANDLE_DTYPE rows of symbol with start <= time < end (ns)."""
+        parts = list(self._iter_month_rows(symbol, start, end))
+        return np.concatenate(parts) if parts else np.empty(0, dtype=CANDLE_DTYPE)
+
+    def load(self, symbol: str, start: int = None, end: int = None) -> MarketData:
+        """Stored candles of symbol as MarketData, ready for run_backtest."""
+        return self._to_market_data(symbol, self.load_candles(symbol, start, end))
+
+    def iter_chunks(self, symbol: str, start: int = None, end: int = None):
+        """Yield stored candles month by month as MarketData, for run_backtest_stream."""
+        for rows in self._iter_month_rows(symbol, start, end):
+            yield self._to_market_data(symbol, rows)
+
+    def export_dataset(self, symbols: List[str], directory: str, start: int = None,
+                       end: int = None) -> MarketData:
+        """
+        Write symbols back to back as a memory-mapped MarketData dataset.
+
+        Columns are filled one symbol at a time through np.lib.format.open_memmap,
+        so the full dataset never has to fit in memory.
+
+        Returns:
+        - MarketData mapped read-only from directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        counts = [len(self.load_candles(symbol, start, end)) for symbol in symbols]
+        total = sum(counts)
+        columns = {name: np.lib.format.open_memmap(os.path.join(directory, f'{name}.npy'), mode='w+',
+                                                   dtype=CANDLE_DTYPE[name], shape=(total,))
+                   for name in ('time',) + MarketData.COLUMNS}
+        symbol_codes = np.lib.format.open_memmap(os.path.join(directory, 'symbol_codes.npy'), mode='w+',
+                                                 dtype=np.int32, shape=(total,))
+        offset = 0
+        for code, (symbol, count) in enumerate(zip(symbols, counts)):
+            rows = self.load_candles(symbol, start, end)
+            for name, column in columns.items():
+                column[offset:offset + count] = rows[name]
+            symbol_codes[offset:offset + count] = code
+            offset += count
+        for column in (*columns.values(), symbol_codes):
+            column.flush()
+        del columns, symbol_codes
+        os.replace(os.path.join(directory, 'time.npy'), os.path.join(directory, 'times.npy'))
+
+        mapped = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                  for name in ('times',) + MarketData.COLUMNS + ('symbol_codes',)}
+        MarketData(symbol_names=symbols, **mapped).write_metadata(directory)
+        return MarketData.load(directory)
+
+    def empty_ranges(self, symbol: str) -> List[Tuple[int, int]]:
+        """Ranges (start, end) in ns confirmed to have no exchange candles, sorted and merged."""
+        path = os.path.join(self._symbol_dir(symbol), self.EMPTY_RANGES_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [tuple(pair) for pair in json.load(f)]
+
+    def mark_empty(self, symbol: str, start: int, end: int):
+        """Record that the exchange has no candles with start <= open time < end (ns)."""
+        ranges = sorted(self.empty_ranges(symbol) + [(int(start), int(end))])
+        merged = [list(ranges[0])]
+        for range_start, range_end in ranges[1:]:
+            if range_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], range_end)
+            else:
+                merged.append([range_start, range_end])
+        path = os.path.join(self._symbol_dir(symbol), self.EMPTY_RANGES_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(merged, f)
+        os.replace(path + '.tmp', path)
+
+    def find_gaps(self, symbol: str, start: int = None, end: int = None,
+                  include_empty: bool = False) -> List[Tuple[int, int]]:
+        """
+        Missing candle ranges between stored candles.
+
+        Only the time column is read, one month file at a time, so long
+        histories are scanned without loading them.
+
+        Parameters:
+        - symbol: Market symbol
+        - start, end: Only look at stored candles with start <= time < end (ns)
+        - include_empty: Also return gaps already confirmed empty by mark_empty
+
+        Returns:
+        - list of (first missing open time, next stored open time) in ns
+        """
+        gaps, previous = [], None
+        for rows in self._iter_month_rows(symbol, start, end):
+            times = rows['time']
+            if previous is not None and times[0] - previous > self.timeframe_ns:
+                gaps.append((previous + self.timeframe_ns, int(times[0])))
+            gap_after = np.flatnonzero(np.diff(times) > self.timeframe_ns)
+            gaps += [(int(times[i]) + self.timeframe_ns, int(times[i + 1])) for i in gap_after]
+            previous = int(times[-1])
+
+        if include_empty:
+            return gaps
+        empty = self.empty_ranges(symbol)
+        return [(gap_start, gap_end) for gap_start, gap_end in gaps
+                if not any(empty_start <= gap_start and gap_end <= empty_end for empty_start, empty_end in empty)]
+
+
+class OHLCVDownloader:
+    """
+    Incremental, concurrent candle downloader for an OHLCVStore.
+
+    Symbols are downloaded concurrently with asyncio, at most max_concurrency
+    at a time, and requests are spaced by the exchange's rateLimit. Each symbol
+    resumes from the newest stored candle. Afterwards gaps between stored
+    candles are downloaded again, and whatever the exchange still has no
+    candles for is marked empty in the store and skipped from then on. Any object with an async fetch_ohlcv(symbol,
+    timeframe, since, limit) and a rateLimit attribute can act as the exchange,
+    so a local fake can replace ccxt in tests.
+    """
+
+    def __init__(self, exchange, store: OHLCVStore, limit: int = 1000,
+                 max_concurrency: int = 8, flush_rows: int = 50_000):
+        """
+        Parameters:
+        - exchange: ccxt async exchange (or compatible fake)
+        - store: Store to append candles to
+        - limit: Candles per fetch_ohlcv request
+        - max_concurrency: Maximum number of requests in flight
+        - flush_rows: Buffered candles per symbol before writing to the store
+        """
+        self.exchange = exchange
+        self.store = store
+        self.limit = limit
+        self.flush_rows = flush_rows
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._throttle_lock = asyncio.Lock()
+        self._next_request_time = 0.0
+        self._min_interval = getattr(exchange, 'rateLimit', 0) / 1000
+
+    def _now_ms(self) -> int:
+        milliseconds = getattr(self.exchange, 'milliseconds', None)
+        return int(milliseconds()) if milliseconds else int(time.time() * 1000)
+
+    async def _throttle(self):
+        """Space requests across all symbols by the exchange rate limit."""
+        async with self._throttle_lock:
+            delay = self._next_request_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_request_time = time.monotonic() + self._min_interval
+
+    async def _fetch_page(self, symbol: str, since_ms: int) -> list:
+        async with self._semaphore:
+            await self._throttle()
+            return await self.exchange.fetch_ohlcv(symbol, self.store.timeframe, since_ms, self.limit)
+
+    async def download_range(self, symbol: str, start: int, end: int = None) -> int:
+        """
+        Download candles of symbol with start <= open time < end (ns) into the store.
+
+        Returns:
+        - number of candles written
+        """
+        end_ms = self._now_ms() if end is None else end // NS_PER_MS
+        since_ms = start // NS_PER_MS
+        timeframe_ms = self.store.timeframe_ns // NS_PER_MS
+        buffer, buffered, written = [], 0, 0
+
+        while since_ms < end_ms:
+            page = await self._fetch_page(symbol, since_ms)
+            if not page:
+                break
+            rows = np.array([tuple(candle[:6]) for candle in page], dtype=CANDLE_DTYPE)
+            rows = rows[rows['time'] < end_ms]
+            last_ms = int(page[-1][0])
+            if len(rows):
+                rows['time'] *= NS_PER_MS
+                buffer.append(rows)
+                buffered += len(rows)
+            if buffered >= self.flush_rows:
+                self.store.append(symbol, np.concatenate(buffer))
+                written += buffered
+                buffer, buffered = [], 0
+            if last_ms < since_ms:
+                break
+            since_ms = last_ms + timeframe_ms
+
+        if buffer:
+            self.store.append(symbol, np.concatenate(buffer))
+            written += buffered
+        return written
+
+    async def update_symbol(self, symbol: str, since: int, fill_gaps: bool = True,
+                            gap_lookback: int = None) -> int:
+        """
+        Bring one symbol up to date, resuming after the newest stored candle.
+
+        Parameters:
+        - symbol: Market symbol, e.g. 'BTC/USDT:USDT'
+        - since: Open time (ns) to start from when nothing is stored yet
+        - fill_gaps: Re-download missing ranges between stored candles
+        - gap_lookback: Only fill gaps within this many ns before the newest candle (None scans all)
+        """
+        last = self.store.last_timestamp(symbol)
+        start = since if last is None else last + self.store.timeframe_ns
+        written = await self.download_range(symbol, start)
+
+        if fill_gaps:
+            newest = self.store.last_timestamp(symbol)
+            gap_start_limit = None if gap_lookback is None or newest is None else newest - gap_lookback
+            for gap_start, gap_end in self.store.find_gaps(symbol, gap_start_limit):
+                filled = await self.download_range(symbol, gap_start, gap_end)
+                written += filled
+                # What is still missing in the gap after asking the exchange is confirmed empty
+                remaining = self.store.find_gaps(symbol, gap_start - self.store.timeframe_ns, gap_end + 1,
+                                                 include_empty=True)
+                for empty_start, empty_end in remaining:
+                    logger.info(f"{symbol}: no exchange data for gap "
+                                f"{pd.Timestamp(empty_start)} - {pd.Timestamp(empty_end)}")
+                    self.store.mark_empty(symbol, empty_start, empty_end)
+
+        logger.info(f"{symbol}: stored {written} new candles")
+        return written
+
+    async def update(self, symbols: List[str], since: int, fill_gaps: bool = True,
+                     gap_lookback: int = None) -> Dict[str, int]:
+        """
+        Update all symbols concurrently (see update_symbol for the parameters).
+
+        Returns:
+        - mapping of symbol to candles written (failed symbols are logged and map to 0)
+        """
+        async def run(symbol):
+            try:
+                return await self.update_symbol(symbol, since, fill_gaps, gap_lookback)
+            except Exception as e:
+                logger.error(f"{symbol}: download failed: {e}")
+                return 0
+
+        counts = await asyncio.gather(*(run(symbol) for symbol in symbols))
+        return dict(zip(symbols, counts))
+
+
+async def usdt_m_symbols(exchange) -> List[str]:
+    """Active USDT-margined perpetual symbols of a ccxt exchange."""
+    markets = await exchange.load_markets()
+    return sorted(symbol for symbol, market in markets.items()
+                  if market.get('swap') and market.get('linear') and market.get('settle') == 'USDT'
+                  and market.get('active', True))
+
+
+async def download_ohlcv(root: str, symbols: List[str] = None, since: str = '2024-01-01',
+                         timeframe: str = '1m', exchange_id: str = 'binanceusdm',
+                         max_concurrency: int = 8) -> Dict[str, int]:
+    """
+    Download candles for many symbols into a local store.
+
+    Parameters:
+    - root: Store directory
+    - symbols: Symbols to download (defaults to all USDT-M perpetuals)
+    - since: Start date used for symbols without stored candles
+    - timeframe: ccxt timeframe
+    - exchange_id: ccxt exchange id, e.g. config.json's exchange_id
+    - max_concurrency: Maximum number of requests in flight
+    """
+    exchange = getattr(ccxt_async, exchange_id)({'enableRateLimit': False})
+    try:
+        if symbols is None:
+            symbols = await usdt_m_symbols(exchange)
+        store = OHLCVStore(root, timeframe)
+        downloader = OHLCVDownloader(exchange, store, max_concurrency=max_concurrency)
+        start = int(datetime.fromisoformat(since).replace(tzinfo=timezone.utc).timestamp()) * 1_000_000_000
+        return await downloader.update(symbols, start)
+    finally:
+        await exchange.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Download OHLCV candles into a local store")
+    parser.add_argument('--root', default='ohlcv_data')
+    parser.add_argument('--symbols', nargs='*', help="Defaults to config.json symbols_to_scan, else all USDT-M")
+    parser.add_argument('--since', default='2024-01-01')
+    parser.add_argument('--timeframe', default='1m')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    symbols = args.symbols
+    exchange_id = 'binanceusdm'
+    if os.path.exists('config.json'):
+        with open('config.json') as f:
+            config = json.load(f)
+        exchange_id = config.get('exchange_id', exchange_id)
+        symbols = symbols or config.get('symbols_to_scan')
+
+    asyncio.run(download_ohlcv(args.root, symbols, args.since, args.timeframe, exchange_id, args.concurrency))
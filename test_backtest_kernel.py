@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from backtest_kernel import NUMBA_AVAILABLE, check_kernel_equivalence
+
+
+def test_kernel_matches_run_backtest():
+    report = check_kernel_equivalence()
+    assert report['match'].all()
+    # The fixed check data must exercise margin additions and counter trades in every configuration
+    assert report['covered'].all()
+
+
+@pytest.mark.skipif(not NUMBA_AVAILABLE, reason="the kernel already runs as plain Python without Numba")
+def test_pure_python_kernel_matches_run_backtest():
+    code = "from backtest_kernel import check_kernel_equivalence; check_kernel_equivalence()"
+    check = subprocess.run([sys.executable, '-c', code], env={**os.environ, 'NUMBA_DISABLE_JIT': '1'},
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert check.returncode == 0
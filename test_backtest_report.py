@@ -0,0 +1,51 @@
+import os
+
+import matplotlib.pyplot as plt
+
+import backtestt
+from backtest_benchmark import generate_market
+from backtestt import (CryptoTradingBot, TradeStats, load_backtest_results, render_backtest_reports,
+                       save_backtest_results)
+
+CONFIG = {'take_profit_roi': 20}
+
+
+def test_lean_report(tmp_path):
+    bot = CryptoTradingBot(backtest_mode=True, lean_backtest=True)
+    results = bot.run_backtest(generate_market(20_000, 0), CONFIG)
+    assert isinstance(results['trade_history'], TradeStats)
+    assert results['total_trades'] > 0
+
+    report = bot.generate_backtest_report(results)
+    assert f"- Total Trades: {results['total_trades']}" in report
+    assert "## Position Management\n\n- Not recorded in lean backtests\n" in report
+    assert "Margin Additions" not in report
+
+    save_backtest_results(results, tmp_path / 'run')
+    assert "## Position Management" in bot.generate_backtest_report(load_backtest_results(tmp_path / 'run'))
+
+
+def test_render_lean_and_full_runs(tmp_path):
+    data = generate_market(20_000, 1)
+    runs = {'lean': CryptoTradingBot(backtest_mode=True, lean_backtest=True).run_backtest(data, CONFIG),
+            'full': CryptoTradingBot(backtest_mode=True).run_backtest(data, CONFIG)}
+    rendered = render_backtest_reports(runs, str(tmp_path), max_workers=1)
+
+    assert set(rendered) == {'lean', 'full'}
+    assert os.path.exists(os.path.join(rendered['lean'], 'report.md'))
+    assert sorted(os.listdir(rendered['full'])) == ['equity_curve.png', 'report.md', 'trade_analysis.png']
+    with open(os.path.join(rendered['full'], 'report.md')) as f:
+        assert "- Margin Additions:" in f.read()
+
+
+def test_render_leaves_pyplot_alone(tmp_path):
+    figure = plt.figure()
+    backend = plt.get_backend()
+    worker_state = dict(backtestt._worker_state)
+    results = CryptoTradingBot(backtest_mode=True).run_backtest(generate_market(20_000, 2), CONFIG)
+    render_backtest_reports({'run': results}, str(tmp_path), max_workers=1)
+
+    assert plt.get_backend() == backend
+    assert plt.get_fignums() == [figure.number]
+    assert backtestt._worker_state == worker_state
+    plt.close(figure)
@@ -0,0 +1,20 @@
+import itertools
+
+import numpy as np
+
+from backtestt import MARGIN_TOLERANCE, generate_margin_ladders, iter_margin_ladders, ladder_total_margin
+
+
+def test_ladders_match_brute_force():
+    values = [1, 5, 10, 25, 33, 50, 100, 150, 200]
+    expected = [list(ladder) for ladder in itertools.product(values, repeat=3)
+                if abs(ladder_total_margin(2, ladder) - 10) <= MARGIN_TOLERANCE]
+    assert generate_margin_ladders(2, 10, 3, level_values=values) == expected
+
+
+def test_five_levels_stream_in_order():
+    ladders = list(itertools.islice(iter_margin_ladders(2, 10, 5), 20_000))
+    assert len(ladders) == 20_000
+    assert ladders == sorted(ladders)
+    totals = ladder_total_margin(2, np.array(ladders, dtype=np.float64))
+    assert np.all(np.abs(totals - 10) <= MARGIN_TOLERANCE)
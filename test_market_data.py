@@ -0,0 +1,42 @@
+import gc
+
+import numpy as np
+import pandas as pd
+
+import backtestt
+from backtest_benchmark import generate_market
+from backtestt import CryptoTradingBot, MarketData, compute_entry_mask
+
+
+def _frame(num_candles: int) -> pd.DataFrame:
+    data = generate_market(num_candles, 0)
+    return pd.DataFrame({'open': data.open, 'high': data.high, 'low': data.low, 'close': data.close,
+                         'volume': data.volume}, index=pd.to_datetime(data.times))
+
+
+def test_frame_conversion_is_reused_while_the_frame_lives():
+    frame = _frame(5_000)
+    data = MarketData.coerce(frame)
+    assert MarketData.coerce(frame) is data
+    assert len(MarketData.coerce(frame.iloc[:-1])) == len(frame) - 1
+
+    key = id(frame)
+    del frame, data
+    gc.collect()
+    assert key not in backtestt._frame_conversions
+
+
+def test_frame_and_market_data_give_the_same_backtest():
+    frame = _frame(20_000)
+    bot = CryptoTradingBot(backtest_mode=True)
+    from_frame = bot.run_backtest(frame, {'take_profit_roi': 20})['trade_history'].to_records()
+    assert bot.run_backtest(frame, {'take_profit_roi': 20})['trade_history'].to_records() == from_frame
+    from_columns = bot.run_backtest(MarketData.from_frame(frame), {'take_profit_roi': 20})
+    assert from_columns['trade_history'].to_records() == from_frame
+
+
+def test_entry_mask_keeps_the_shape_of_change():
+    change = np.full((3, 50), 10.0)
+    assert compute_entry_mask(change, 'SHORT', 5).all()
+    unknown = compute_entry_mask(change, 'NEUTRAL', 5)
+    assert unknown.shape == change.shape and not unknown.any()
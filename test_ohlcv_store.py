@@ -0,0 +1,123 @@
+import asyncio
+
+import numpy as np
+import pandas as pd
+
+from ohlcv_store import NS_PER_MS, OHLCVDownloader, OHLCVStore
+
+MINUTE_MS = 60_000
+# Crosses a month boundary, so gaps spanning two month files are covered too
+START_MS = pd.Timestamp('2024-01-31 22:00').value // NS_PER_MS
+
+
+class FakeExchange:
+    """ccxt-like exchange serving 1m candles from memory, recording every request."""
+    rateLimit = 0
+
+    def __init__(self, num_candles: int, holes=()):
+        times = START_MS + np.arange(num_candles) * MINUTE_MS
+        self.candles = {}
+        self.holes = list(holes)  # (first, last) candle indices the exchange has no data for
+        self.times = times
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def add_symbol(self, symbol: str):
+        close = 100 + np.arange(len(self.times), dtype=np.float64)
+        self.candles[symbol] = [[int(t), c, c + 1, c - 1, c, 1.0] for t, c in zip(self.times, close)]
+
+    def milliseconds(self) -> int:
+        return int(self.times[-1]) + MINUTE_MS
+
+    def _available(self, index: int) -> bool:
+        return not any(first <= index <= last for first, last in self.holes)
+
+    async def fetch_ohlcv(self, symbol, timeframe, since, limit):
+        self.calls.append((symbol, since))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        return [candle for index, candle in enumerate(self.candles[symbol])
+                if candle[0] >= since and self._available(index)][:limit]
+
+
+def _update(exchange, store, symbols, **options):
+    downloader = OHLCVDownloader(exchange, store, limit=50, **options)
+    return asyncio.run(downloader.update(symbols, START_MS * NS_PER_MS))
+
+
+def test_resume_downloads_only_new_candles(tmp_path):
+    exchange = FakeExchange(300)
+    exchange.add_symbol('AAA/USDT:USDT')
+    store = OHLCVStore(str(tmp_path))
+    exchange.candles['AAA/USDT:USDT'] = exchange.candles['AAA/USDT:USDT'][:200]
+    assert _update(exchange, store, ['AAA/USDT:USDT']) == {'AAA/USDT:USDT': 200}
+
+    exchange.add_symbol('AAA/USDT:USDT')
+    exchange.calls.clear()
+    assert _update(exchange, store, ['AAA/USDT:USDT']) == {'AAA/USDT:USDT': 100}
+    assert exchange.calls[0][1] == int(exchange.times[200])
+    assert np.array_equal(store.load_candles('AAA/USDT:USDT')['time'], exchange.times * NS_PER_MS)
+
+
+def test_unfillable_gaps_are_requested_once(tmp_path):
+    exchange = FakeExchange(300, holes=[(100, 149)])
+    exchange.add_symbol('AAA/USDT:USDT')
+    store = OHLCVStore(str(tmp_path))
+    _update(exchange, store, ['AAA/USDT:USDT'])
+    hole = (int(exchange.times[100]) * NS_PER_MS, int(exchange.times[150]) * NS_PER_MS)
+    assert store.empty_ranges('AAA/USDT:USDT') == [hole]
+    assert store.find_gaps('AAA/USDT:USDT') == []
+    assert store.find_gaps('AAA/USDT:USDT', include_empty=True) == [hole]
+
+    exchange.calls.clear()
+    _update(exchange, store, ['AAA/USDT:USDT'])
+    # The store is up to date and the hole is known, so nothing is requested
+    assert exchange.calls == []
+
+
+def test_gaps_are_filled_once_the_exchange_has_them(tmp_path):
+    exchange = FakeExchange(300)
+    exchange.add_symbol('AAA/USDT:USDT')
+    store = OHLCVStore(str(tmp_path))
+    # Simulate a download that skipped candles, e.g. an interrupted earlier run
+    exchange.holes = [(120, 129)]
+    asyncio.run(OHLCVDownloader(exchange, store, limit=50).download_range(
+        'AAA/USDT:USDT', START_MS * NS_PER_MS))
+    assert len(store.find_gaps('AAA/USDT:USDT')) == 1
+
+    exchange.holes = []
+    assert _update(exchange, store, ['AAA/USDT:USDT']) == {'AAA/USDT:USDT': 10}
+    assert store.find_gaps('AAA/USDT:USDT', include_empty=True) == []
+    assert store.empty_ranges('AAA/USDT:USDT') == []
+
+
+def test_concurrent_update_respects_max_concurrency(tmp_path):
+    exchange = FakeExchange(200)
+    symbols = [f'S{i}/USDT:USDT' for i in range(6)]
+    for symbol in symbols:
+        exchange.add_symbol(symbol)
+    store = OHLCVStore(str(tmp_path))
+
+    assert _update(exchange, store, symbols, max_concurrency=2) == {symbol: 200 for symbol in symbols}
+    assert exchange.max_in_flight == 2
+    assert sorted(store.symbols()) == symbols
+    for symbol in symbols:
+        assert np.array_equal(store.load_candles(symbol)['close'], 100 + np.arange(200))
+
+
+def test_gap_lookback_limits_gap_filling(tmp_path):
+    exchange = FakeExchange(300, holes=[(50, 59)])
+    exchange.add_symbol('AAA/USDT:USDT')
+    store = OHLCVStore(str(tmp_path))
+    asyncio.run(OHLCVDownloader(exchange, store, limit=50).download_range(
+        'AAA/USDT:USDT', START_MS * NS_PER_MS))
+
+    exchange.calls.clear()
+    lookback = 100 * MINUTE_MS * NS_PER_MS
+    downloader = OHLCVDownloader(exchange, store, limit=50)
+    asyncio.run(downloader.update_symbol('AAA/USDT:USDT', START_MS * NS_PER_MS, gap_lookback=lookback))
+    assert exchange.calls == []
+    assert store.empty_ranges('AAA/USDT:USDT') == []